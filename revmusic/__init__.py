@@ -1,13 +1,11 @@
 import os
-import json
 from flask_cors import CORS
 from flask import Flask, Response, request, redirect
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
 
-# Initialize the database object
-db = SQLAlchemy()
+from .replicas import RoutingSQLAlchemy
+
+# Initialize the database object. Its sessions read from a replica when one is chosen for the request (see replicas.py)
+db = RoutingSQLAlchemy()
 
 from .constants import *
 
@@ -24,10 +22,10 @@ def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True, static_folder="static")
     # SOURCE: https://stackoverflow.com/questions/65587708/why-is-flask-cors-not-detecting-my-cross-origin-domain-in-production
     CORS(app, resources={r"/api/*": {"origins": "*", "allow_headers": "*", "expose_headers": "*"}})
-    # Check what database to use
+    # Check what database to use. A database server can be given in the environment
     if test_config is None:
         app.config.from_mapping(
-            SQLALCHEMY_DATABASE_URI = "sqlite:///../db/revmusic.db",
+            SQLALCHEMY_DATABASE_URI = os.environ.get("REVMUSIC_DATABASE_URI", "sqlite:///../db/revmusic.db"),
             SQLALCHEMY_TRACK_MODIFICATIONS=False
         )
     else:
@@ -35,19 +33,44 @@ def create_app(test_config=None):
 
     # Add database to the app
     db.init_app(app)
-    # Force foreing key usageUserCo
-    @event.listens_for(Engine, "connect")
-    def set_sqlite_pragma(dbapi_connection, connection_record):
-        cursor = dbapi_connection.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.close()
-        
+    # Configure the database connections (pooling, and foreign keys, WAL journaling etc. on SQLite)
+    from . import database
+    database.init_database(app)
+    # Route the reads of GET requests to the read replicas, if configured
+    from . import replicas
+    replicas.init_replicas(app)
+
     # Make "$ flask init-db" callable. Must be called before running the app
     from . import models
     app.cli.add_command(models.init_db_cmd)
+    # Make "$ flask upgrade-db" callable. Adds new indexes to an existing database
+    app.cli.add_command(models.upgrade_db_cmd)
+    # Make "$ flask snapshot-db" callable. Copies the SQLite database, e.g. for read replicas
+    app.cli.add_command(replicas.snapshot_db_cmd)
     # Make "$ flask populate-db" callable.
     from . import populate_db
     app.cli.add_command(populate_db.populate_db_cmd)
+    # Make "$ flask import-albums" callable.
+    from . import importer
+    app.cli.add_command(importer.import_albums_cmd)
+    # Make "$ flask benchmark" callable.
+    from . import benchmark
+    app.cli.add_command(benchmark.benchmark_cmd)
+    # Make "$ flask serve" callable. Also available as "$ revmusic serve"
+    from . import server
+    app.cli.add_command(server.serve_cmd)
+
+    # Build and compile the JSON schemas once; they are reused by every request
+    from . import schemas
+    schemas.init_schemas()
+
+    # Enable the request instrumentation, if configured
+    from . import metrics
+    metrics.init_metrics(app)
+
+    # Create the response cache, if one is configured
+    from . import caching
+    caching.init_cache(app)
 
     # Register API blueprint
     from . import api
@@ -64,21 +87,25 @@ def create_app(test_config=None):
         return redirect(APIARY_URL + "profiles")
 
 
-    from revmusic.mason import RevMusicBuilder
+    from revmusic.mason import RevMusicBuilder, dumps
+    from revmusic.caching import conditional
     # Add entry point
     @app.route('/api/', methods=["GET"])
+    @conditional()
     def entry_point():
         """
         Returns Mason with the controls:
         - revmusic:reviews-all
         - revmusic:albums-all
+        - revmusic:albums-top
         - revmusic:users-all
         """    
         body = RevMusicBuilder()
         body.add_namespace('revmusic', LINK_RELATIONS_URL)
         body.add_control_reviews_all()
         body.add_control_albums_all()
+        body.add_control_albums_top()
         body.add_control_users_all()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(dumps(body), 200, mimetype=MASON)
 
     return app
@@ -8,8 +8,8 @@ URL: https://github.com/enkwolf/pwp-course-sensorhub-api-example/blob/master/sen
 
 # Import the different resources
 from revmusic.resources.user import UserCollection, UserItem
-from revmusic.resources.album import AlbumCollection, AlbumItem
-from revmusic.resources.review import ReviewCollection, ReviewItem, ReviewsByAlbum, ReviewsByUser
+from revmusic.resources.album import AlbumCollection, AlbumBulk, TopAlbums, AlbumItem
+from revmusic.resources.review import ReviewCollection, ReviewBulk, ReviewItem, ReviewsByAlbum, ReviewsByUser
 #from revmusic.resources.tag import TagsByUser, TagItem
 
 # Create the API blueprint
@@ -20,10 +20,14 @@ api = Api(api_blueprint)
 api.add_resource(UserCollection, '/users/')
 api.add_resource(UserItem, '/users/<user>/')
 api.add_resource(AlbumCollection, '/albums/')
+# No trailing slash, so these never shadow an album named "bulk" or "top" at /albums/<album>/
+api.add_resource(AlbumBulk, '/albums/bulk')
+api.add_resource(TopAlbums, '/albums/top')
 api.add_resource(AlbumItem, '/albums/<album>/')
 api.add_resource(ReviewsByAlbum, '/albums/<album>/reviews/')
 api.add_resource(ReviewItem, '/albums/<album>/reviews/<review>/')
 api.add_resource(ReviewCollection, '/reviews/')
+api.add_resource(ReviewBulk, '/reviews/bulk')
 api.add_resource(ReviewsByUser, '/users/<user>/reviews/')
 #api.add_resource(TagsByUser, '/users/<user>/tags/')
 #api.add_resource(TagItem, '/users/<user>/tags/<tag>/')
@@ -0,0 +1,194 @@
+import io
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from revmusic import create_app, db
+from revmusic.database import DEFAULT_POOL_OPTIONS
+
+"""
+ASGI serving mode. The Flask app is wrapped into an ASGI application, which can be run by any ASGI server, e.g.
+$ uvicorn --factory revmusic.asgi:create_asgi_app
+The event loop holds the connections: it reads the request bodies and writes the responses, so slow clients and
+idle keep-alive connections cost no threads. Only the handling of a request, including its database access, is offloaded
+to a pool of ASGI_THREADS threads, by default as many as the database pool has connections. As the same app handles
+the requests, the responses are the same as when the app is served with WSGI.
+"""
+
+# Number of response messages a worker thread may queue before waiting for the client to read them
+RESPONSE_QUEUE_SIZE = 8
+
+
+def _build_environ(scope, body):
+    """
+    Returns the WSGI environ of an HTTP request
+    : param dict scope: the ASGI connection scope
+    : param bytes body: the whole request body
+    """
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI strings carry the bytes of the URL as latin-1
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1').lower(), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            environ[key] += ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        else:
+            environ[key] = value
+    # The body has already been read whole, also when it was sent in chunks without a length
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+class AsgiApp(object):
+    """
+    ASGI application serving a Flask app. Supports HTTP and lifespan scopes; on shutdown the worker threads
+    are stopped and the database connections closed.
+    """
+    def __init__(self, app, max_threads=None):
+        """
+        : param Flask app: the app
+        : param int max_threads: the number of worker threads, ASGI_THREADS of the app configuration by default
+        """
+        self.app = app
+        if max_threads is None:
+            max_threads = app.config.get('ASGI_THREADS')
+        if max_threads is None:
+            # More threads would only wait for a free connection
+            max_threads = (app.config.get('DATABASE_POOL_SIZE', DEFAULT_POOL_OPTIONS['DATABASE_POOL_SIZE'])
+                + app.config.get('DATABASE_MAX_OVERFLOW', DEFAULT_POOL_OPTIONS['DATABASE_MAX_OVERFLOW']))
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='revmusic')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope: {}'.format(scope['type']))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Off the event loop, which the requests still being handled need for sending their responses
+                await asyncio.get_running_loop().run_in_executor(None, self.close)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        environ = _build_environ(scope, b''.join(chunks))
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(RESPONSE_QUEUE_SIZE)
+        dropped = threading.Event()
+        worker = loop.run_in_executor(self.executor, self._run, environ, loop, queue, dropped)
+        error = None
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                if error is None:
+                    try:
+                        await send(message)
+                    except Exception as e:
+                        # The client is gone: the rest of the response is dropped, so the worker thread can finish
+                        error = e
+        except asyncio.CancelledError:
+            # The server gave up on the request, e.g. when shutting down: the worker thread stops queuing the response
+            dropped.set()
+            while not queue.empty():
+                queue.get_nowait()
+            raise
+        await worker
+        if error is not None:
+            raise error
+
+    def _run(self, environ, loop, queue, dropped):
+        """
+        Handles a request in a worker thread, passing the ASGI messages of the response to the event loop
+        until the request is dropped. The last body chunk is held back, so a response that is not streamed
+        takes a single body message.
+        """
+        def put(message):
+            if not dropped.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        start = []
+        def start_response(status, headers, exc_info=None):
+            start[:] = [int(status.split(' ', 1)[0]), [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                pending = None
+                for chunk in result:
+                    if not chunk:
+                        continue
+                    if pending is None:
+                        put({'type': 'http.response.start', 'status': start[0], 'headers': start[1]})
+                    else:
+                        put({'type': 'http.response.body', 'body': pending, 'more_body': True})
+                    pending = chunk
+                if pending is None:
+                    put({'type': 'http.response.start', 'status': start[0], 'headers': start[1]})
+                put({'type': 'http.response.body', 'body': pending or b''})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            put(None)
+
+    def close(self):
+        """
+        Waits for the requests being handled, then closes the database connections.
+        Blocks, so it must not be called from the thread of the event loop while requests are handled
+        """
+        self.executor.shutdown(wait=True)
+        with self.app.app_context():
+            db.engine.dispose()
+
+
+def create_asgi_app(test_config=None):
+    """
+    Creates the app (see create_app) and returns it as an ASGI application
+    : param dict test_config: the configuration, as for create_app
+    """
+    return AsgiApp(create_app(test_config))
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import platform
+import datetime
+import click
+from urllib.parse import quote
+from sqlalchemy import event
+
+"""
+Benchmark harness. Every route of the API is driven through the Flask test client against databases filled with
+synthetic data (see populate_db.generate_data) of several sizes. The latency percentiles and the SQL statement counts
+of every route are written into a JSON file, which can be compared with an earlier run to catch regressions.
+"""
+
+
+def _percentile(values, p):
+    """
+    Returns the p:th percentile of the values with linear interpolation
+    : param list values: the measurements, sorted
+    : param float p: the percentile, 0-100
+    """
+    if len(values) == 1:
+        return values[0]
+    position = (len(values) - 1) * p / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+def _summary(samples):
+    """
+    Summarizes the (seconds, queries) samples of a route
+    """
+    times = sorted(seconds * 1000 for seconds, queries in samples)
+    queries = sorted(queries for seconds, queries in samples)
+    return {
+        'requests': len(samples),
+        'p50_ms': round(_percentile(times, 50), 3),
+        'p90_ms': round(_percentile(times, 90), 3),
+        'p99_ms': round(_percentile(times, 99), 3),
+        'max_ms': round(times[-1], 3),
+        'mean_ms': round(sum(times) / len(times), 3),
+        'queries': queries[len(queries) // 2],
+        'max_queries': queries[-1]
+    }
+
+# URL of a request standing for the location of the item created or updated by the previous request of the round
+LOCATION = object()
+
+def _scenario(rng, users, albums, reviews, i):
+    """
+    Returns the requests of one round as (route, method, url, json) tuples. Every route of the API is requested once,
+    and every method of it the API supports. The url is LOCATION for the requests to an item whose URL is only known
+    from the Location header of the previous response, e.g. a review the round added.
+    The entities created by the round are deleted by the same round, and the imported albums replace the ones imported
+    by the previous round, so the dataset size stays the same.
+    : param Random rng: random number generator choosing the existing entities to read
+    : param list users: existing usernames
+    : param list albums: existing album unique names
+    : param list reviews: existing (album unique name, review identifier) tuples
+    : param int i: the number of the round, makes the created names unique
+    """
+    user = quote(rng.choice(users))
+    album = quote(rng.choice(albums))
+    review_album, review = rng.choice(reviews)
+    new_user = 'bench_user_{}'.format(i)
+    new_album = 'bench_album_{}'.format(i)
+    user_json = {'username': new_user, 'email': new_user + '@example.com', 'password': 'a' * 64}
+    album_json = {'unique_name': new_album, 'title': 'Bench {}'.format(i), 'artist': 'Bench', 'release': '2001-04-25', 'duration': '00:44:35', 'genre': 'Noise'}
+    review_json = {'user': new_user, 'title': 'Bench', 'content': 'Benchmark review', 'star_rating': 3}
+    return [
+        ('entry point', 'GET', '/api/', None),
+        ('users', 'GET', '/api/users/', None),
+        ('user', 'GET', '/api/users/{}/'.format(user), None),
+        ('albums', 'GET', '/api/albums/', None),
+        ('albums by rating', 'GET', '/api/albums/?sortby=rating&min_reviews=5', None),
+        ('top albums', 'GET', '/api/albums/top?days=365', None),
+        ('trending albums', 'GET', '/api/albums/top?rankby=trending&days=30&genre=Rock', None),
+        ('album', 'GET', '/api/albums/{}/'.format(album), None),
+        ('reviews', 'GET', '/api/reviews/', None),
+        ('reviews nlatest', 'GET', '/api/reviews/?nlatest=20', None),
+        ('reviews page', 'GET', '/api/reviews/?page_size=20', None),
+        ('reviews by genre', 'GET', '/api/reviews/?filterby=genre&searchword=Metal&nlatest=20', None),
+        ('reviews by timeframe', 'GET', '/api/reviews/?timeframe=01012021_31012021', None),
+        ('reviews text search', 'GET', '/api/reviews/?filterby=text&searchword=masterpiece&nlatest=20', None),
+        ('reviews by album', 'GET', '/api/albums/{}/reviews/'.format(album), None),
+        ('reviews by user', 'GET', '/api/users/{}/reviews/'.format(user), None),
+        ('review', 'GET', '/api/albums/{}/reviews/{}/'.format(quote(review_album), review), None),
+        ('add user', 'POST', '/api/users/', user_json),
+        ('edit user', 'PUT', '/api/users/{}/'.format(new_user), user_json),
+        ('add album', 'POST', '/api/albums/', album_json),
+        ('edit album', 'PUT', '/api/albums/{}/'.format(new_album), album_json),
+        ('add review', 'POST', '/api/albums/{}/reviews/'.format(new_album), review_json),
+        # Editing a review gives it a new identifier, and so a new location
+        ('edit review', 'PUT', LOCATION, dict(review_json, star_rating=4)),
+        ('delete review', 'DELETE', LOCATION, None),
+        ('add reviews', 'POST', '/api/reviews/bulk', [dict(review_json, album=name) for name in rng.sample(albums, min(10, len(albums)))]),
+        ('import albums', 'POST', '/api/albums/bulk', [dict(album_json, unique_name='bench_import_{}'.format(j), title='Bench import {}'.format(j)) for j in range(10)]),
+        ('delete album', 'DELETE', '/api/albums/{}/'.format(new_album), None),
+        ('delete user', 'DELETE', '/api/users/{}/'.format(new_user), None)
+    ]
+
+def run_benchmark(scale, rounds, seed=0):
+    """
+    Benchmarks every route of the API against a new database with synthetic data. Returns the summaries of the routes
+    : param int scale: the scale of the synthetic data (number of users)
+    : param int rounds: the number of times every route is requested
+    : param int seed: seed of the synthetic data and of the requests
+    """
+    from revmusic import create_app, db
+    from revmusic.models import User, Album, Review
+    from revmusic.populate_db import generate_data
+
+    db_fd, db_fname = tempfile.mkstemp(suffix='.db')
+    try:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_fname,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False
+        })
+        with app.app_context():
+            db.create_all()
+            generate_data(scale, seed)
+            users = [row[0] for row in db.session.query(User.username)]
+            albums = [row[0] for row in db.session.query(Album.unique_name)]
+            reviews = db.session.query(Album.unique_name, Review.identifier).join(Review.album).all()
+            engine = db.engine
+
+        queries = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            queries.append(1)
+        event.listen(engine, 'before_cursor_execute', count_statement)
+
+        client = app.test_client()
+        rng = random.Random(seed)
+        samples = {}
+        for i in range(rounds):
+            location = None
+            for route, method, url, body in _scenario(rng, users, albums, reviews, i):
+                if url is LOCATION:
+                    url = location
+                queries.clear()
+                start = time.perf_counter()
+                resp = client.open(url, method=method, json=body)
+                data = resp.data
+                seconds = time.perf_counter() - start
+                if resp.status_code >= 400:
+                    raise RuntimeError('{} {} failed with {}: {}'.format(method, url, resp.status_code, data[:200]))
+                location = resp.headers.get('Location')
+                samples.setdefault(route, []).append((seconds, len(queries)))
+        event.remove(engine, 'before_cursor_execute', count_statement)
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        return {route: _summary(route_samples) for route, route_samples in samples.items()}
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+def compare_results(baseline, results, tolerance=0.2):
+    """
+    Compares benchmark results with a baseline. Returns a message for every route that got slower (median latency grew
+    more than the tolerance) or that executes more SQL statements than in the baseline
+    : param dict baseline: earlier results, as written by the benchmark command
+    : param dict results: the new results
+    : param float tolerance: the allowed relative growth of the median latency
+    """
+    messages = []
+    for scale, routes in results['scales'].items():
+        for route, summary in routes.items():
+            old = baseline.get('scales', {}).get(scale, {}).get(route)
+            if old is None:
+                continue
+            if summary['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+                messages.append('scale {}, {}: median {:.2f} ms, was {:.2f} ms'.format(scale, route, summary['p50_ms'], old['p50_ms']))
+            if summary['queries'] > old['queries']:
+                messages.append('scale {}, {}: {} SQL statements, was {}'.format(scale, route, summary['queries'], old['queries']))
+    return messages
+
+
+@click.command(name="benchmark", help="Benchmarks every route of the API against synthetic databases of several sizes")
+@click.option("--scales", default="100,1000", help="Comma separated dataset sizes (number of users)")
+@click.option("--rounds", default=20, help="Number of times every route is requested per dataset size")
+@click.option("--seed", default=0, help="Seed of the synthetic data and of the requests")
+@click.option("--output", default="benchmark.json", type=click.Path(dir_okay=False), help="File the results are written to")
+@click.option("--baseline", default=None, type=click.Path(exists=True, dir_okay=False), help="Earlier results to compare with")
+@click.option("--tolerance", default=0.2, help="Allowed relative growth of the median latency when comparing with the baseline")
+def benchmark_cmd(scales, rounds, seed, output, baseline, tolerance):
+    """
+    Runs the benchmarks and writes the results into a JSON file.
+    This function is called from the command line with "$ flask benchmark"
+    If a baseline is given and a route regressed, the command exits with status 1.
+    """
+    results = {
+        'created': datetime.datetime.utcnow().isoformat(' ', 'seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'rounds': rounds,
+        'seed': seed,
+        'scales': {}
+    }
+    for scale in [int(scale) for scale in scales.split(',')]:
+        print("Benchmarking with scale {}...".format(scale))
+        routes = results['scales'][str(scale)] = run_benchmark(scale, rounds, seed)
+        for route, summary in routes.items():
+            print("  {:<22} p50 {:>9.2f} ms  p90 {:>9.2f} ms  p99 {:>9.2f} ms  {:>3} queries".format(
+                route, summary['p50_ms'], summary['p90_ms'], summary['p99_ms'], summary['queries']))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {}".format(output))
+
+    if baseline is not None:
+        with open(baseline) as f:
+            messages = compare_results(json.load(f), results, tolerance)
+        for message in messages:
+            print("Regression: " + message)
+        if messages:
+            raise SystemExit(1)
+        print("No regressions compared to {}".format(baseline))
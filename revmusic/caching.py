@@ -0,0 +1,332 @@
+import os
+import json
+import uuid
+import hashlib
+import datetime
+import threading
+import collections
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Response, request, current_app, g
+
+from revmusic.models import DataVersion
+from revmusic.constants import NDJSON
+from revmusic.mason import wants_stream
+
+
+def _to_utc(dt):
+    """
+    Returns the datetime as timezone aware UTC datetime. Naive datetimes are assumed to be in UTC
+    : param datetime dt: the datetime
+    """
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.astimezone(datetime.timezone.utc)
+
+def source_version():
+    """
+    Returns a hash of the source code of the app. The representations are produced by the code, so it changes whenever
+    they may change, e.g. when a control or a field is added, and the same in every process of a deployment
+    """
+    digest = hashlib.sha1()
+    package = os.path.dirname(os.path.abspath(__file__))
+    for root, dirs, files in os.walk(package):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.py'):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, package).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+def get_validators(tables, daily=False):
+    """
+    Computes the cache validators of the current request from the change counters of the given tables,
+    without touching the data itself. Returns a tuple (etag, last_modified); last_modified is None if no tables are given.
+    The ETag is strong: it changes whenever the URL, the representation negotiated with the Accept header (Mason or NDJSON,
+    see mason.wants_stream), the version of the representations (REPRESENTATION_VERSION, see init_cache)
+    or any of the tables change. Both are None if the database
+    has no change counters for the tables (see models.create_data_versions).
+    : param list tables: names of the tables the response depends on, e.g. ['album']
+    : param bool daily: whether the response also depends on the current date, e.g. covers the last 7 days
+    """
+    versions = []
+    if tables:
+        versions = DataVersion.query.filter(DataVersion.name.in_(tables)).order_by(DataVersion.name).all()
+        if len(versions) < len(set(tables)):
+            return (None, None)
+    key = current_app.config['REPRESENTATION_VERSION'] + request.full_path + ''.join(';{}={}'.format(version.name, version.version) for version in versions)
+    if wants_stream() == NDJSON:
+        key += ';ndjson'
+    if daily:
+        key += ';' + datetime.date.today().isoformat()
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    last_modified = None
+    if versions:
+        last_modified = datetime.datetime.fromtimestamp(int(max(version.modified for version in versions)), datetime.timezone.utc)
+        if daily:
+            # The local midnight the current date began
+            midnight = datetime.datetime.combine(datetime.date.today(), datetime.time.min).astimezone(datetime.timezone.utc)
+            last_modified = max(last_modified, midnight)
+    return (etag, last_modified)
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks the conditional headers of the current request. If-None-Match takes precedence over If-Modified-Since,
+    as the ETag also catches changes made within the same second.
+    : param str etag: the current ETag
+    : param datetime last_modified: the current modification time or None
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= _to_utc(request.if_modified_since)
+    return False
+
+def _set_validators(response, etag, last_modified):
+    """
+    Adds the validators to the response. Clients may store the response but must revalidate it before using it again.
+    As the ETag depends on the Accept header, so does a 304 response
+    """
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def conditional(*tables, daily=False):
+    """
+    Decorator for GET handlers. Adds ETag and Last-Modified headers to successful responses, and answers
+    a conditional request (If-None-Match / If-Modified-Since) with 304 Not Modified without calling the handler,
+    when none of the given tables have changed.
+    : param str tables: names of the tables the response depends on
+    : param bool daily: whether the response also changes when the date changes
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = get_validators(tables, daily)
+            if etag is None:
+                return func(*args, **kwargs)
+            if is_not_modified(etag, last_modified):
+                return _set_validators(Response(status=304), etag, last_modified)
+            response = func(*args, **kwargs)
+            if response.status_code == 200:
+                _set_validators(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
+
+
+class LRUCache(object):
+    """
+    In-process response cache holding at most maxsize entries; the least recently used entry is dropped first.
+    Every entry stores the version of each of its tags at the time its response was computed, and invalidating a tag
+    bumps the tag's version, so stale entries are never returned. Suits single-process deployments only,
+    as the invalidations done by one process are not seen by the others.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.tag_versions = {}
+        self.lock = threading.Lock()
+
+    def versions(self, tags):
+        with self.lock:
+            return {tag: self.tag_versions.get(tag, 0) for tag in tags}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, versions = entry
+            if any(self.tag_versions.get(tag, 0) != version for tag, version in versions.items()):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, versions):
+        with self.lock:
+            self.entries[key] = (value, versions)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.tag_versions[tag] = self.tag_versions.get(tag, 0) + 1
+
+
+class FileCache(object):
+    """
+    Response cache shared by all processes of a host through a directory, e.g. one under /dev/shm for a memory backed cache.
+    Works like LRUCache, but the entries and the tag versions are files. A tag version is a random token rewritten on invalidation,
+    so concurrent invalidations by different processes can't cancel each other out. Files are replaced atomically.
+    Reading an entry updates its modification time, and the entries least recently used are removed when there are more than maxsize.
+    """
+    def __init__(self, directory, maxsize=1024):
+        self.maxsize = maxsize
+        self.entry_dir = os.path.join(directory, 'entries')
+        self.tag_dir = os.path.join(directory, 'tags')
+        os.makedirs(self.entry_dir, exist_ok=True)
+        os.makedirs(self.tag_dir, exist_ok=True)
+
+    @staticmethod
+    def _name(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _write(path, data):
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _version(self, tag):
+        try:
+            with open(os.path.join(self.tag_dir, self._name(tag)), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def versions(self, tags):
+        return {tag: self._version(tag) for tag in tags}
+
+    def get(self, key):
+        path = os.path.join(self.entry_dir, self._name(key))
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if any(self._version(tag) != version for tag, version in entry['versions'].items()):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        status, headers, body = entry['value']
+        return (status, [tuple(header) for header in headers], body.encode('latin-1'))
+
+    def set(self, key, value, versions):
+        status, headers, body = value
+        entry = {'value': [status, headers, body.decode('latin-1')], 'versions': versions}
+        self._write(os.path.join(self.entry_dir, self._name(key)), json.dumps(entry))
+        self._prune()
+
+    def _prune(self):
+        """
+        Removes the least recently used entries above maxsize. Entries being written (temporary files) are not counted
+        """
+        entries = []
+        for entry in os.scandir(self.entry_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime_ns, entry.path))
+            except FileNotFoundError:
+                pass
+        if len(entries) <= self.maxsize:
+            return
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.maxsize]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, tags):
+        for tag in tags:
+            self._write(os.path.join(self.tag_dir, self._name(tag)), uuid.uuid4().hex)
+
+
+def init_cache(app):
+    """
+    Creates the response cache of the app according to its configuration:
+    - REPRESENTATION_VERSION: the version of the representations, part of the ETags and the cache keys so that responses
+      of an earlier deployment are never used. A hash of the source code by default (see source_version)
+    - RESPONSE_CACHE: None (default, no caching), 'lru' or 'file'
+    - RESPONSE_CACHE_SIZE: the maximum number of entries of the cache, 1024 by default
+    - RESPONSE_CACHE_DIR: the directory of the 'file' cache
+    : param Flask app: the app
+    """
+    if app.config.get('REPRESENTATION_VERSION') is None:
+        app.config['REPRESENTATION_VERSION'] = source_version()
+    backend = app.config.get('RESPONSE_CACHE')
+    if backend == 'lru':
+        app.extensions['response_cache'] = LRUCache(app.config.get('RESPONSE_CACHE_SIZE', 1024))
+    elif backend == 'file':
+        app.extensions['response_cache'] = FileCache(app.config['RESPONSE_CACHE_DIR'], app.config.get('RESPONSE_CACHE_SIZE', 1024))
+    elif backend is not None:
+        raise ValueError('Unknown response cache: {}'.format(backend))
+    else:
+        app.extensions.pop('response_cache', None)
+
+def _cache_key(daily=False):
+    """
+    Returns the cache key of the current request: the version of the representations, the path, the query parameters
+    sorted and the accepted media types, and the current date for responses depending on it
+    """
+    args = sorted((key, value) for key in request.args for value in request.args.getlist(key))
+    key = '{}:{}?{}#{}'.format(current_app.config['REPRESENTATION_VERSION'], request.path, urlencode(args), request.headers.get('Accept', ''))
+    if daily:
+        key += '@' + datetime.date.today().isoformat()
+    return key
+
+def add_cache_tags(*tags):
+    """
+    Adds dependency tags to the response being computed, for dependencies not known from the URL alone
+    : param str tags: the tags, e.g. 'user:admin'
+    """
+    if 'cache_tags' in g:
+        g.cache_tags.extend(tags)
+
+def invalidate(*tags):
+    """
+    Invalidates the cached responses depending on any of the given tags. Called by the write handlers after committing.
+    The tag '*' is given to every cached response, so invalidating it clears the whole cache.
+    : param str tags: the tags, e.g. 'album:rota'
+    """
+    cache = current_app.extensions.get('response_cache')
+    if cache is not None:
+        cache.invalidate(tags)
+
+def cached(*tags, daily=False):
+    """
+    Decorator for GET handlers. Serves the response from the response cache of the app when possible,
+    and stores successful responses in it. The tags name what the response depends on; they are formatted
+    with the URL parameters of the request, e.g. 'user:{user}'.
+    : param str tags: the dependency tags
+    : param bool daily: whether the response also changes when the date changes
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            if cache is None:
+                return func(*args, **kwargs)
+            key = _cache_key(daily)
+            value = cache.get(key)
+            if value is not None:
+                status, headers, body = value
+                return Response(body, status, headers)
+            g.cache_tags = ['*'] + [tag.format(**kwargs) for tag in tags]
+            # The versions are read before computing the response, so a write happening meanwhile makes the entry stale
+            versions = cache.versions(g.cache_tags)
+            response = func(*args, **kwargs)
+            versions.update((tag, version) for tag, version in cache.versions(g.cache_tags).items() if tag not in versions)
+            # A response read from a lagging replica (see replicas.py) could stay in the cache after the write it missed
+            if response.status_code == 200 and not response.is_streamed and g.get('read_engine') is None:
+                cache.set(key, (response.status_code, list(response.headers.items()), response.get_data()), versions)
+            return response
+        return wrapper
+    return decorator
@@ -1,4 +1,6 @@
 MASON = 'application/vnd.mason+json'
+NDJSON = 'application/x-ndjson'
+CSV = 'text/csv'
 LINK_RELATIONS_URL = '/revmusic/link-relations/'
 APIARY_URL = "https://revmusic.docs.apiary.io/#reference/"
 
@@ -8,14 +10,29 @@ REVIEW_PROFILE = '/profiles/review/'
 TAG_PROFILE = '/profiles/tag/'
 ERROR_PROFILE = '/profiles/error/'
 
+# The maximum number of rows accepted by a single bulk request
+MAX_BULK_ROWS = 10000
+# The mean rating of all albums counts as this many reviews in the Bayesian average rating of an album
+RANKING_PRIOR_REVIEWS = 10
+# The default time window (in days) of the trending albums, and the number of albums in a ranking
+TRENDING_DAYS = 7
+TOP_ALBUMS = 10
+MAX_TOP_ALBUMS = 100
+# The longest time window (in days) of a ranking, a century
+MAX_TOP_DAYS = 36500
+# The number of rows fetched from the database at a time when a collection is streamed
+STREAM_BATCH_ROWS = 500
+# The minimum size of a chunk written to the client when a collection is streamed
+STREAM_CHUNK_BYTES = 64 * 1024
+
 REVIEW_ALL_SCHEMA = {
     "type": "object",
     "properties": {
         "filterby": {
-            "description": "Selects the feature on which the filtering of the returned reviews should be based",
+            "description": "Selects the feature on which the filtering of the returned reviews should be based. With 'text' the search word is looked up from the titles and contents of the reviews and the title, artist and genre of their albums, and the reviews are returned best match first unless page_size is provided",
             "type": "string",
             "default": "album",
-            "enum": ["album", "artist", "genre", "user"]
+            "enum": ["album", "artist", "genre", "user", "text"]
         },
         "searchword" : {
             "description": "Define the search word used with the filterby feature",
@@ -26,8 +43,70 @@ REVIEW_ALL_SCHEMA = {
             "type": "string"
         },
         "nlatest" : {
-            "description": "Define the number how many latest reviews should be returned",
+            "description": "Define the number how many latest reviews should be returned. Ignored if page_size is provided",
             "type": "integer"
+        },
+        "page_size" : {
+            "description": "Define the number of reviews returned per page. The other pages can be accessed with the next and prev controls",
+            "type": "integer",
+            "minimum": 1
+        }
+    },
+    "required": []
+}
+
+ALBUM_ALL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sortby": {
+            "description": "Selects the order of the returned albums. With 'rating' the best rated albums come first, and albums without reviews last. With 'reviews' the most reviewed albums come first",
+            "type": "string",
+            "enum": ["rating", "reviews"]
+        },
+        "min_rating": {
+            "description": "Return only albums whose average star rating is at least this",
+            "type": "number",
+            "minimum": 1,
+            "maximum": 5
+        },
+        "min_reviews": {
+            "description": "Return only albums with at least this many reviews",
+            "type": "integer",
+            "minimum": 0
+        }
+    },
+    "required": []
+}
+
+ALBUM_TOP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "rankby": {
+            "description": "Selects the ranking. With 'rating' the albums are ranked by their Bayesian average rating, i.e. the average pulled towards the mean of all albums when there are few reviews. With 'trending' they are ranked by the number of reviews per day within the time window",
+            "type": "string",
+            "default": "rating",
+            "enum": ["rating", "trending"]
+        },
+        "genre": {
+            "description": "Rank only albums of this genre",
+            "type": "string"
+        },
+        "artist": {
+            "description": "Rank only albums of this artist",
+            "type": "string"
+        },
+        "days": {
+            "description": "Count only the reviews submitted within this many last days, today included. Defaults to all reviews for 'rating' and to %d days for 'trending'" % TRENDING_DAYS,
+            "type": "integer",
+            "minimum": 1,
+            "maximum": MAX_TOP_DAYS
+        },
+        "limit": {
+            "description": "The number of albums returned",
+            "type": "integer",
+            "default": TOP_ALBUMS,
+            "minimum": 1,
+            "maximum": MAX_TOP_ALBUMS
         }
     },
     "required": []
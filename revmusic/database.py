@@ -0,0 +1,125 @@
+import os
+import weakref
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from revmusic import db
+
+"""
+Configuration of the database connections. The database is given with SQLALCHEMY_DATABASE_URI, or with the
+REVMUSIC_DATABASE_URI environment variable, e.g. postgresql://revmusic@dbhost/revmusic for a server shared by the workers
+of many hosts. Connections are pooled: every process keeps up to DATABASE_POOL_SIZE connections open and opens at most
+DATABASE_MAX_OVERFLOW more under load. Connections to a server are checked before use and replaced after
+DATABASE_POOL_RECYCLE seconds, so connections dropped by the server or a proxy are not handed out.
+The options can also be given directly with SQLALCHEMY_ENGINE_OPTIONS, which take precedence.
+
+For SQLite, every new connection is set up with the pragmas below,
+which can be overridden with SQLITE_PRAGMAS in the app configuration (a pragma set to None is left to SQLite's default).
+WAL journaling lets readers go on while a review is being written, and with it synchronous=NORMAL is still safe
+against corruption: only the last transactions before a power loss may be lost.
+"""
+
+DEFAULT_POOL_OPTIONS = {
+    'DATABASE_POOL_SIZE': 5,
+    'DATABASE_MAX_OVERFLOW': 10,
+    'DATABASE_POOL_RECYCLE': 1800,  # seconds
+    'DATABASE_POOL_TIMEOUT': 30     # seconds to wait for a free connection before failing
+}
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'foreign_keys': 'ON',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,        # milliseconds to wait for a lock before failing
+    'cache_size': -64000,        # negative values are in KiB, i.e. 64 MB of page cache
+    'mmap_size': 268435456,      # 256 MB of the database file read through memory mapping
+    'temp_store': 'MEMORY'
+}
+
+# Engines whose connections are already configured, with their SQLite pragmas
+_configured_engines = weakref.WeakKeyDictionary()
+
+
+def get_engine_options(config):
+    """
+    Returns the options the engine is created with: the pool settings of the configuration,
+    overridden by SQLALCHEMY_ENGINE_OPTIONS
+    : param dict config: the app configuration
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    settings = {name: config.get(name, default) for name, default in DEFAULT_POOL_OPTIONS.items()}
+    options = {}
+    if url.get_backend_name() != 'sqlite':
+        options = {
+            'pool_size': settings['DATABASE_POOL_SIZE'],
+            'max_overflow': settings['DATABASE_MAX_OVERFLOW'],
+            'pool_recycle': settings['DATABASE_POOL_RECYCLE'],
+            'pool_timeout': settings['DATABASE_POOL_TIMEOUT'],
+            'pool_pre_ping': True
+        }
+    elif url.database not in (None, '', ':memory:'):
+        # Flask-SQLAlchemy opens a new connection per request for SQLite files, which redoes the connection setup
+        # every time. A pooled connection is only used by one thread at a time, so it may move between threads
+        options = {
+            'poolclass': QueuePool,
+            'pool_size': settings['DATABASE_POOL_SIZE'],
+            'max_overflow': settings['DATABASE_MAX_OVERFLOW'],
+            'pool_timeout': settings['DATABASE_POOL_TIMEOUT'],
+            'connect_args': {'check_same_thread': False}
+        }
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    return options
+
+
+def get_sqlite_pragmas(config):
+    """
+    Returns the pragmas to set on new SQLite connections, in the order they are set
+    : param dict config: the app configuration
+    """
+    pragmas = dict(DEFAULT_SQLITE_PRAGMAS)
+    pragmas.update(config.get('SQLITE_PRAGMAS') or {})
+    return [(name, value) for name, value in pragmas.items() if value is not None]
+
+def configure_engine(engine, config):
+    """
+    Registers the connection setup of the engine. Does nothing if the engine has already been configured,
+    so the listeners are registered only once per engine however many apps use it.
+    : param Engine engine: the engine
+    : param dict config: the app configuration
+    """
+    if engine in _configured_engines:
+        return
+    _configured_engines[engine] = None
+
+    @event.listens_for(engine, 'connect')
+    def remember_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        # A connection opened before a fork is never used by the child process: it is dropped without closing it,
+        # as closing it would also close it for the parent, and the pool opens a new one
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError('Connection belongs to process {}'.format(connection_record.info['pid']))
+
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = _configured_engines[engine] = get_sqlite_pragmas(config)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+def init_database(app):
+    """
+    Creates the database engine of the app and configures its connections. Called from create_app
+    : param Flask app: the app
+    """
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app.config)
+    with app.app_context():
+        configure_engine(db.engine, app.config)
@@ -0,0 +1,159 @@
+import io
+import csv
+import json
+import time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text, bindparam
+from sqlalchemy.exc import IntegrityError
+from jsonschema import ValidationError
+
+from . import db
+from .schemas import validate
+from .utils import to_date, to_time
+
+# Inserts an album or, if the unique name is already in use, replaces the existing album's information.
+# Requires SQLite 3.24 or newer
+ALBUM_UPSERT = text("""
+    INSERT INTO album (unique_name, title, artist, publication_date, duration, genre)
+    VALUES (:unique_name, :title, :artist, :publication_date, :duration, :genre)
+    ON CONFLICT (unique_name) DO UPDATE SET
+        title = excluded.title,
+        artist = excluded.artist,
+        publication_date = excluded.publication_date,
+        duration = excluded.duration,
+        genre = excluded.genre
+""").bindparams(bindparam('publication_date', type_=db.Date), bindparam('duration', type_=db.Time))
+
+
+def read_album_rows(stream, fmt):
+    """
+    Reads album rows one by one from a CSV or NDJSON text stream, so that the whole file is never in memory.
+    CSV files must have a header row with the album fields (unique_name, title, artist, release, duration, genre);
+    empty CSV fields are treated as missing. An NDJSON line that is not valid JSON is yielded as None.
+    : param stream: text stream to read
+    : param str fmt: either 'csv' or 'ndjson'
+    """
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield {key: value for key, value in row.items() if key and value}
+    else:
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+def _album_values(row):
+    """
+    Validates an album row and converts it to column values. Raises ValueError with a human-readable message if the row is invalid
+    : param dict row: album in the same format as in the POST request of the album collection
+    """
+    try:
+        validate(row, 'album')
+    except ValidationError as e:
+        raise ValueError(e.message)
+    release = None
+    if 'release' in row:
+        release = to_date(row['release'])
+        if release is None:
+            raise ValueError('The release date you provided is an invalid date')
+    return {
+        'unique_name': row['unique_name'].lower(),
+        'title': row['title'],
+        'artist': row['artist'],
+        'publication_date': release,
+        'duration': to_time(row.get('duration')),
+        'genre': row.get('genre')
+    }
+
+def _begin():
+    """
+    Opens the transaction of the session on SQLite, where the sqlite3 module opens one only before a data modifying
+    statement. Without it the savepoint of a batch would be the outermost transaction, and releasing it would commit the batch
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite' and not connection.connection.in_transaction:
+        # Immediate, so that no other writer can get in between and fail the import with a busy database
+        connection.execute(text('BEGIN IMMEDIATE'))
+
+def _upsert_batch(batch, result):
+    """
+    Upserts a batch of album values with one executemany. If a row of the batch violates a constraint
+    (the same title and artist under another unique name), the batch is retried row by row to find the failing rows.
+    : param list batch: (index, values) tuples
+    : param dict result: the result of import_albums, updated in place
+    """
+    try:
+        with db.session.begin_nested():
+            db.session.execute(ALBUM_UPSERT, [values for index, values in batch])
+        result['imported'] += len(batch)
+        return
+    except IntegrityError:
+        pass
+    for index, values in batch:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(ALBUM_UPSERT, values)
+            result['imported'] += 1
+        except IntegrityError:
+            _add_failure(result, index, 'Album with title "{}" already exists with artist "{}"'.format(values['title'], values['artist']))
+
+def _add_failure(result, index, message, max_errors=100):
+    """
+    Records a failed row. Only the first max_errors failures are listed in detail to keep the memory use bounded
+    """
+    result['failed'] += 1
+    if len(result['errors']) < max_errors:
+        result['errors'].append({'index': index, 'message': message})
+
+def import_albums(rows, batch_size=1000):
+    """
+    Imports albums with upsert semantics: new unique names are inserted and existing ones are replaced.
+    The rows are consumed lazily and written in batches, so the memory use does not depend on the number of rows.
+    Everything is committed in one transaction at the end, so nothing is imported if the import fails partway. Returns a dictionary with the number of imported and failed rows,
+    the first errors, the elapsed time and the throughput.
+    : param rows: iterable of album rows, e.g. from read_album_rows
+    : param int batch_size: the number of rows written with one executemany
+    """
+    result = {'imported': 0, 'failed': 0, 'errors': []}
+    start = time.perf_counter()
+    _begin()
+    batch = []
+    for index, row in enumerate(rows):
+        try:
+            batch.append((index, _album_values(row)))
+        except ValueError as e:
+            _add_failure(result, index, str(e))
+        if len(batch) >= batch_size:
+            _upsert_batch(batch, result)
+            batch = []
+    if batch:
+        _upsert_batch(batch, result)
+    db.session.commit()
+    result['errors'].sort(key=lambda error: error['index'])
+    result['seconds'] = time.perf_counter() - start
+    result['rows_per_second'] = (result['imported'] + result['failed']) / result['seconds'] if result['seconds'] > 0 else 0.0
+    return result
+
+
+@click.command(name="import-albums", help="Imports albums from a CSV or NDJSON file, replacing albums with the same unique name")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default=None, help="File format, by default deduced from the file extension")
+@click.option("--batch-size", default=1000, help="Number of albums written at once")
+@with_appcontext
+def import_albums_cmd(path, fmt, batch_size):
+    """
+    Imports a catalog of albums into the database.
+    This function is called from the command line with "$ flask import-albums <path>"
+    """
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    with io.open(path, encoding='utf-8', newline='') as stream:
+        result = import_albums(read_album_rows(stream, fmt), batch_size)
+    for error in result['errors']:
+        print("Row {}: {}".format(error['index'], error['message']))
+    print("Imported {} albums, {} failed, in {:.2f} s ({:.0f} rows/s)".format(
+        result['imported'], result['failed'], result['seconds'], result['rows_per_second']))
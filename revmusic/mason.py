@@ -1,8 +1,64 @@
-from flask import Response, request, url_for
+from flask import Response, request, url_for, stream_with_context, current_app, g
+import re
 import json
+import time
+import datetime
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from revmusic.models import *
 from revmusic.constants import *
+from revmusic.schemas import get_schema, FrozenDict
+from revmusic.metrics import add_serialize_time
+
+def _default(obj):
+    """
+    Serializes the types the JSON encoders don't know: datetimes as 'YYYY-MM-DD HH:MM:SS', dates as 'YYYY-MM-DD'
+    and times as 'HH:MM:SS', i.e. in the same format as they are given to the API
+    """
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat(' ', 'seconds')
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    if isinstance(obj, datetime.time):
+        return obj.isoformat('seconds')
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+def _dumps_orjson(obj):
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+def _dumps_json(obj):
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Available serializers. Both produce the same bytes: compact UTF-8 JSON
+SERIALIZERS = {'json': _dumps_json}
+if orjson is not None:
+    SERIALIZERS['orjson'] = _dumps_orjson
+_serializer = SERIALIZERS.get('orjson', _dumps_json)
+
+def use_serializer(name):
+    """
+    Selects the serializer used by dumps. By default orjson is used if it is installed, and the standard library otherwise.
+    : param str name: 'orjson', 'json' or 'auto'
+    """
+    global _serializer
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in SERIALIZERS else 'json'
+    if name not in SERIALIZERS:
+        raise ValueError('JSON serializer "{}" is not available'.format(name))
+    _serializer = SERIALIZERS[name]
+
+def dumps(obj):
+    """
+    Serializes a Mason document (or any JSON compatible object, including datetimes, dates and times) to UTF-8 encoded bytes
+    : param obj: the document
+    """
+    start = time.perf_counter()
+    data = _serializer(obj)
+    add_serialize_time(time.perf_counter() - start)
+    return data
 
 class MasonBuilder(dict):
     """
@@ -69,9 +125,125 @@ def create_error_response(status_code, title, message=None):
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return Response(dumps(body), status_code, mimetype=MASON)
+
+def wants_stream():
+    """
+    Checks whether the client asked for a streamed collection: NDJSON in the Accept header, or the query parameter stream=true
+    """
+    if request.accept_mimetypes.best_match([MASON, NDJSON], default=MASON) == NDJSON:
+        return NDJSON
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return MASON
+    return None
+
+def _buffered(parts):
+    """
+    Joins small serialized parts into chunks of at least STREAM_CHUNK_BYTES bytes
+    """
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_BYTES:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+def create_collection_response(body, rows, make_item):
+    """
+    Creates the response of a collection: the body with its items under 'items'. Normally the whole document is built in memory.
+    If the client asks for a stream (see wants_stream), the rows are fetched from the database in batches and every item is
+    serialized as soon as it is built, so the memory use does not depend on the size of the collection. The streamed Mason document
+    is byte for byte the same as the normal one; with NDJSON only the items are sent, one per line.
+    : param MasonBuilder body: the collection document without its items
+    : param rows: the rows to list, a query or a list
+    : param function make_item: builds the item (MasonBuilder) of a row
+    """
+    mode = wants_stream()
+    if mode is None:
+        body['items'] = [make_item(row) for row in rows]
+        response = Response(dumps(body), 200, mimetype=MASON)
+        # The same URL is also available as NDJSON
+        response.vary.add('Accept')
+        return response
+
+    if hasattr(rows, 'yield_per'):
+        rows = rows.yield_per(STREAM_BATCH_ROWS)
+
+    def generate_ndjson():
+        for row in rows:
+            yield dumps(make_item(row)) + b'\n'
+
+    def generate_mason():
+        # The envelope is the document without items, with the items array spliced in as its last key
+        head = dumps(body)[:-1]
+        yield head + (b',' if body else b'') + b'"items":['
+        for index, row in enumerate(rows):
+            yield (b',' if index else b'') + dumps(make_item(row))
+        yield b']}'
+
+    generate = generate_ndjson if mode == NDJSON else generate_mason
+    response = Response(stream_with_context(_buffered(generate())), 200, mimetype=mode)
+    response.vary.add('Accept')
+    return response
+
+class UrlTemplate(object):
+    """
+    URL of an endpoint with its variables left open. The URL is built once with url_for, after which
+    filling in the variables is plain string concatenation. The values are quoted by the converters of the URL rule,
+    so the URLs are the same as the ones url_for builds.
+    """
+    def __init__(self, endpoint, *variables):
+        """
+        : param str endpoint: the endpoint, e.g. 'api.reviewitem'
+        : param str variables: the names of the variables of the URL rule, e.g. 'album', 'review'
+        """
+        url = url_for(endpoint, **{variable: '__{}__'.format(variable) for variable in variables})
+        rule = next(current_app.url_map.iter_rules(endpoint))
+        # Literal parts and variable names alternate, starting and ending with a literal part
+        self.parts = re.split('__({})__'.format('|'.join(variables)), url)
+        self.to_url = {variable: rule._converters[variable].to_url for variable in variables}
+
+    def __call__(self, **values):
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = self.to_url[parts[i]](values[parts[i]])
+        return ''.join(parts)
+
+# Profile controls are the same for every item, so all items share one immutable control
+PROFILE_CONTROLS = {
+    profile: FrozenDict(href=profile) for profile in (USER_PROFILE, ALBUM_PROFILE, REVIEW_PROFILE, TAG_PROFILE)
+}
 
 class RevMusicBuilder(MasonBuilder):
+    @staticmethod
+    def url_template(endpoint, *variables):
+        """
+        Returns the UrlTemplate of the endpoint. The templates are built once per request, as the URLs depend on the request's script root
+        : param str endpoint: the endpoint, e.g. 'api.reviewitem'
+        : param str variables: the names of the variables of the URL rule, e.g. 'album', 'review'
+        """
+        templates = g.setdefault('url_templates', {})
+        key = (endpoint,) + variables
+        if key not in templates:
+            templates[key] = UrlTemplate(endpoint, *variables)
+        return templates[key]
+
+    def add_item_controls(self, href, profile):
+        """
+        self and profile controls of a collection item. Same as adding them with add_control, but the profile control is shared
+        : param str href: URL of the item, e.g. from a UrlTemplate
+        : param str profile: the profile of the item, e.g. REVIEW_PROFILE
+        """
+        self['@controls'] = {
+            'self': {'href': href},
+            'profile': PROFILE_CONTROLS[profile]
+        }
+
     ###
     # USERS
     ###
@@ -96,7 +268,7 @@ class RevMusicBuilder(MasonBuilder):
             title='Add a new user',
             encoding='json',
             method='POST',
-            schema=User.get_schema()
+            schema=get_schema('user')
         )
 
     def add_control_edit_user(self, user):
@@ -109,7 +281,7 @@ class RevMusicBuilder(MasonBuilder):
             title='Edit this user',
             encoding='json',
             method='PUT',
-            schema=User.get_schema()
+            schema=get_schema('user')
         )
 
     def add_control_delete_user(self, user):
@@ -133,9 +305,24 @@ class RevMusicBuilder(MasonBuilder):
         """
         self.add_control(
             'revmusic:albums-all',
-            href=url_for('api.albumcollection'),
+            href=url_for('api.albumcollection') + '?{sortby,min_rating,min_reviews}',
             title='All albums',
-            method='GET'           
+            method='GET',
+            isHrefTemplate=True,
+            schema=ALBUM_ALL_SCHEMA
+        )
+
+    def add_control_albums_top(self):
+        """
+        revmusic:albums-top
+        """
+        self.add_control(
+            'revmusic:albums-top',
+            href=url_for('api.topalbums') + '?{rankby,genre,artist,days,limit}',
+            title='Top rated and trending albums',
+            method='GET',
+            isHrefTemplate=True,
+            schema=ALBUM_TOP_SCHEMA
         )
 
     def add_control_add_album(self):
@@ -148,7 +335,20 @@ class RevMusicBuilder(MasonBuilder):
             title='Add a new album',
             encoding='json',
             method='POST',
-            schema=Album.get_schema()
+            schema=get_schema('album')
+        )
+
+    def add_control_import_albums(self):
+        """
+        revmusic:import-albums
+        """
+        self.add_control(
+            'revmusic:import-albums',
+            href=url_for('api.albumbulk'),
+            title='Add or replace many albums at once, as a JSON array, NDJSON or CSV',
+            encoding='json',
+            method='POST',
+            schema={'type': 'array', 'items': get_schema('album')}
         )
 
     def add_control_edit_album(self, album):
@@ -161,7 +361,7 @@ class RevMusicBuilder(MasonBuilder):
             title='Edit this album',
             encoding='json',
             method='PUT',
-            schema=Album.get_schema()
+            schema=get_schema('album')
         )
         
     def add_control_delete_album(self, album):
@@ -185,13 +385,46 @@ class RevMusicBuilder(MasonBuilder):
         """
         self.add_control(
             ctrl,
-            href=url_for('api.reviewcollection') + '?{filterby,searchword,timeframe,nlatest}',
+            href=url_for('api.reviewcollection') + '?{filterby,searchword,timeframe,nlatest,page_size}',
             title='All reviews',
             method='GET',
             isHrefTemplate=True,
             schema=REVIEW_ALL_SCHEMA
         )
 
+    def add_control_add_reviews(self):
+        """
+        revmusic:add-reviews
+        """
+        self.add_control(
+            'revmusic:add-reviews',
+            href=url_for('api.reviewbulk'),
+            title='Add many new reviews at once, as a JSON array or NDJSON',
+            encoding='json',
+            method='POST',
+            schema={'type': 'array', 'items': get_schema('review-bulk')}
+        )
+
+    def add_control_reviews_page(self, ctrl, args, after=None, before=None):
+        """
+        next / prev
+        : param str ctrl: name of the control, either 'next' or 'prev'
+        : param dict args: the query parameters of the current page, kept in the link
+        : param str after: cursor of the last review on the current page (for 'next')
+        : param str before: cursor of the first review on the current page (for 'prev')
+        """
+        params = {key: value for key, value in args.items() if value is not None and key not in ('nlatest', 'after', 'before')}
+        if after is not None:
+            params['after'] = after
+        if before is not None:
+            params['before'] = before
+        self.add_control(
+            ctrl,
+            href=url_for('api.reviewcollection', **params),
+            title='Next page of reviews' if ctrl == 'next' else 'Previous page of reviews',
+            method='GET'
+        )
+
     def add_control_reviews_by(self, user, ctrl='revmusic:reviews-by'):
         """
         revmusic:reviews-by
@@ -222,7 +455,7 @@ class RevMusicBuilder(MasonBuilder):
             title='Add a new review for this album',
             encoding='json',
             method='POST',
-            schema=Review.get_schema()
+            schema=get_schema('review')
         )
         
     def add_control_edit_review(self, album, review):
@@ -235,7 +468,7 @@ class RevMusicBuilder(MasonBuilder):
             title='Edit this review',
             encoding='json',
             method='PUT',
-            schema=Review.get_schema()
+            schema=get_schema('review')
         )
         
     def add_control_delete_review(self, album, review):
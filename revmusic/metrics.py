@@ -0,0 +1,157 @@
+import time
+import threading
+from flask import Response, request, g, has_request_context
+from sqlalchemy import event
+
+from revmusic import db
+
+"""
+Optional per-request instrumentation, enabled with METRICS=True in the app configuration.
+For every request the number of SQL statements, the time spent in the database and in JSON serialization,
+the total time and the payload size are measured. They are sent back in the Server-Timing header and aggregated
+per endpoint; the aggregates are served from /api/_metrics in the Prometheus text format.
+The aggregates are kept per process, so with many worker processes each of them reports its own.
+"""
+
+# Upper bounds (in seconds) of the buckets of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats(object):
+    """
+    Measurements of the current request, kept in flask.g
+    """
+    __slots__ = ('start', 'queries', 'db_seconds', 'serialize_seconds')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+
+class Metrics(object):
+    """
+    Aggregated measurements per (endpoint, method, status). Updating them takes one lock per request.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def record(self, labels, stats, seconds, size):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {
+                    'requests': 0, 'seconds': 0.0, 'queries': 0, 'db_seconds': 0.0,
+                    'serialize_seconds': 0.0, 'bytes': 0, 'buckets': [0] * len(DURATION_BUCKETS)
+                }
+            series['requests'] += 1
+            series['seconds'] += seconds
+            series['queries'] += stats.queries
+            series['db_seconds'] += stats.db_seconds
+            series['serialize_seconds'] += stats.serialize_seconds
+            series['bytes'] += size
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    series['buckets'][i] += 1
+
+    def render(self):
+        """
+        Returns the aggregates in the Prometheus text exposition format
+        """
+        with self.lock:
+            series = {labels: dict(values, buckets=list(values['buckets'])) for labels, values in self.series.items()}
+        lines = []
+        def add(name, kind, help_text, key):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, values in sorted(series.items()):
+                lines.append('{}{{{}}} {}'.format(name, _labels(labels), values[key]))
+        add('revmusic_requests_total', 'counter', 'Number of handled requests', 'requests')
+        add('revmusic_db_queries_total', 'counter', 'Number of SQL statements executed', 'queries')
+        add('revmusic_db_seconds_total', 'counter', 'Time spent executing SQL statements', 'db_seconds')
+        add('revmusic_serialize_seconds_total', 'counter', 'Time spent serializing JSON documents', 'serialize_seconds')
+        add('revmusic_response_bytes_total', 'counter', 'Size of the response bodies, streamed responses excluded', 'bytes')
+        lines.append('# HELP revmusic_request_duration_seconds Time spent handling requests')
+        lines.append('# TYPE revmusic_request_duration_seconds histogram')
+        for labels, values in sorted(series.items()):
+            for bound, count in zip(DURATION_BUCKETS, values['buckets']):
+                lines.append('revmusic_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(_labels(labels), bound, count))
+            lines.append('revmusic_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(_labels(labels), values['requests']))
+            lines.append('revmusic_request_duration_seconds_sum{{{}}} {}'.format(_labels(labels), values['seconds']))
+            lines.append('revmusic_request_duration_seconds_count{{{}}} {}'.format(_labels(labels), values['requests']))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    endpoint, method, status = labels
+    return 'endpoint="{}",method="{}",status="{}"'.format(endpoint, method, status)
+
+def _current_stats():
+    """
+    Returns the RequestStats of the current request, or None if the request is not measured
+    """
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+def add_serialize_time(seconds):
+    """
+    Adds time spent in JSON serialization to the current request. Called by mason.dumps
+    : param float seconds: the time
+    """
+    stats = _current_stats()
+    if stats is not None:
+        stats.serialize_seconds += seconds
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # A connection executes one statement at a time. A statement that fails never reaches after_cursor_execute,
+    # so its start time is simply overwritten by the next one
+    conn.info['query_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('query_start', None)
+    stats = _current_stats()
+    if stats is not None and start is not None:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - start
+
+def _start_request():
+    g.request_stats = RequestStats()
+
+def _finish_request(metrics, response):
+    """
+    Adds the Server-Timing header to the response and records the request in the aggregates
+    """
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    seconds = time.perf_counter() - stats.start
+    response.headers['Server-Timing'] = 'db;dur={:.3f};desc="{} queries", serialize;dur={:.3f}, total;dur={:.3f}'.format(
+        stats.db_seconds * 1000, stats.queries, stats.serialize_seconds * 1000, seconds * 1000)
+    size = 0 if response.is_streamed else response.calculate_content_length() or 0
+    endpoint = request.url_rule.endpoint if request.url_rule is not None else 'none'
+    metrics.record((endpoint, request.method, response.status_code), stats, seconds, size)
+    return response
+
+def init_metrics(app):
+    """
+    Enables the instrumentation for the app if METRICS is set in its configuration
+    : param Flask app: the app
+    """
+    if not app.config.get('METRICS'):
+        return
+    metrics = app.extensions['metrics'] = Metrics()
+    with app.app_context():
+        engine = db.engine
+    # The reads of GET requests may go to the read replicas (see replicas.init_replicas, called before this)
+    for engine in [engine] + app.extensions.get('replicas', []):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(lambda response: _finish_request(metrics, response))
+
+    @app.route('/api/_metrics', methods=['GET'])
+    def send_metrics():
+        return Response(metrics.render(), 200, mimetype='text/plain; version=0.0.4')
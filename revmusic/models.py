@@ -1,10 +1,11 @@
-import os
 import click
 from flask import Flask
 from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from sqlalchemy import event, inspect, table, column, literal_column, false, func, and_, or_, text
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.exc import IntegrityError, OperationalError
 
 # The database is required here. Defined in __init__.py
@@ -18,8 +19,10 @@ class User(db.Model):
     email = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String(64), nullable=False)
     
-    reviews = db.relationship("Review", cascade="all, delete-orphan", back_populates="user")
-    tags = db.relationship("Tag", cascade="all, delete-orphan", back_populates="user")
+    # With passive_deletes the children are left to the ondelete="CASCADE" of the foreign keys (here and below),
+    # so deleting a user, album or review never loads its reviews and tags
+    reviews = db.relationship("Review", cascade="all, delete-orphan", passive_deletes=True, back_populates="user")
+    tags = db.relationship("Tag", cascade="all, delete-orphan", passive_deletes=True, back_populates="user")
     
     #def __repr__(self):
     #    return "{} <{}>".format(self.username, self.id)
@@ -52,7 +55,10 @@ class User(db.Model):
 
 class Album(db.Model):
     
-    __table_args__ = (db.UniqueConstraint("title", "artist", name="_album_to_artist_uc"), )
+    __table_args__ = (
+        db.UniqueConstraint("title", "artist", name="_album_to_artist_uc"),
+        db.Index("ix_album_review_count", "review_count"),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     unique_name = db.Column(db.String(200), unique=True, nullable=False)
@@ -61,8 +67,36 @@ class Album(db.Model):
     publication_date = db.Column(db.Date, nullable=True)
     duration = db.Column(db.Time, nullable=True)
     genre = db.Column(db.String(50), nullable=True)
+    # Rating aggregates of the album's reviews, maintained by triggers (see ALBUM_RATING_DDL)
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_1 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_2 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_3 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_4 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_5 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     
-    reviews = db.relationship("Review", cascade="all, delete-orphan", back_populates="album")
+    reviews = db.relationship("Review", cascade="all, delete-orphan", passive_deletes=True, back_populates="album")
+
+    @hybrid_property
+    def average_rating(self):
+        """
+        The mean star rating of the album's reviews, None if the album has no reviews
+        """
+        if not self.review_count:
+            return None
+        return self.rating_sum / self.review_count
+
+    @average_rating.expression
+    def average_rating(cls):
+        return cls.rating_sum * 1.0 / func.nullif(cls.review_count, 0)
+
+    @property
+    def rating_histogram(self):
+        """
+        The number of reviews giving each number of stars, keyed by the number of stars
+        """
+        return {str(stars): getattr(self, "rating_{}".format(stars)) for stars in range(1, 6)}
 
     #def __repr__(self):
     #    return "{} <{}> by {}".format(self.title, self.id, self.artist)
@@ -108,10 +142,16 @@ class Album(db.Model):
 
 class Review(db.Model):
     
-    __table_args__ = (db.UniqueConstraint("user_id", "album_id", name="_user_to_albumreview_uc"), )
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "album_id", name="_user_to_albumreview_uc"),
+        # Indexes for listing reviews newest first, either all of them or by album or user
+        db.Index("ix_review_submission_date", "submission_date"),
+        db.Index("ix_review_album_submission_date", "album_id", "submission_date"),
+        db.Index("ix_review_user_submission_date", "user_id", "submission_date"),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    identifier = db.Column(db.String, unique=True, nullable=False)
+    identifier = db.Column(db.String(64), unique=True, nullable=False)
     user_id = db.Column(db.ForeignKey("user.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
     album_id = db.Column(db.ForeignKey("album.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
     title = db.Column(db.String(150), nullable=False)
@@ -121,7 +161,7 @@ class Review(db.Model):
     
     user = db.relationship("User", back_populates="reviews")
     album = db.relationship("Album", back_populates="reviews")
-    tags = db.relationship("Tag", cascade="all, delete-orphan", back_populates="review")
+    tags = db.relationship("Tag", cascade="all, delete-orphan", passive_deletes=True, back_populates="review")
 
     #def __repr__(self):
     #    return "{} <{}>".format(self.title, self.id)
@@ -155,12 +195,26 @@ class Review(db.Model):
         }
         return schema
 
+    @staticmethod
+    def get_bulk_schema():
+        schema = Review.get_schema()
+        schema['required'].append('album')
+        schema['properties']['album'] = {
+            'description': 'Unique name of the reviewed album',
+            'type': 'string'
+        }
+        return schema
+
 class Tag(db.Model):
     
-    __table_args__ = (db.UniqueConstraint("user_id", "review_id", name="_usertag_to_review_uc"), )
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "review_id", name="_usertag_to_review_uc"),
+        # Deleting a review deletes its tags through this index
+        db.Index("ix_tag_review_id", "review_id"),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    identifier = db.Column(db.String, unique=True, nullable=False)
+    identifier = db.Column(db.String(64), unique=True, nullable=False)
     user_id = db.Column(db.ForeignKey("user.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
     review_id = db.Column(db.ForeignKey("review.id", ondelete="CASCADE", onupdate="CASCADE"), nullable=False)
     meaning = db.Column(db.String(10), nullable=False, default="useful")
@@ -192,14 +246,324 @@ class Tag(db.Model):
     #    return schema
 
 
-@click.command(name="init-db", help="Calls create_all() on the database")
+class AlbumActivity(db.Model):
+    """
+    Reviews of an album submitted on one day: their number and the sum of their star ratings.
+    Maintained by triggers like the rating aggregates of the albums (see ALBUM_ACTIVITY_DDL), so that rankings
+    over a time window sum at most one row per album and day instead of reading the reviews.
+    """
+    # A time window is a range of the index, which covers the columns summed over it. No index starts with album_id,
+    # as SQLite would rather scan all the rows in the order of the album than group the rows of the window
+    __table_args__ = (db.Index("ix_album_activity_day", "day", "album_id", "review_count", "rating_sum"), )
+
+    day = db.Column(db.Date, primary_key=True)
+    album_id = db.Column(db.ForeignKey("album.id", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DataVersion(db.Model):
+    """
+    Change counter of a table. The version is incremented and the modification time (unix time) updated
+    by triggers on every insert, update and delete, so that the API can tell whether its data has changed
+    without reading the data itself.
+    """
+    name = db.Column(db.String(20), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.Float, nullable=False)
+
+
+# Tables whose changes are counted in DataVersion
+VERSIONED_TABLES = ["user", "album", "review"]
+
+DATA_VERSION_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS data_version_{table}_{op} AFTER {op} ON "{table}" BEGIN
+        UPDATE data_version SET version = version + 1, modified = (julianday('now') - 2440587.5) * 86400.0 WHERE name = '{table}';
+    END""".format(table=table, op=op) for table in VERSIONED_TABLES for op in ["INSERT", "UPDATE", "DELETE"]
+]
+
+# The same on PostgreSQL, with one statement level trigger per table
+POSTGRESQL_DATA_VERSION_DDL = [
+    """CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE data_version SET version = version + 1, modified = extract(epoch from clock_timestamp()) WHERE name = TG_TABLE_NAME;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql"""
+] + [
+    statement.format(table=table) for table in VERSIONED_TABLES for statement in [
+        'DROP TRIGGER IF EXISTS data_version_{table} ON "{table}"',
+        """CREATE TRIGGER data_version_{table} AFTER INSERT OR UPDATE OR DELETE ON "{table}"
+        FOR EACH STATEMENT EXECUTE PROCEDURE bump_data_version()"""
+    ]
+]
+
+def create_data_versions(connection):
+    """
+    Creates the change counters of the versioned tables and the triggers updating them, if they don't exist yet.
+    Only SQLite and PostgreSQL have the counters; on other databases the responses are sent without validators
+    : param Connection connection: the connection used for creating the counters
+    """
+    if connection.dialect.name == "sqlite":
+        for table in VERSIONED_TABLES:
+            connection.execute("""INSERT OR IGNORE INTO data_version (name, version, modified)
+                VALUES (?, 0, (julianday('now') - 2440587.5) * 86400.0)""", (table, ))
+        statements = DATA_VERSION_DDL
+    elif connection.dialect.name == "postgresql":
+        for table in VERSIONED_TABLES:
+            connection.execute(text("""INSERT INTO data_version (name, version, modified)
+                VALUES (:name, 0, extract(epoch from clock_timestamp())) ON CONFLICT (name) DO NOTHING"""), name=table)
+        statements = POSTGRESQL_DATA_VERSION_DDL
+    else:
+        return
+    for statement in statements:
+        connection.execute(statement)
+
+
+# Full-text search index for reviews (SQLite FTS5). The rowid of an index row is the id of the review,
+# and the album's title, artist and genre are copied next to the review's own text, so that one MATCH covers them all.
+# The index is kept in sync with the review and album tables by the triggers below.
+REVIEW_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS review_search USING fts5(title, content, album, artist, genre)""",
+    """CREATE TRIGGER IF NOT EXISTS review_search_insert AFTER INSERT ON review BEGIN
+        INSERT INTO review_search(rowid, title, content, album, artist, genre)
+        SELECT new.id, new.title, new.content, album.title, album.artist, album.genre FROM album WHERE album.id = new.album_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS review_search_update AFTER UPDATE ON review BEGIN
+        DELETE FROM review_search WHERE rowid = old.id;
+        INSERT INTO review_search(rowid, title, content, album, artist, genre)
+        SELECT new.id, new.title, new.content, album.title, album.artist, album.genre FROM album WHERE album.id = new.album_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS review_search_delete AFTER DELETE ON review BEGIN
+        DELETE FROM review_search WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS review_search_album_update AFTER UPDATE OF title, artist, genre ON album BEGIN
+        UPDATE review_search SET album = new.title, artist = new.artist, genre = new.genre
+        WHERE rowid IN (SELECT id FROM review WHERE album_id = new.id);
+    END"""
+]
+
+# Lightweight table construct for querying the index; the table itself is created with the DDL above
+review_search = table("review_search", column("rowid"), column("rank"))
+
+def create_review_search(connection):
+    """
+    Creates the review full-text search index and its triggers if they don't exist yet,
+    and fills the index with the reviews already in the database.
+    : param Connection connection: the connection used for creating the index
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'review_search'").first() is not None
+    for statement in REVIEW_SEARCH_DDL:
+        connection.execute(statement)
+    if not exists:
+        connection.execute("""INSERT INTO review_search(rowid, title, content, album, artist, genre)
+            SELECT review.id, review.title, review.content, album.title, album.artist, album.genre
+            FROM review JOIN album ON album.id = review.album_id""")
+
+def _rating_change(row, sign):
+    """
+    Returns the SET clause adding (sign "+") or removing (sign "-") the rating of a review row ("new" or "old")
+    to or from the rating aggregates of its album
+    """
+    changes = ["review_count = review_count {} 1".format(sign), "rating_sum = rating_sum {} {}.star_rating".format(sign, row)]
+    changes += ["rating_{stars} = rating_{stars} {sign} (CASE WHEN {row}.star_rating = {stars} THEN 1 ELSE 0 END)".format(
+        stars=stars, sign=sign, row=row) for stars in range(1, 6)]
+    return ", ".join(changes)
+
+# Triggers keeping the rating aggregates of the albums up to date. They run in the transaction changing the reviews,
+# so the aggregates are always consistent with them, also when reviews are inserted in bulk or deleted by cascade
+ALBUM_RATING_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS album_rating_insert AFTER INSERT ON review BEGIN
+        UPDATE album SET {} WHERE id = new.album_id;
+    END""".format(_rating_change("new", "+")),
+    """CREATE TRIGGER IF NOT EXISTS album_rating_update AFTER UPDATE OF star_rating, album_id ON review BEGIN
+        UPDATE album SET {} WHERE id = old.album_id;
+        UPDATE album SET {} WHERE id = new.album_id;
+    END""".format(_rating_change("old", "-"), _rating_change("new", "+")),
+    """CREATE TRIGGER IF NOT EXISTS album_rating_delete AFTER DELETE ON review BEGIN
+        UPDATE album SET {} WHERE id = old.album_id;
+    END""".format(_rating_change("old", "-"))
+]
+
+POSTGRESQL_ALBUM_RATING_DDL = [
+    """CREATE OR REPLACE FUNCTION update_album_rating() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE album SET {} WHERE id = old.album_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            UPDATE album SET {} WHERE id = new.album_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""".format(_rating_change("old", "-"), _rating_change("new", "+")),
+    "DROP TRIGGER IF EXISTS album_rating ON review",
+    """CREATE TRIGGER album_rating AFTER INSERT OR DELETE OR UPDATE OF star_rating, album_id ON review
+    FOR EACH ROW EXECUTE PROCEDURE update_album_rating()"""
+]
+
+# Recomputes the rating aggregates of every album from its reviews
+REFRESH_ALBUM_RATINGS = "UPDATE album SET review_count = (SELECT COUNT(*) FROM review WHERE review.album_id = album.id), " + \
+    "rating_sum = (SELECT COALESCE(SUM(star_rating), 0) FROM review WHERE review.album_id = album.id), " + \
+    ", ".join("rating_{stars} = (SELECT COUNT(*) FROM review WHERE review.album_id = album.id AND star_rating = {stars})".format(stars=stars)
+        for stars in range(1, 6))
+
+def _activity_change(row, sign):
+    """
+    Returns the statement adding (sign "+") or removing (sign "-") a review row ("new" or "old")
+    to or from the daily activity of its album
+    """
+    if sign == "+":
+        return """INSERT INTO album_activity (album_id, day, review_count, rating_sum)
+            VALUES ({row}.album_id, date({row}.submission_date), 1, {row}.star_rating)
+            ON CONFLICT (day, album_id) DO UPDATE SET review_count = album_activity.review_count + 1,
+            rating_sum = album_activity.rating_sum + excluded.rating_sum""".format(row=row)
+    return """UPDATE album_activity SET review_count = review_count - 1, rating_sum = rating_sum - {row}.star_rating
+            WHERE album_id = {row}.album_id AND day = date({row}.submission_date)""".format(row=row)
+
+# Triggers keeping the daily activity of the albums up to date
+ALBUM_ACTIVITY_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS album_activity_insert AFTER INSERT ON review BEGIN
+        {};
+    END""".format(_activity_change("new", "+")),
+    """CREATE TRIGGER IF NOT EXISTS album_activity_update AFTER UPDATE OF star_rating, album_id, submission_date ON review BEGIN
+        {};
+        {};
+    END""".format(_activity_change("old", "-"), _activity_change("new", "+")),
+    """CREATE TRIGGER IF NOT EXISTS album_activity_delete AFTER DELETE ON review BEGIN
+        {};
+    END""".format(_activity_change("old", "-"))
+]
+
+POSTGRESQL_ALBUM_ACTIVITY_DDL = [
+    """CREATE OR REPLACE FUNCTION update_album_activity() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            {};
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            {};
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""".format(_activity_change("old", "-"), _activity_change("new", "+")),
+    "DROP TRIGGER IF EXISTS album_activity ON review",
+    """CREATE TRIGGER album_activity AFTER INSERT OR DELETE OR UPDATE OF star_rating, album_id, submission_date ON review
+    FOR EACH ROW EXECUTE PROCEDURE update_album_activity()"""
+]
+
+# Recomputes the daily activity of every album from its reviews
+REFRESH_ALBUM_ACTIVITY = [
+    "DELETE FROM album_activity",
+    """INSERT INTO album_activity (album_id, day, review_count, rating_sum)
+        SELECT album_id, date(submission_date), COUNT(*), SUM(star_rating) FROM review GROUP BY album_id, date(submission_date)"""
+]
+
+def create_album_ratings(connection, refresh=False):
+    """
+    Creates the triggers maintaining the rating aggregates and the daily activity of the albums, if they don't exist yet.
+    Only SQLite and PostgreSQL have the triggers
+    : param Connection connection: the connection used for creating the triggers
+    : param bool refresh: whether to recompute the aggregates and the activity of the existing reviews
+    """
+    if connection.dialect.name == "sqlite":
+        statements = ALBUM_RATING_DDL + ALBUM_ACTIVITY_DDL
+    elif connection.dialect.name == "postgresql":
+        statements = POSTGRESQL_ALBUM_RATING_DDL + POSTGRESQL_ALBUM_ACTIVITY_DDL
+    else:
+        return
+    for statement in statements:
+        connection.execute(statement)
+    if refresh:
+        for statement in [REFRESH_ALBUM_RATINGS] + REFRESH_ALBUM_ACTIVITY:
+            connection.execute(statement)
+
+@event.listens_for(db.metadata, "after_create")
+def _create_triggers(target, connection, **kw):
+    create_review_search(connection)
+    create_data_versions(connection)
+    create_album_ratings(connection)
+
+@event.listens_for(db.metadata, "after_drop")
+def _drop_review_search(target, connection, **kw):
+    # The triggers are dropped along with their tables, but the index is a table of its own
+    if connection.dialect.name == "sqlite":
+        connection.execute("DROP TABLE IF EXISTS review_search")
+
+def match_reviews(searchword):
+    """
+    Returns a MATCH clause against the review full-text search index. Every word of the search word
+    must be found from the review or its album, and the last word can also be the beginning of a word.
+    : param str searchword: the search word(s) given by the user
+    """
+    words = ['"{}"'.format(word.replace('"', '""')) for word in searchword.split()]
+    if not words:
+        return false()
+    words[-1] += '*'
+    return literal_column("review_search").match(" ".join(words))
+
+def search_reviews(query, searchword):
+    """
+    Filters a review query with a full-text search. Returns the filtered query and the columns ordering the results
+    by relevance, best first. The search index exists only on SQLite; elsewhere every word must be found as a substring
+    of the review or its album, case insensitively, and no relevance order is given.
+    : param Query query: the review query, with the albums of the reviews joined (Review.album)
+    : param str searchword: the search word(s) given by the user
+    """
+    if db.engine.dialect.name == "sqlite":
+        return (query.join(review_search, review_search.c.rowid == Review.id).filter(match_reviews(searchword)), [review_search.c.rank])
+    words = searchword.lower().split()
+    if not words:
+        return (query.filter(false()), [])
+    columns = [Review.title, Review.content, Album.title, Album.artist, Album.genre]
+    query = query.filter(and_(*[
+        or_(*[func.lower(col).contains(word, autoescape=True) for col in columns]) for word in words
+    ]))
+    return (query, [])
+
+
+@click.command(name="init-db", help="Drops the tables of the database and calls create_all()")
 @with_appcontext
 def init_db_cmd():
     """
-    Creates the actual database with the above models.
+    Creates the actual database with the above models. Existing tables and their data are dropped first.
+    Works through the engine, so the database may as well be on a server.
     This function is called from the command line with "$ flask init-db"
     """
-    if os.path.exists("db/revmusic.db"):
-        os.remove("db/revmusic.db")
+    db.drop_all()
     db.create_all()
     print("Database created")
+
+
+@click.command(name="upgrade-db", help="Adds missing indexes and the search index to an existing database")
+@with_appcontext
+def upgrade_db_cmd():
+    """
+    Brings a database created with an older version of the models up to date without losing its data.
+    Tables missing from the database are created, and columns and indexes missing from existing tables are added.
+    The review full-text search index, the change counters and the album rating triggers are created,
+    if the database does not have them yet, and the album rating aggregates are recomputed.
+    This function is called from the command line with "$ flask upgrade-db"
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = set(col['name'] for col in inspector.get_columns(table.name))
+            for col in table.columns:
+                if col.name not in existing:
+                    connection.execute('ALTER TABLE "{}" ADD COLUMN {}'.format(table.name, CreateColumn(col).compile(dialect=connection.dialect)))
+                    print("Added column {}.{}".format(table.name, col.name))
+        create_review_search(connection)
+        create_data_versions(connection)
+        create_album_ratings(connection, refresh=True)
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                print("Created index {}".format(index.name))
+    print("Database upgraded")
@@ -1,22 +1,146 @@
+import time
+import random
+import datetime
+import itertools
 import click
 from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from sqlalchemy import event, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError, OperationalError
 
 from . import db
 from .models import User, Album, Review, Tag
-from .utils import to_date, to_time, to_datetime
+from .utils import to_date, to_time, to_datetime, create_identifier, chunks
+
+
+GENRES = ['Rock', 'Pop', 'Hip Hop', 'Jazz', 'Black Metal', 'Death Metal', 'Folk', 'Electronic', 'Classical', 'Nerdcore',
+    'Punk', 'Blues', 'Soul', 'Reggae', 'Country', 'Ambient']
+WORDS = ['good', 'bad', 'great', 'awful', 'album', 'song', 'riff', 'beat', 'voice', 'production', 'lyrics', 'classic', 'boring',
+    'heavy', 'catchy', 'raw', 'masterpiece', 'listen', 'again', 'never', 'best', 'worst', 'year', 'sound', 'guitar', 'drums', 'bass']
+# Relative frequencies of the star ratings 1-5; reviewers tend to rate what they like
+RATING_WEIGHTS = [5, 8, 17, 35, 35]
+
+
+def _words(rng, n):
+    return ' '.join(rng.choices(WORDS, k=n))
+
+def _next_id(model):
+    """
+    Returns the first free primary key of the model's table. The generated rows are given explicit keys, so that the rows
+    referring to them can be built without reading the keys back from the database
+    """
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def _insert(model, rows, batch_size=5000):
+    for chunk in chunks(rows, batch_size):
+        db.session.execute(model.__table__.insert(), chunk)
+
+def _sync_sequences(*models):
+    """
+    Moves the primary key sequences of the models' tables past the explicitly given keys. Only PostgreSQL
+    has sequences separate from the tables; SQLite and MySQL continue from the largest key by themselves
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in models:
+        db.session.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), (SELECT max(id) FROM \"{}\"))".format(model.__tablename__)),
+            {'table': '"{}"'.format(model.__tablename__)})
+
+def generate_data(scale, seed=0, now=None):
+    """
+    Adds synthetic data to the database with bulk inserts: scale users, scale // 2 albums, about 8 reviews per user
+    and about 0.3 tags per review. The distributions are skewed like in real data: a few users write most of the reviews
+    (Pareto distributed review counts), a few albums get most of them (Zipf distributed popularity),
+    high ratings are more common than low ones and the reviews are spread over the three years before now.
+    The same scale, seed and now always give the same data. Returns the number of added users, albums, reviews and tags.
+    : param int scale: the number of users
+    : param int seed: seed of the random number generator
+    : param datetime now: the end of the period of the reviews, the start of the current day by default
+    """
+    rng = random.Random(seed)
+    if now is None:
+        # Dated relative to today, so the time windows of the queries (e.g. the top albums of the last days) aren't empty
+        now = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    first_user, first_album, first_review, first_tag = _next_id(User), _next_id(Album), _next_id(Review), _next_id(Tag)
+
+    users = [{
+        'id': first_user + i,
+        'username': 'user_{}_{}'.format(seed, first_user + i),
+        'email': 'user_{}_{}@example.com'.format(seed, first_user + i),
+        'password': '{:064x}'.format(rng.getrandbits(256))
+    } for i in range(scale)]
+
+    albums = []
+    for i in range(max(1, scale // 2)):
+        album_id = first_album + i
+        albums.append({
+            'id': album_id,
+            'unique_name': 'album {} {}'.format(seed, album_id),
+            'title': '{} {}'.format(_words(rng, rng.randint(1, 4)).title(), album_id),
+            'artist': 'Artist {}'.format(rng.randint(1, max(1, scale // 5))),
+            'publication_date': datetime.date(rng.randint(1960, 2020), rng.randint(1, 12), rng.randint(1, 28)),
+            'duration': (datetime.datetime.min + datetime.timedelta(seconds=rng.randint(25 * 60, 80 * 60))).time(),
+            'genre': rng.choice(GENRES)
+        })
+
+    # Zipf distributed album popularity
+    album_weights = list(itertools.accumulate(1 / (rank + 1) ** 1.1 for rank in range(len(albums))))
+    reviews = []
+    for user in users:
+        count = min(len(albums), int(rng.paretovariate(1.2) * 2))
+        album_ids = set()
+        while len(album_ids) < count:
+            album_ids.update(album['id'] for album in rng.choices(albums, cum_weights=album_weights, k=count - len(album_ids)))
+        for album_id in album_ids:
+            reviews.append({
+                'id': first_review + len(reviews),
+                'identifier': create_identifier('review_')[0],
+                'user_id': user['id'],
+                'album_id': album_id,
+                'title': _words(rng, rng.randint(1, 6)).capitalize(),
+                'content': _words(rng, rng.randint(5, 80)).capitalize(),
+                'star_rating': rng.choices(range(1, 6), weights=RATING_WEIGHTS)[0],
+                'submission_date': now - datetime.timedelta(seconds=rng.randint(0, 3 * 365 * 24 * 3600))
+            })
+
+    tags = []
+    for review in reviews:
+        user_ids = set(rng.choice(users)['id'] for i in range(rng.choices([0, 1, 2], weights=[75, 20, 5])[0]))
+        for user_id in user_ids:
+            tags.append({
+                'id': first_tag + len(tags),
+                'identifier': create_identifier('tag_')[0],
+                'user_id': user_id,
+                'review_id': review['id'],
+                'meaning': rng.choice(['useful', 'useful', 'not useful']),
+                'date_created': review['submission_date'] + datetime.timedelta(seconds=rng.randint(60, 30 * 24 * 3600))
+            })
+
+    _insert(User, users)
+    _insert(Album, albums)
+    _insert(Review, reviews)
+    _insert(Tag, tags)
+    _sync_sequences(User, Album, Review, Tag)
+    db.session.commit()
+    return (len(users), len(albums), len(reviews), len(tags))
 
 
 # Useful link for viewing .db file contents: https://inloop.github.io/sqlite-viewer/
-@click.command(name="populate-db", help="Populates the database with hardcoded data")
+@click.command(name="populate-db", help="Populates the database with hardcoded data, or with synthetic data if --scale is given")
+@click.option("--scale", default=0, help="Number of synthetic users to generate, along with their albums, reviews and tags")
+@click.option("--seed", default=0, help="Seed of the synthetic data; data generated with different seeds can be added to the same database")
 @with_appcontext
-def populate_db_cmd():
+def populate_db_cmd(scale, seed):
     """
     Populates the database with example values
     """
+    if scale > 0:
+        print("Generating synthetic data...")
+        start = time.perf_counter()
+        users, albums, reviews, tags = generate_data(scale, seed)
+        print("Added {} users, {} albums, {} reviews and {} tags in {:.2f} s".format(users, albums, reviews, tags, time.perf_counter() - start))
+        return
     print("Populating the database...")
     user1 = User(username='admin', email='root@admin.com', password='9e81d8ab3b3bc5853467dc1fd8a8afcbde52ed71b7c170d8802a86ffa9e226a8')
     user2 = User(username='ytc fan', email='best_rapper@gmail.com', password='b4fdf2ea4fd3222ea3ca97ebf3835de15c7a27b704eca26317a8cf2dba925bc1')
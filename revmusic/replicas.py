@@ -0,0 +1,162 @@
+import random
+import sqlite3
+import click
+from flask import current_app, request, g, has_app_context
+from flask.cli import with_appcontext
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, exc, text
+from sqlalchemy.engine.url import make_url
+
+"""
+Read replicas. With SQLALCHEMY_REPLICA_URIS set in the app configuration, GET and HEAD requests are served from one of
+the given databases, chosen at random for every request, while all writes go to the primary database
+(SQLALCHEMY_DATABASE_URI). The replicas can be replicas of a database server, or copies of an SQLite database made with
+"$ flask snapshot-db"; SQLite replicas are opened read-only (query_only).
+
+Replicas may lag behind the primary. So that a client always sees its own writes, every successful write sets a cookie
+with the change counters of the primary (see models.create_data_versions). For REPLICA_STICKY_SECONDS (60 by default)
+the requests of the client are then served only by the replicas that have caught up with those counters, or by the
+primary if none has.
+"""
+
+# Cookie remembering the change counters after the latest write of the client
+STICKY_COOKIE = 'revmusic_written'
+# Pragmas set on the connections of SQLite replicas, on top of the ones of the primary
+REPLICA_SQLITE_PRAGMAS = {
+    'journal_mode': None,  # Decided by the copied database
+    'query_only': 'ON'
+}
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session reading from the replica chosen for the current request, if any, and writing to the primary
+    """
+    def get_bind(self, mapper=None, clause=None):
+        engine = g.get('read_engine') if has_app_context() else None
+        if engine is not None and not self._flushing:
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with sessions that can read from replicas
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _read_versions(connection):
+    """
+    Returns the change counters of a database as a dict
+    """
+    return dict(connection.execute(text('SELECT name, version FROM data_version')).fetchall())
+
+def _encode_versions(versions):
+    # Separated with characters that need no quoting in a cookie
+    return '.'.join('{}:{}'.format(name, version) for name, version in sorted(versions.items()))
+
+def _decode_versions(value):
+    """
+    Returns the change counters of a cookie as a dict; empty if the cookie is not valid
+    """
+    try:
+        return {name: int(version) for name, version in (item.split(':') for item in value.split('.') if item)}
+    except ValueError:
+        return {}
+
+def _has_caught_up(engine, versions):
+    """
+    Checks that the change counters of a replica are at least the given ones. A replica that can't be reached hasn't
+    """
+    try:
+        with engine.connect() as connection:
+            current = _read_versions(connection)
+    except exc.DBAPIError:
+        return False
+    return all(current.get(name, -1) >= version for name, version in versions.items())
+
+def _choose_replica():
+    """
+    Chooses the replica the current request reads from. Called before every request
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return
+    engines = current_app.extensions['replicas']
+    if STICKY_COOKIE not in request.cookies:
+        g.read_engine = random.choice(engines)
+        return
+    versions = _decode_versions(request.cookies[STICKY_COOKIE])
+    # Without change counters the writes can't be located, so they are read from the primary
+    g.read_engine = None
+    if versions:
+        g.read_engine = next((engine for engine in random.sample(engines, len(engines)) if _has_caught_up(engine, versions)), None)
+
+def _remember_write(response):
+    """
+    Sets the cookie with the change counters of the primary after a successful write. Called after every request
+    """
+    if request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400:
+        return response
+    from revmusic import db
+    try:
+        versions = _read_versions(db.session)
+    except exc.DBAPIError:
+        db.session.rollback()
+        versions = {}
+    response.set_cookie(STICKY_COOKIE, _encode_versions(versions), max_age=current_app.config.get('REPLICA_STICKY_SECONDS', 60),
+                        path='/api/', httponly=True, samesite='Lax')
+    return response
+
+def init_replicas(app):
+    """
+    Creates the engines of the replicas of the app, if SQLALCHEMY_REPLICA_URIS is set in its configuration.
+    Their engine options and pragmas are the same as the primary's, unless SQLALCHEMY_REPLICA_ENGINE_OPTIONS is given
+    : param Flask app: the app
+    """
+    from revmusic import db
+    from revmusic.database import get_engine_options, configure_engine
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    if not uris:
+        app.extensions.pop('replicas', None)
+        return
+    engines = app.extensions['replicas'] = []
+    for uri in uris:
+        config = dict(app.config, SQLALCHEMY_DATABASE_URI=uri,
+                      SQLALCHEMY_ENGINE_OPTIONS=app.config.get('SQLALCHEMY_REPLICA_ENGINE_OPTIONS'),
+                      SQLITE_PRAGMAS=dict(app.config.get('SQLITE_PRAGMAS') or {}, **REPLICA_SQLITE_PRAGMAS))
+        # Relative SQLite paths are resolved like the primary's
+        url, options = make_url(uri), {}
+        db.apply_driver_hacks(app, url, options)
+        options.update(get_engine_options(config))
+        engine = db.create_engine(url, options)
+        configure_engine(engine, config)
+        engines.append(engine)
+    app.before_request(_choose_replica)
+    app.after_request(_remember_write)
+
+
+@click.command(name="snapshot-db", help="Copies the SQLite database into the given files, e.g. to be used as read replicas")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(dir_okay=False))
+@with_appcontext
+def snapshot_db_cmd(paths):
+    """
+    Writes a consistent copy of the database into every given file, replacing its contents.
+    Readers of a file see either the previous copy or the new one.
+    This function is called from the command line with "$ flask snapshot-db PATH..."
+    """
+    from revmusic import db
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException("Only SQLite databases can be copied; use the replication of the database server instead")
+    source = db.engine.raw_connection()
+    try:
+        for path in paths:
+            target = sqlite3.connect(path)
+            try:
+                source.connection.backup(target)
+            finally:
+                target.close()
+            print("Snapshot written to {}".format(path))
+    finally:
+        source.close()
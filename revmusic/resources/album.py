@@ -1,40 +1,101 @@
 from revmusic import db
 from revmusic.utils import *
 from revmusic.constants import *
-from revmusic.models import User, Album, Review, Tag
-from revmusic.mason import create_error_response, RevMusicBuilder
-from flask_restful import Resource
+from revmusic.models import User, Album, Review, Tag, AlbumActivity
+from revmusic.mason import create_error_response, create_collection_response, dumps, RevMusicBuilder
+from revmusic.schemas import validate
+from revmusic.caching import conditional, cached, invalidate
+from revmusic.importer import read_album_rows, import_albums
+from flask_restful import Resource, reqparse
 from flask import Response, request, url_for
+from sqlalchemy import func, literal
 from sqlalchemy.exc import IntegrityError, StatementError
-import json
-from jsonschema import validate, ValidationError
+import io
+import datetime
+from jsonschema import ValidationError
+
+
+def _round_rating(rating):
+    """
+    Rounds an average rating for the representations; None stays None
+    """
+    return None if rating is None else round(rating, 2)
+
+
+def _conflict_response(error, unique_name, title, artist):
+    """
+    Returns the 409 error response of a write that failed with an IntegrityError,
+    naming the unique name or the title and artist that are already in use
+    : param IntegrityError error: the error raised on commit
+    : param str unique_name: the unique name of the written album
+    : param str title: the title of the written album
+    : param str artist: the artist of the written album
+    """
+    columns = unique_violation(error)
+    if columns == ('unique_name',):
+        return create_error_response(409, 'Already exists',
+        'Unique name "{}" is already in use'.format(unique_name))
+    if columns is not None and set(columns) == {'title', 'artist'}:
+        return create_error_response(409, 'Already exists',
+        'Album with title "{}" already exists with artist "{}"'.format(title, artist))
+    return create_error_response(409, 'Unexpected conflict',
+    'An unexpected conflict happened while committing to the database')
 
 
 class AlbumCollection(Resource):
+    def __init__(self):
+        """
+        This enables the optional query parameters for the GET request
+        """
+        self.parse = reqparse.RequestParser()
+        self.parse.add_argument('sortby', type=str, required=False, choices=('rating', 'reviews'))
+        self.parse.add_argument('min_rating', type=float, required=False)
+        self.parse.add_argument('min_reviews', type=int, required=False)
+
+    @conditional('album')
+    @cached('albums')
     def get(self):
         """
         Responds to GET request with a listing of all album items known to the API (JSON document with added hypermedia controls (MASON))
+        Query parameters in the request URL can be used to sort and filter the albums by their ratings; the rating aggregates
+        are stored in the album rows, so no reviews are read.
+        The listing is streamed as NDJSON or Mason if requested (see create_collection_response)
         """
         body = RevMusicBuilder()
         body.add_namespace('revmusic', LINK_RELATIONS_URL)
         body.add_control('self', url_for('api.albumcollection'))
         body.add_control_users_all()
         body.add_control_reviews_all()
+        body.add_control_albums_top()
         body.add_control_add_album()
+        body.add_control_import_albums()
+
+        # Error handling for min_rating and min_reviews is implemented by flask, since their types have been set
+        args = self.parse.parse_args()
+        albums_query = Album.query
+        if args['min_rating'] is not None:
+            albums_query = albums_query.filter(Album.average_rating >= args['min_rating'])
+        if args['min_reviews'] is not None:
+            albums_query = albums_query.filter(Album.review_count >= args['min_reviews'])
+        if args['sortby'] == 'rating':
+            albums_query = albums_query.order_by(Album.average_rating.desc().nullslast(), Album.review_count.desc(), Album.id)
+        elif args['sortby'] == 'reviews':
+            albums_query = albums_query.order_by(Album.review_count.desc(), Album.id)
 
-        body['items'] = []
-        for album in Album.query.all():
+        album_url = RevMusicBuilder.url_template('api.albumitem', 'album')
+        def make_item(album):
             item = RevMusicBuilder(
                 unique_name=album.unique_name,
                 title=album.title,
                 artist=album.artist,
-                genre=album.genre
+                genre=album.genre,
+                review_count=album.review_count,
+                average_rating=_round_rating(album.average_rating)
             )
-            item.add_control('self', url_for('api.albumitem', album=album.unique_name))
-            item.add_control('profile', ALBUM_PROFILE)
-            body['items'].append(item)
+            item.add_item_controls(album_url(album=album.unique_name), ALBUM_PROFILE)
+            return item
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_collection_response(body, albums_query, make_item)
 
     def post(self):
         """
@@ -45,7 +106,7 @@ class AlbumCollection(Resource):
         if not request.json:
             return create_error_response(415, 'Unsupported media type', 'Use JSON')
         try:
-            validate(request.json, Album.get_schema())
+            validate(request.json, 'album')
         except ValidationError as e:
             return create_error_response(400, 'Invalid JSON document', str(e))
         
@@ -71,12 +132,7 @@ class AlbumCollection(Resource):
         if 'genre' in request.json:
             genre = request.json['genre']
 
-        # Check that unique_name is not in use
-        if Album.query.filter_by(unique_name=unique_name).count() > 0:
-            return create_error_response(409, 'Already exists',
-            'Unique name "{}" is already in use'.format(unique_name))
-
-        # Create album entry and commit
+        # Create album entry and commit; the unique constraints tell if the unique name or the title and artist are in use
         album = Album(
             unique_name=unique_name,
             title=title,
@@ -88,16 +144,128 @@ class AlbumCollection(Resource):
         try:
             db.session.add(album)
             db.session.commit()
-        except IntegrityError:
+        except IntegrityError as e:
             db.session.rollback()
-            return create_error_response(409, 'Already exists',
-            'Album with title "{}" already exists with artist "{}"'.format(title, artist))
+            return _conflict_response(e, unique_name, title, artist)
+        invalidate('albums', 'album:' + unique_name)
 
         return Response(status=201, headers={
             'Location': url_for('api.albumitem', album=unique_name) # Location of the added item
         })
 
+class AlbumBulk(Resource):
+    def post(self):
+        """
+        Responds to POST request by importing many album items at once. The albums are sent as a JSON array, NDJSON or CSV
+        (with a header row). An album whose unique name is already in use replaces the existing album's information.
+        The response tells how many albums were imported, and lists an error for every album that could not be imported.
+        """
+        if request.mimetype == CSV:
+            rows = list(read_album_rows(io.StringIO(request.get_data(as_text=True)), 'csv'))
+        else:
+            rows = parse_bulk_rows(request)
+        if rows is None:
+            return create_error_response(415, 'Unsupported media type', 'Use a JSON array, NDJSON or CSV')
+        if len(rows) > MAX_BULK_ROWS:
+            return create_error_response(413, 'Too many albums', 'At most {} albums can be sent at once'.format(MAX_BULK_ROWS))
+
+        result = import_albums(rows)
+        invalidate('albums', 'album-names', *set(
+            'album:' + row['unique_name'].lower() for row in rows if isinstance(row, dict) and isinstance(row.get('unique_name'), str)
+        ))
+        body = RevMusicBuilder(imported=result['imported'], failed=result['failed'], errors=result['errors'])
+        body.add_namespace('revmusic', LINK_RELATIONS_URL)
+        body.add_control('self', url_for('api.albumbulk'))
+        body.add_control_albums_all()
+        return Response(dumps(body), 200, mimetype=MASON)
+
+class TopAlbums(Resource):
+    def __init__(self):
+        """
+        This enables the optional query parameters for the GET request
+        """
+        self.parse = reqparse.RequestParser()
+        self.parse.add_argument('rankby', type=str, required=False, default='rating', choices=('rating', 'trending'))
+        self.parse.add_argument('genre', type=str, required=False)
+        self.parse.add_argument('artist', type=str, required=False)
+        self.parse.add_argument('days', type=int, required=False)
+        self.parse.add_argument('limit', type=int, required=False, default=TOP_ALBUMS)
+
+    @conditional('album', daily=True)
+    @cached('albums', daily=True)
+    def get(self):
+        """
+        Responds to GET request with a ranking of the albums, best first (JSON document with added hypermedia controls (MASON))
+        With rankby=rating the score of an album is its Bayesian average rating, and with rankby=trending the number of its
+        reviews per day. The ranking is computed from the rating aggregates of the albums, or from their daily activity
+        when a time window is given; both are maintained by the database as reviews are written, so no reviews are read.
+        """
+        args = self.parse.parse_args()
+        days = args['days']
+        if days is None and args['rankby'] == 'trending':
+            days = TRENDING_DAYS
+        if days is not None and not 1 <= days <= MAX_TOP_DAYS:
+            return create_error_response(400, 'Invalid time window', 'The number of days must be between 1 and {}'.format(MAX_TOP_DAYS))
+        if not 1 <= args['limit'] <= MAX_TOP_ALBUMS:
+            return create_error_response(400, 'Invalid limit', 'The limit must be between 1 and {}'.format(MAX_TOP_ALBUMS))
+
+        body = RevMusicBuilder(rankby=args['rankby'], days=days)
+        body.add_namespace('revmusic', LINK_RELATIONS_URL)
+        body.add_control('self', url_for('api.topalbums'))
+        body.add_control_albums_all()
+        body.add_control_reviews_all()
+
+        if days is None:
+            review_count, rating_sum = Album.review_count, Album.rating_sum
+            albums_query = db.session.query(Album, review_count, rating_sum)
+            totals = db.session.query(func.sum(review_count), func.sum(rating_sum))
+        else:
+            # The window ends today and covers the given number of days
+            activity = db.session.query(
+                AlbumActivity.album_id,
+                func.sum(AlbumActivity.review_count).label('review_count'),
+                func.sum(AlbumActivity.rating_sum).label('rating_sum')
+            ).filter(AlbumActivity.day > datetime.date.today() - datetime.timedelta(days=days)).group_by(AlbumActivity.album_id).subquery()
+            review_count, rating_sum = activity.c.review_count, activity.c.rating_sum
+            albums_query = db.session.query(Album, review_count, rating_sum).join(activity, activity.c.album_id == Album.id)
+            totals = db.session.query(func.sum(review_count), func.sum(rating_sum))
+        albums_query = albums_query.filter(review_count > 0)
+        if args['genre']:
+            albums_query = albums_query.filter(func.lower(Album.genre) == args['genre'].lower())
+        if args['artist']:
+            albums_query = albums_query.filter(func.lower(Album.artist) == args['artist'].lower())
+
+        if args['rankby'] == 'rating':
+            # Every album starts with RANKING_PRIOR_REVIEWS reviews worth of the mean rating of all albums,
+            # so a single five star review does not top the albums with many good ones
+            total_count, total_sum = totals.one()
+            mean = total_sum / total_count if total_count else 0
+            score = (literal(mean * RANKING_PRIOR_REVIEWS) + rating_sum) / (literal(float(RANKING_PRIOR_REVIEWS)) + review_count)
+            albums_query = albums_query.add_columns(score).order_by(score.desc(), review_count.desc(), Album.id)
+        else:
+            score = review_count * 1.0 / days
+            albums_query = albums_query.add_columns(score).order_by(review_count.desc(), (rating_sum * 1.0 / review_count).desc(), Album.id)
+
+        album_url = RevMusicBuilder.url_template('api.albumitem', 'album')
+        def make_item(row):
+            album, count, total, album_score = row
+            item = RevMusicBuilder(
+                unique_name=album.unique_name,
+                title=album.title,
+                artist=album.artist,
+                genre=album.genre,
+                review_count=count,
+                average_rating=_round_rating(total / count),
+                score=round(album_score, 3)
+            )
+            item.add_item_controls(album_url(album=album.unique_name), ALBUM_PROFILE)
+            return item
+
+        return create_collection_response(body, albums_query.limit(args['limit']), make_item)
+
 class AlbumItem(Resource):
+    @conditional('album')
+    @cached('album:{album}', 'ratings:album:{album}', 'ratings')
     def get(self, album):
         """
         Responds to GET request with the information of the requested album item (JSON document with added hypermedia controls (MASON))
@@ -109,21 +277,17 @@ class AlbumItem(Resource):
         if not album_item:
             return create_error_response(404, 'Album not found')
         
-        # Handle optional data (date and time objects to string, if exists)
-        release = album_item.publication_date
-        duration = album_item.duration
-        if release:
-            release = release.strftime('%Y-%m-%d')
-        if duration:
-            duration = duration.strftime('%H:%M:%S')
-            
+        # The optional date and time objects are serialized by dumps
         body = RevMusicBuilder(
             unique_name=album,
             title=album_item.title,
             artist=album_item.artist,
-            release=release,
-            duration=duration,
-            genre=album_item.genre
+            release=album_item.publication_date,
+            duration=album_item.duration,
+            genre=album_item.genre,
+            review_count=album_item.review_count,
+            average_rating=_round_rating(album_item.average_rating),
+            rating_histogram=album_item.rating_histogram
         )
         body.add_namespace('revmusic', LINK_RELATIONS_URL)
         body.add_control('self', url_for('api.albumitem', album=album))
@@ -133,7 +297,7 @@ class AlbumItem(Resource):
         body.add_control_edit_album(album)
         body.add_control_delete_album(album)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(dumps(body), 200, mimetype=MASON)
 
     def put(self, album):
         """
@@ -145,7 +309,7 @@ class AlbumItem(Resource):
             return create_error_response(415, 'Unsupported media type', 'Use JSON')
         
         try:
-            validate(request.json, Album.get_schema())
+            validate(request.json, 'album')
         except ValidationError as e:
             return create_error_response(400, 'Invalid JSON document', str(e))
         
@@ -177,12 +341,7 @@ class AlbumItem(Resource):
         if 'genre' in request.json:
             genre = request.json['genre']
 
-        # Check that unique_name is not in use in case that it is changed
-        if unique_name != album and Album.query.filter_by(unique_name=unique_name).count() > 0:
-            return create_error_response(409, 'Already exists',
-            'Unique name "{}" is already in use'.format(unique_name))
-
-        # Update album values and commit
+        # Update album values and commit; the unique constraints tell if the unique name or the title and artist are in use
         album_item.unique_name = unique_name
         album_item.title = title
         album_item.artist = artist
@@ -192,10 +351,10 @@ class AlbumItem(Resource):
 
         try:
             db.session.commit()
-        except IntegrityError:
+        except IntegrityError as e:
             db.session.rollback()
-            return create_error_response(409, 'Already exists',
-            'Album with title "{}" already exists with artist "{}"'.format(title, artist))
+            return _conflict_response(e, unique_name, title, artist)
+        invalidate('albums', 'album:' + album, 'album:' + unique_name, 'album-names')
 
         return Response(status=201, headers={
             'Location': url_for('api.albumitem', album=unique_name) # Location of the updated item
@@ -207,11 +366,11 @@ class AlbumItem(Resource):
         If requested album does not exist in the API, 404 error code returned.
         : param str album: the unique name of the requested album, provided in the request URL
         """
-        # Fetch requested album item from database and check that it exists
-        album_item = Album.query.filter_by(unique_name=album).first()
-        if not album_item:
-            return create_error_response(404, 'Album not found')
-        
-        db.session.delete(album_item)
+        # Delete the requested album with a single statement; its reviews and their tags are deleted by the database (ON DELETE CASCADE)
+        deleted = Album.query.filter_by(unique_name=album).delete(synchronize_session=False)
         db.session.commit()
+        if not deleted:
+            return create_error_response(404, 'Album not found')
+        # The reviews of the album are deleted too; every listing that contained them shows album titles
+        invalidate('albums', 'album:' + album, 'album-names')
         return Response(status=204)
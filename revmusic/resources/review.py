@@ -1,15 +1,49 @@
 from revmusic import db
 from revmusic.constants import *
-from revmusic.models import User, Album, Review, Tag
-from revmusic.mason import create_error_response, RevMusicBuilder
-from revmusic.utils import create_identifier
+from revmusic.models import User, Album, Review, Tag, search_reviews
+from revmusic.mason import create_error_response, create_collection_response, dumps, RevMusicBuilder
+from revmusic.schemas import validate
+from revmusic.caching import conditional, cached, invalidate, add_cache_tags
+from revmusic.utils import create_identifier, encode_cursor, decode_cursor, parse_bulk_rows, chunks
 from flask_restful import Resource, reqparse
 from flask import Response, request, url_for
-from sqlalchemy import func
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy.orm import joinedload, contains_eager
 from sqlalchemy.exc import IntegrityError, StatementError
 import datetime
-import json
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
+
+
+def _start_of_day(date):
+    """
+    Returns the datetime at midnight of the given date
+    : param date date: the date
+    """
+    return datetime.datetime.combine(date, datetime.time.min)
+
+def _get_page(reviews_query, page_size, after=None, before=None):
+    """
+    Fetches one page of reviews ordered from newest to oldest using keyset pagination on (submission_date, id).
+    The page starts right after the "after" cursor or ends right before the "before" cursor, so fetching
+    a deep page costs the same as fetching the first one. Returns a tuple (reviews, has_next, has_prev).
+    : param Query reviews_query: the filtered review query to paginate
+    : param int page_size: the maximum number of reviews on the page
+    : param tuple after: decoded cursor (submission_date, id) of the last review on the previous page
+    : param tuple before: decoded cursor (submission_date, id) of the first review on the next page
+    """
+    if before is not None:
+        # Walk backwards from the cursor and flip the page to the normal order afterwards
+        date, review_id = before
+        reviews = reviews_query.filter(or_(Review.submission_date > date, and_(Review.submission_date == date, Review.id > review_id)))\
+            .order_by(Review.submission_date.asc(), Review.id.asc()).limit(page_size + 1).all()
+        has_prev = len(reviews) > page_size
+        reviews = reviews[:page_size][::-1]
+        return (reviews, True, has_prev)
+    if after is not None:
+        date, review_id = after
+        reviews_query = reviews_query.filter(or_(Review.submission_date < date, and_(Review.submission_date == date, Review.id < review_id)))
+    reviews = reviews_query.order_by(Review.submission_date.desc(), Review.id.desc()).limit(page_size + 1).all()
+    return (reviews[:page_size], len(reviews) > page_size, after is not None)
 
 
 class ReviewCollection(Resource):
@@ -18,26 +52,32 @@ class ReviewCollection(Resource):
         This enables the optional query parameters for the GET request
         """
         self.parse = reqparse.RequestParser()
-        self.parse.add_argument('filterby', type=str, required=False, default='album', choices=('album', 'artist', 'genre', 'user'))
+        self.parse.add_argument('filterby', type=str, required=False, default='album', choices=('album', 'artist', 'genre', 'user', 'text'))
         self.parse.add_argument('searchword', type=str, required=False)
         self.parse.add_argument('timeframe', type=str, required=False)
         self.parse.add_argument('nlatest', type=int, required=False)
+        self.parse.add_argument('page_size', type=int, required=False)
+        self.parse.add_argument('after', type=str, required=False)
+        self.parse.add_argument('before', type=str, required=False)
 
+    @conditional('review', 'user', 'album')
+    @cached('reviews', 'user-names', 'album-names')
     def get(self):
         """
         Responds to GET request with a listing of review items known to the API (JSON document with added hypermedia controls (MASON))
         Query parameters in the request URL can be used to filter the returned reviews.
+        The listing is streamed as NDJSON or Mason if requested (see create_collection_response)
         """
         body = RevMusicBuilder()
         body.add_namespace('revmusic', LINK_RELATIONS_URL)
         body.add_control_reviews_all('self')
         body.add_control_users_all()
         body.add_control_albums_all()
+        body.add_control_add_reviews()
 
         # Obtain query parameters sent by user
         args = self.parse.parse_args()
         reviews = []
-        foreign_keys = []
         timeframe = []
         nlatest = args['nlatest'] # None or int
         
@@ -47,19 +87,17 @@ class ReviewCollection(Resource):
                 if not temp[0][4:].isnumeric() or not temp[0][2:4].isnumeric() or not temp[0][0:2].isnumeric():
                     return create_error_response(415, 'Incorrect timeframe format')
                 try:
-                    datetime.date(int(temp[0][4:]), int(temp[0][2:4]), int(temp[0][0:2]))
+                    timeframe.append(datetime.date(int(temp[0][4:]), int(temp[0][2:4]), int(temp[0][0:2])))
                 except ValueError:
                     return create_error_response(415, 'Incorrect timeframe format')
-                timeframe.append('{}-{}-{}'.format(temp[0][4:], temp[0][2:4], temp[0][0:2]))
                 # Check for possible second time
                 if len(temp) is 2:
                     if not temp[1][4:].isnumeric() or not temp[1][2:4].isnumeric() or not temp[1][0:2].isnumeric():
                         return create_error_response(415, 'Incorrect timeframe format')
                     try:
-                        datetime.date(int(temp[1][4:]), int(temp[1][2:4]), int(temp[1][0:2]))
+                        timeframe.append(datetime.date(int(temp[1][4:]), int(temp[1][2:4]), int(temp[1][0:2])))
                     except ValueError:
                         return create_error_response(415, 'Incorrect timeframe format')
-                    timeframe.append('{}-{}-{}'.format(temp[1][4:], temp[1][2:4], temp[1][0:2]))
                 # Make sure no more than 2 timeframes were provided
                 if len(temp) > 2:   
                     raise Exception('More than two timeframe parameters')
@@ -67,63 +105,181 @@ class ReviewCollection(Resource):
                 # Return an error if an exception occurred
                 return create_error_response(415, 'Incorrect timeframe format', 'You provided an incorrect timeframe format. Please fix that >:( {}'.format(e))
 
-        # Error handling for nlatest is implemented by flask, since the type has been set to int
-        
-        # Handle filtering
-        if not args['searchword']:
-            # No searchword
-            if len(timeframe) < 1:
-                # No timeframe provided, return all or nlatest
-                reviews = Review.query.order_by(Review.submission_date.desc()).limit(nlatest).all()
-            elif len(timeframe) == 1:
-                # One time provided, return all or nlatest after that 
-                reviews = Review.query.filter(func.date(Review.submission_date) >= timeframe[0])\
-                    .order_by(Review.submission_date.desc()).limit(nlatest).all()
+        # Error handling for nlatest and page_size is implemented by flask, since the type has been set to int
+        page_size = args['page_size'] # None or int
+        if page_size is not None and page_size < 1:
+            return create_error_response(400, 'Invalid page size', 'Page size must be a positive integer')
+        # Decode the possible pagination cursors; only one of them can be used at a time
+        after = decode_cursor(args['after'])
+        before = decode_cursor(args['before'])
+        if (args['after'] is not None and after is None) or (args['before'] is not None and before is None):
+            return create_error_response(400, 'Invalid cursor', 'The provided pagination cursor is malformed')
+        if after and before:
+            return create_error_response(400, 'Invalid cursor', 'Parameters "after" and "before" cannot be used together')
+
+        # Handle filtering. The filtered column is joined to the review query, so the filtering needs no separate queries
+        reviews_query = Review.query
+        relevance = []
+        joined = set() # Relationships joined for filtering
+        if args['searchword']:
+            if args['filterby'] == 'user':
+                reviews_query = reviews_query.join(Review.user).filter(User.username.contains(args['searchword']))
+                joined.add('user')
             else:
-                # Two times provided, return all or nlatest between them
-                reviews = Review.query.filter(func.date(Review.submission_date) >= timeframe[0])\
-                    .filter(func.date(Review.submission_date) <= timeframe[1]).order_by(Review.submission_date.desc()).limit(nlatest).all()
-    
-        else:
-            # Handle filtering
+                reviews_query = reviews_query.join(Review.album)
+                joined.add('album')
             if args['filterby'] == 'album':
-                foreign_keys = Album.query.filter(Album.title.contains(args['searchword'])).all()
+                reviews_query = reviews_query.filter(Album.title.contains(args['searchword']))
             elif args['filterby'] == 'artist':
-                foreign_keys = Album.query.filter(Album.artist.contains(args['searchword'])).all()
+                reviews_query = reviews_query.filter(Album.artist.contains(args['searchword']))
             elif args['filterby'] == 'genre':
-                foreign_keys = Album.query.filter(Album.genre.contains(args['searchword'])).all()
-            else: # Filter by users
-                foreign_keys = User.query.filter(User.username.contains(args['searchword'])).all()
+                reviews_query = reviews_query.filter(Album.genre.contains(args['searchword']))
+            elif args['filterby'] == 'text':
+                # Full-text search from the review and album texts (see models.search_reviews)
+                reviews_query, relevance = search_reviews(reviews_query, args['searchword'])
+        # Users and albums are loaded in the same query to avoid a lazy load per listed review.
+        # A relationship joined for filtering is loaded from that join, the other one with a join of its own
+        reviews_query = reviews_query.options(*[
+            contains_eager(getattr(Review, name)) if name in joined else joinedload(getattr(Review, name)) for name in ('user', 'album')
+        ])
+        # Timeframes are compared as half-open datetime ranges against the bare column, so that the index on submission_date can be used
+        if len(timeframe) > 0:
+            # Return reviews submitted on the first day or after it
+            reviews_query = reviews_query.filter(Review.submission_date >= _start_of_day(timeframe[0]))
+        if len(timeframe) > 1 and timeframe[1] < datetime.date.max:
+            # Two times provided, return reviews submitted between them, including the whole last day.
+            # No day follows the last representable one, so then there's no upper bound
+            reviews_query = reviews_query.filter(Review.submission_date < _start_of_day(timeframe[1] + datetime.timedelta(days=1)))
 
-            if len(timeframe) < 1:
-                reviews = Review.query.filter(Review.album_id.in_([fk.id for fk in foreign_keys])).order_by(Review.submission_date.desc()).limit(nlatest).all()
-            elif len(timeframe) == 1:
-                reviews = Review.query.filter(Review.album_id.in_([fk.id for fk in foreign_keys])).filter(func.date(Review.submission_date) >= timeframe[0])\
-                    .order_by(Review.submission_date.desc()).limit(nlatest).all()
-            else:
-                reviews = Review.query.filter(Review.album_id.in_([fk.id for fk in foreign_keys])).filter(func.date(Review.submission_date) >= timeframe[0])\
-                    .filter(func.date(Review.submission_date) <= timeframe[1]).order_by(Review.submission_date.desc()).limit(nlatest).all()
+        if page_size is None and args['searchword'] and args['filterby'] == 'text':
+            # No pagination, return all or nlatest best matching reviews, ranked by relevance (bm25 on SQLite)
+            reviews = reviews_query.order_by(*relevance, Review.submission_date.desc()).limit(nlatest)
+        elif page_size is None:
+            # No pagination, return all or nlatest
+            reviews = reviews_query.order_by(Review.submission_date.desc(), Review.id.desc()).limit(nlatest)
+        else:
+            reviews, has_next, has_prev = _get_page(reviews_query, page_size, after, before)
+            if reviews and has_next:
+                body.add_control_reviews_page('next', args, after=encode_cursor(reviews[-1].submission_date, reviews[-1].id))
+            if reviews and has_prev:
+                body.add_control_reviews_page('prev', args, before=encode_cursor(reviews[0].submission_date, reviews[0].id))
 
-        body['items'] = []
-        for review in reviews:
+        review_url = RevMusicBuilder.url_template('api.reviewitem', 'album', 'review')
+        def make_item(review):
             item = RevMusicBuilder(
                 identifier=review.identifier,
                 user=review.user.username,
                 album=review.album.title,
                 title=review.title,
                 star_rating=review.star_rating,
-                submission_date=datetime.datetime.strftime(review.submission_date, '%Y-%m-%d %H:%M:%S')
+                submission_date=review.submission_date
             )
-            item.add_control('self', url_for('api.reviewitem', album=review.album.unique_name, review=review.identifier))
-            item.add_control('profile', REVIEW_PROFILE)
+            item.add_item_controls(review_url(album=review.album.unique_name, review=review.identifier), REVIEW_PROFILE)
+            return item
+
+        return create_collection_response(body, reviews, make_item)
+
+class ReviewBulk(Resource):
+    def post(self):
+        """
+        Responds to POST request by adding many new review items at once. The reviews are sent either as a JSON array
+        or as NDJSON, and every review names the reviewed album with the 'album' field.
+        The users and albums of the whole batch are resolved with a few set-based queries, and the valid reviews are inserted
+        in one transaction. The response lists the created reviews and an error for every review that could not be added.
+        If the batch as a whole can not be handled, an appropriate error code with a human-readable error message is returned.
+        """
+        rows = parse_bulk_rows(request)
+        if rows is None:
+            return create_error_response(415, 'Unsupported media type', 'Use a JSON array or NDJSON')
+        if len(rows) > MAX_BULK_ROWS:
+            return create_error_response(413, 'Too many reviews', 'At most {} reviews can be sent at once'.format(MAX_BULK_ROWS))
+
+        errors = []
+        valid = []
+        for index, row in enumerate(rows):
+            try:
+                validate(row, 'review-bulk')
+            except ValidationError as e:
+                errors.append({'index': index, 'status': 400, 'message': 'Invalid JSON document', 'details': e.message})
+                continue
+            valid.append((index, row))
+
+        # Resolve the users and albums of the batch and the reviews they already have
+        usernames = list(set(row['user'].lower() for index, row in valid))
+        album_names = list(set(row['album'] for index, row in valid))
+        users = {}
+        for chunk in chunks(usernames):
+            users.update(User.query.with_entities(User.username, User.id).filter(User.username.in_(chunk)).all())
+        albums = {}
+        for chunk in chunks(album_names):
+            albums.update(Album.query.with_entities(Album.unique_name, Album.id).filter(Album.unique_name.in_(chunk)).all())
+        pairs = list(set((users[row['user'].lower()], albums[row['album']]) for index, row in valid
+            if row['user'].lower() in users and row['album'] in albums))
+        reviewed = set()
+        for chunk in chunks(pairs, 250):
+            reviewed.update(Review.query.with_entities(Review.user_id, Review.album_id)\
+                .filter(tuple_(Review.user_id, Review.album_id).in_(chunk)).all())
+
+        created = []
+        new_reviews = []
+        for index, row in valid:
+            user_id = users.get(row['user'].lower())
+            album_id = albums.get(row['album'])
+            if user_id is None:
+                errors.append({'index': index, 'status': 404, 'message': 'User not found', 'details': row['user']})
+            elif album_id is None:
+                errors.append({'index': index, 'status': 404, 'message': 'Album not found', 'details': row['album']})
+            elif (user_id, album_id) in reviewed:
+                errors.append({'index': index, 'status': 409, 'message': 'Already exists',
+                    'details': 'User "{}" has already submitted a review to album "{}"'.format(row['user'].lower(), row['album'])})
+            else:
+                reviewed.add((user_id, album_id))
+                identifier, submission_dt = create_identifier('review_')
+                new_reviews.append({
+                    'identifier': identifier,
+                    'user_id': user_id,
+                    'album_id': album_id,
+                    'title': row['title'],
+                    'content': row['content'],
+                    'star_rating': row['star_rating'],
+                    'submission_date': submission_dt
+                })
+                created.append((index, row['album'], identifier))
+
+        # Insert all new reviews with a single executemany
+        if new_reviews:
+            try:
+                db.session.execute(Review.__table__.insert(), new_reviews)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return create_error_response(409, 'Conflict',
+                'Some of the reviews were submitted concurrently by another request, no reviews were added')
+            invalidate('reviews', 'albums', *set(
+                tag for index, row in valid
+                for tag in ('reviews:album:' + row['album'], 'ratings:album:' + row['album'], 'reviews:user:' + row['user'].lower())
+            ))
+
+        body = RevMusicBuilder(created=len(created), failed=len(errors))
+        body.add_namespace('revmusic', LINK_RELATIONS_URL)
+        body.add_control('self', url_for('api.reviewbulk'))
+        body.add_control_reviews_all()
+        body['items'] = []
+        for index, album, identifier in created:
+            item = RevMusicBuilder(index=index, identifier=identifier)
+            item.add_control('self', url_for('api.reviewitem', album=album, review=identifier))
             body['items'].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        body['errors'] = sorted(errors, key=lambda error: error['index'])
+        return Response(dumps(body), 200, mimetype=MASON)
 
 class ReviewsByAlbum(Resource):
+    @conditional('review', 'user', 'album')
+    @cached('album:{album}', 'reviews:album:{album}', 'user-names')
     def get(self, album):
         """
         Responds to GET request with a listing of all reviews for the specified album (JSON document with added hypermedia controls (MASON))
         If the specified album does not exist in the API, 404 error code returned.
+        The listing is streamed as NDJSON or Mason if requested (see create_collection_response)
         : param str album: the unique name of the album the reviews of which are requested, provided in the request URL
         """
         # Fetch the album item from the database and check whether it exists
@@ -139,21 +295,21 @@ class ReviewsByAlbum(Resource):
         body.add_control_add_review(album)
         
         # Fetch all the reviews from the database for the specified album
-        reviews = Review.query.filter(Review.album == album_item).order_by(Review.submission_date.desc()).all()
-        body['items'] = []
-        for review in reviews:
+        reviews = Review.query.options(joinedload(Review.user)).filter(Review.album == album_item).order_by(Review.submission_date.desc())
+
+        review_url = RevMusicBuilder.url_template('api.reviewitem', 'album', 'review')
+        def make_item(review):
             item = RevMusicBuilder(
                 identifier=review.identifier,
                 user=review.user.username,
                 title=review.title,
                 star_rating=review.star_rating,
-                submission_date=datetime.datetime.strftime(review.submission_date, '%Y-%m-%d %H:%M:%S')
+                submission_date=review.submission_date
             )
-            item.add_control('self', url_for('api.reviewitem', album=album, review=review.identifier))
-            item.add_control('profile', REVIEW_PROFILE)
-            body['items'].append(item)
+            item.add_item_controls(review_url(album=album, review=review.identifier), REVIEW_PROFILE)
+            return item
             
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_collection_response(body, reviews, make_item)
 
     def post(self, album):
         """
@@ -165,7 +321,7 @@ class ReviewsByAlbum(Resource):
         if not request.json:
             return create_error_response(415, 'Unsupported media type', 'Use JSON')
         try:
-            validate(request.json, Review.get_schema())
+            validate(request.json, 'review')
         except ValidationError as e:
             return create_error_response(400, 'Invalid JSON document', str(e))
         
@@ -175,13 +331,7 @@ class ReviewsByAlbum(Resource):
             return create_error_response(404, 'Album not found')
         
         # Create an unique identifier and get the submission datetime for the review
-        # Note: the probability of creating an identifier that already exist is practically zero, 
-        # but just to be absolutely sure the creation is tried until unique identifier is created. 
-        # Infinite looping extremely unlikely.
-        while True:
-            identifier, submission_dt = create_identifier('review_')
-            if Review.query.filter_by(identifier=identifier).count() == 0:
-                break
+        identifier, submission_dt = create_identifier('review_')
             
         # Get the arguments from the request
         user = request.json['user'].lower() # Lowercase just in case
@@ -213,6 +363,7 @@ class ReviewsByAlbum(Resource):
             db.session.rollback()
             return create_error_response(409, 'Already exists',
             'User "{}" has already submitted a review to album with title "{}"'.format(user, album_item.title))
+        invalidate('reviews', 'reviews:album:' + album, 'reviews:user:' + user, 'albums', 'ratings:album:' + album)
         
         # Respond to successful request
         return Response(status=201, headers={
@@ -220,10 +371,13 @@ class ReviewsByAlbum(Resource):
         })
 
 class ReviewsByUser(Resource):
+    @conditional('review', 'user', 'album')
+    @cached('user:{user}', 'reviews:user:{user}', 'album-names')
     def get(self, user):
         """
         Responds to GET request with a listing of all reviews submitted by the specified user (JSON document with added hypermedia controls (MASON))
         If the specified user does not exist in the API, 404 error code returned.
+        The listing is streamed as NDJSON or Mason if requested (see create_collection_response)
         : param str user: the username of the user whose reviews are requested, provided in the request URL
         """
         # Fetch the user item from the database and check if it exists
@@ -238,23 +392,25 @@ class ReviewsByUser(Resource):
         body.add_control_reviews_all()
         
         # Fetch the reviews from the database submitted by the specified user
-        reviews = Review.query.filter(Review.user == user_item).order_by(Review.submission_date.desc()).all()
-        body['items'] = []
-        for review in reviews:
+        reviews = Review.query.options(joinedload(Review.album)).filter(Review.user == user_item).order_by(Review.submission_date.desc())
+
+        review_url = RevMusicBuilder.url_template('api.reviewitem', 'album', 'review')
+        def make_item(review):
             item = RevMusicBuilder(
                 identifier=review.identifier,
                 album=review.album.title,
                 title=review.title,
                 star_rating=review.star_rating,
-                submission_date=datetime.datetime.strftime(review.submission_date, '%Y-%m-%d %H:%M:%S')
+                submission_date=review.submission_date
             )
-            item.add_control('self', url_for('api.reviewitem', album=review.album.unique_name, review=review.identifier))
-            item.add_control('profile', REVIEW_PROFILE)
-            body['items'].append(item)
+            item.add_item_controls(review_url(album=review.album.unique_name, review=review.identifier), REVIEW_PROFILE)
+            return item
             
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_collection_response(body, reviews, make_item)
     
 class ReviewItem(Resource):
+    @conditional('review', 'user', 'album')
+    @cached('review:{review}', 'album:{album}')
     def get(self, album, review):
         """
         Responds to GET request with the representation of the requested review item (JSON document with added hypermedia controls (MASON))
@@ -272,6 +428,7 @@ class ReviewItem(Resource):
         
         # Create response
         user = review_item.user.username
+        add_cache_tags('user:' + user)
         body = RevMusicBuilder(
             identifier=review,
             user=user,
@@ -280,7 +437,7 @@ class ReviewItem(Resource):
             title=review_item.title,
             content=review_item.content,
             star_rating=review_item.star_rating,
-            submission_date=datetime.datetime.strftime(review_item.submission_date, '%Y-%m-%d %H:%M:%S')
+            submission_date=review_item.submission_date
         )
         body.add_namespace('revmusic', LINK_RELATIONS_URL)
         body.add_control('self', url_for('api.reviewitem', album=album, review=review))
@@ -293,7 +450,7 @@ class ReviewItem(Resource):
         body.add_control_edit_review(album, review)
         body.add_control_delete_review(album, review)
         
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(dumps(body), 200, mimetype=MASON)
 
     def put(self, album, review):
         """
@@ -305,7 +462,7 @@ class ReviewItem(Resource):
         if not request.json:
             return create_error_response(415, 'Unsupported media type', 'Use JSON')
         try:
-            validate(request.json, Review.get_schema())
+            validate(request.json, 'review')
         except ValidationError as e:
             return create_error_response(400, 'Invalid JSON document', str(e))
         
@@ -318,13 +475,7 @@ class ReviewItem(Resource):
             return create_error_response(404, 'Review not found')
         
         # Create an updated unique identifier and get the updated submission datetime for the review
-        # Note: the probability of creating an identifier that already exist is practically zero, 
-        # but just to be absolutely sure the creation is tried until unique identifier is created. 
-        # Infinite looping extremely unlikely.
-        while True:
-            identifier, submission_dt = create_identifier('review_')
-            if Review.query.filter_by(identifier=identifier).count() == 0:
-                break
+        identifier, submission_dt = create_identifier('review_')
         original_user = review_item.user.username
         # Get the arguments from the request
         user = request.json['user'].lower() # Lowercase just in case
@@ -350,6 +501,7 @@ class ReviewItem(Resource):
             db.session.rollback()
             return create_error_response(409, 'Unexpected conflict',
             'An unexpected conflict happened while committing to the database')
+        invalidate('reviews', 'review:' + review, 'reviews:album:' + album, 'reviews:user:' + user, 'albums', 'ratings:album:' + album)
         
         return Response(status=201, headers={
             'Location': url_for('api.reviewitem', album=album, review=identifier) # The location of the updated item
@@ -370,6 +522,8 @@ class ReviewItem(Resource):
         if not review_item:
             return create_error_response(404, 'Review not found')
         
+        user = review_item.user.username
         db.session.delete(review_item)
         db.session.commit()
+        invalidate('reviews', 'review:' + review, 'reviews:album:' + album, 'reviews:user:' + user, 'albums', 'ratings:album:' + album)
         return Response(status=204)
@@ -1,18 +1,42 @@
 from revmusic import db
+from revmusic.utils import unique_violation
 from revmusic.constants import *
 from revmusic.models import User, Album, Review, Tag
-from revmusic.mason import create_error_response, RevMusicBuilder
+from revmusic.mason import create_error_response, create_collection_response, dumps, RevMusicBuilder
+from revmusic.schemas import validate
+from revmusic.caching import conditional, cached, invalidate
 from flask_restful import Resource
 from flask import Response, request, url_for
 from sqlalchemy.exc import IntegrityError, StatementError
-import json
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
+
+
+def _conflict_response(error, username, email):
+    """
+    Returns the 409 error response of a write that failed with an IntegrityError,
+    naming the username or email that is already taken
+    : param IntegrityError error: the error raised on commit
+    : param str username: the username of the written user
+    : param str email: the email of the written user
+    """
+    columns = unique_violation(error)
+    if columns == ('username',):
+        return create_error_response(409, 'Already exists',
+        'User with username "{}" already exists'.format(username))
+    if columns == ('email',):
+        return create_error_response(409, 'Already exists',
+        'User with email "{}" already exists'.format(email))
+    return create_error_response(409, 'Unexpected conflict',
+    'An unexpected conflict happened while committing to the database')
 
 
 class UserCollection(Resource):
+    @conditional('user')
+    @cached('users')
     def get(self):
         """
         Responds to GET request with a listing of all user items known to the API (JSON document with added hypermedia controls (MASON))
+        The listing is streamed as NDJSON or Mason if requested (see create_collection_response)
         """
         body = RevMusicBuilder()
         body.add_namespace('revmusic', LINK_RELATIONS_URL)
@@ -21,16 +45,15 @@ class UserCollection(Resource):
         body.add_control_albums_all()
         body.add_control_add_user()
 
-        body['items'] = []
-        for user in User.query.all():
+        user_url = RevMusicBuilder.url_template('api.useritem', 'user')
+        def make_item(user):
             item = RevMusicBuilder(
                 username=user.username
             )
-            item.add_control('self', url_for('api.useritem', user=user.username))
-            item.add_control('profile', USER_PROFILE)
-            body['items'].append(item)
+            item.add_item_controls(user_url(user=user.username), USER_PROFILE)
+            return item
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_collection_response(body, User.query, make_item)
 
     def post(self):
         """
@@ -41,7 +64,7 @@ class UserCollection(Resource):
         if not request.json:
             return create_error_response(415, 'Unsupported media type', 'Use JSON')
         try:
-            validate(request.json, User.get_schema())
+            validate(request.json, 'user')
         except ValidationError as e:
             return create_error_response(400, 'Invalid JSON document', str(e))
         
@@ -50,29 +73,20 @@ class UserCollection(Resource):
         email = request.json['email']
         password = request.json['password']
 
-        # Check that username not taken
-        if User.query.filter_by(username=username).count() > 0:
-            return create_error_response(409, 'Already exists',
-            'User with username "{}" already exists'.format(username))
-        # Check that email not taken
-        if User.query.filter_by(email=email).count() > 0:
-            return create_error_response(409, 'Already exists',
-            'User with email "{}" already exists'.format(email))
-
         # Create the new user entry
         user = User(
             username=username,
             email=email,
             password=password
         )
-        # Attempt to add to database
+        # Attempt to add to database; the unique constraints tell if the username or email is taken
         try:
             db.session.add(user)
             db.session.commit()
-        except IntegrityError:
+        except IntegrityError as e:
             db.session.rollback()
-            return create_error_response(409, 'Unexpected conflict',
-            'An unexpected conflict happened while committing to the database')
+            return _conflict_response(e, username, email)
+        invalidate('users', 'user:' + username)
         
         # Respond to successful request
         return Response(status=201, headers={
@@ -80,6 +94,8 @@ class UserCollection(Resource):
         })
 
 class UserItem(Resource):
+    @conditional('user')
+    @cached('user:{user}')
     def get(self, user):
         """
         Responds to GET request with the representation of the requested user item (JSON document with added hypermedia controls (MASON))
@@ -102,7 +118,7 @@ class UserItem(Resource):
         body.add_control_reviews_by(user)
         body.add_control_edit_user(user)
         body.add_control_delete_user(user)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(dumps(body), 200, mimetype=MASON)
 
     def put(self, user):
         """
@@ -113,7 +129,7 @@ class UserItem(Resource):
         if not request.json:
             return create_error_response(415, 'Unsupported media type', 'Use JSON')
         try:
-            validate(request.json, User.get_schema())
+            validate(request.json, 'user')
         except ValidationError as e:
             return create_error_response(400, 'Invalid JSON document', str(e))
         
@@ -126,29 +142,18 @@ class UserItem(Resource):
         email = request.json['email']
         password = request.json['password']
 
-        # Check that possible new username is not taken
-        if username != user:
-            if User.query.filter_by(username=username).count() > 0:
-                return create_error_response(409, 'Already exists',
-                'User with username "{}" already exists'.format(username))
-
-        # Check that possible new email is not taken
-        if email != db_user.email:
-            if User.query.filter_by(email=email).count() > 0:
-                return create_error_response(409, 'Already exists',
-                'User with email "{}" already exists'.format(email))
-        
         # Updated user entry
         db_user.username = username
         db_user.email = email
         db_user.password = password
-        # Commit changes
+        # Commit changes; the unique constraints tell if the possible new username or email is taken
         try:
             db.session.commit()
-        except IntegrityError:
+        except IntegrityError as e:
             db.session.rollback()
-            return create_error_response(409, 'Unexpected conflict',
-            'An unexpected conflict happened while committing to the database')
+            return _conflict_response(e, username, email)
+        # Review listings show the usernames, so they are stale only if the username changed
+        invalidate('users', 'user:' + user, 'user:' + username, *(['user-names'] if username != user else []))
         
         return Response(status=201, headers={
             'Location': url_for('api.useritem', user=username) # Location of the updated item
@@ -160,11 +165,12 @@ class UserItem(Resource):
         If the requested user does not exist in the API, 404 error code returned.
         : param str user: the username of the requested user, provided in the request URL
         """
-        # Fetch the requested user from the database and check that it exists
-        db_user = User.query.filter_by(username=user).first()
-        if not db_user:
-            return create_error_response(404, 'User not found')
-        
-        db.session.delete(db_user)
+        # Delete the requested user with a single statement; its reviews and tags are deleted by the database (ON DELETE CASCADE)
+        deleted = User.query.filter_by(username=user).delete(synchronize_session=False)
         db.session.commit()
+        if not deleted:
+            return create_error_response(404, 'User not found')
+        # The reviews of the user are deleted too; every listing that contained them shows usernames,
+        # and the ratings of the reviewed albums change
+        invalidate('users', 'user:' + user, 'user-names', 'albums', 'ratings')
         return Response(status=204)
@@ -0,0 +1,80 @@
+from jsonschema.validators import validator_for
+
+from revmusic.models import User, Album, Review
+
+"""
+Registry of the JSON schemas of the models and their compiled validators.
+The schemas are built and checked against the metaschema only once, when the app is created,
+and the same objects are then reused for validating requests and for rendering the Mason controls.
+"""
+
+SCHEMAS = {}
+VALIDATORS = {}
+
+
+class FrozenDict(dict):
+    """
+    Dictionary that cannot be modified after creation. Being a dict, it is serialized by json.dumps as is.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Registered schemas cannot be modified')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+
+class FrozenList(list):
+    """
+    List that cannot be modified after creation. Being a list, it is serialized by json.dumps as is.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Registered schemas cannot be modified')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = clear = extend = insert = pop = remove = reverse = sort = _immutable
+
+
+def _freeze(obj):
+    """
+    Returns a recursively frozen copy of a schema
+    : param obj: the schema or a part of it
+    """
+    if isinstance(obj, dict):
+        return FrozenDict((key, _freeze(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(_freeze(value) for value in obj)
+    return obj
+
+def init_schemas():
+    """
+    Builds the schemas of the models and compiles their validators, unless already done.
+    Called from create_app.
+    """
+    sources = {
+        'user': User.get_schema,
+        'album': Album.get_schema,
+        'review': Review.get_schema,
+        'review-bulk': Review.get_bulk_schema
+    }
+    for name, build in sources.items():
+        if name in SCHEMAS:
+            continue
+        schema = _freeze(build())
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        SCHEMAS[name] = schema
+        VALIDATORS[name] = cls(schema)
+
+def get_schema(name):
+    """
+    Returns a registered (frozen) schema
+    : param str name: name of the schema, e.g. 'user'
+    """
+    return SCHEMAS[name]
+
+def validate(instance, name):
+    """
+    Validates a JSON document against a registered schema with the compiled validator.
+    Raises jsonschema.ValidationError if the document is invalid, just like jsonschema.validate.
+    : param instance: the JSON document, e.g. request.json
+    : param str name: name of the schema, e.g. 'user'
+    """
+    VALIDATORS[name].validate(instance)
@@ -0,0 +1,287 @@
+import gc
+import os
+import sys
+import time
+import signal
+import socket
+import threading
+import traceback
+import click
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.sharedctypes import RawArray
+from flask import current_app
+from flask.cli import FlaskGroup, with_appcontext
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import ClosingIterator
+
+from revmusic import create_app, db
+
+"""
+Production launcher: "$ revmusic serve" (or "$ flask serve"). The app is created once in a master process, which then
+forks the worker processes; they share the loaded code, the compiled schemas and the URL map copy-on-write,
+so starting a worker costs nothing but the fork. The workers accept connections from the same listening socket,
+and every worker handles at most THREADS requests at a time, leaving the other connections to the idle workers.
+
+The master replaces workers that exit, e.g. after --max-requests requests. Signals to the master:
+- HUP: graceful reload, new workers are started and the old ones finish their requests and exit
+- USR1: report the statistics of every worker
+- TERM, INT: graceful shutdown, the workers finish their requests (for at most --graceful-timeout seconds)
+"""
+
+# Fields of a worker's statistics, kept in memory shared by the master and the workers
+STAT_FIELDS = ('pid', 'started', 'requests', 'active', 'errors')
+PID, STARTED, REQUESTS, ACTIVE, ERRORS = range(len(STAT_FIELDS))
+# Signals handled by the master
+SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        if self.server.access_log:
+            super().log_request(*args, **kwargs)
+
+
+class WorkerServer(BaseWSGIServer):
+    """
+    WSGI server of a worker process. Connections are handled by a pool of threads; when all of them are busy,
+    no more connections are accepted, so they wait in the listening socket for other workers.
+    """
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, app, threads, fd, access_log=False):
+        super().__init__(host, port, app, handler=_RequestHandler, fd=fd)
+        self.access_log = access_log
+        self.slots = threading.BoundedSemaphore(threads)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='revmusic')
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+def _run_worker(app, options, listener, stats, slot):
+    """
+    Serves requests in a forked worker process until the master asks it to stop or it has handled max_requests requests.
+    Never returns
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    # The master decides what to do on these, also when they are sent to the whole process group
+    for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(signum, signal.SIG_IGN)
+    # The signals were blocked by the master while forking, so none of them reached its handlers in this process
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+
+    row = slot * len(STAT_FIELDS)
+    stats[row + PID], stats[row + STARTED] = os.getpid(), int(time.time())
+    lock = threading.Lock()
+
+    def finished():
+        with lock:
+            stats[row + ACTIVE] -= 1
+
+    def counted_app(environ, start_response):
+        with lock:
+            stats[row + REQUESTS] += 1
+            stats[row + ACTIVE] += 1
+            if options['max_requests'] and stats[row + REQUESTS] >= options['max_requests']:
+                stop.set()
+        def counted_start_response(status, headers, exc_info=None):
+            if status.startswith('5'):
+                with lock:
+                    stats[row + ERRORS] += 1
+            return start_response(status, headers, exc_info)
+        return ClosingIterator(app(environ, counted_start_response), finished)
+
+    server = WorkerServer(options['host'], options['port'], counted_app, options['threads'], listener.fileno(), options['access_log'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    while not stop.wait(1):
+        pass
+    server.shutdown()
+    server.executor.shutdown(wait=True)
+    with app.app_context():
+        db.engine.dispose()
+    os._exit(0)
+
+
+class Master(object):
+    """
+    The master process: forks the workers, replaces the ones that exit, and handles the signals
+    """
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        self.workers = {}      # pid -> slot of the running workers
+        self.retiring = set()  # pids of the workers asked to exit
+        # Twice the slots, so the old and the new workers fit in during a reload
+        self.slots = options['workers'] * 2
+        self.free_slots = list(range(self.slots))
+        self.stats = RawArray('q', self.slots * len(STAT_FIELDS))
+        # Totals of the workers that have exited
+        self.exited_requests = self.exited_errors = 0
+        self.signals = []
+
+    def run(self):
+        options = self.options
+        self.listener = socket.create_server((options['host'], options['port']), backlog=options['backlog'])
+        host, port = self.listener.getsockname()[:2]
+        options['port'] = port
+        click.echo("Listening on http://{}:{} with {} workers of {} threads".format(host, port, options['workers'], options['threads']))
+        # Connections are opened by the workers, never shared with them
+        with self.app.app_context():
+            db.engine.dispose()
+        # Objects created so far are never collected, so the garbage collector of a worker doesn't copy their pages
+        gc.freeze()
+
+        for signum in SIGNALS:
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        for i in range(options['workers']):
+            self.spawn()
+        last_report = time.time()
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.shutdown()
+                    return
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGUSR1:
+                    self.report()
+            self.reap()
+            if options['stats_interval'] and time.time() - last_report >= options['stats_interval']:
+                self.report()
+                last_report = time.time()
+            time.sleep(0.1)
+
+    def spawn(self):
+        slot = self.free_slots.pop(0)
+        row = slot * len(STAT_FIELDS)
+        self.stats[row:row + len(STAT_FIELDS)] = [0] * len(STAT_FIELDS)
+        signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(self.app, self.options, self.listener, self.stats, slot)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(1)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+        self.workers[pid] = slot
+        click.echo("Worker {} started".format(pid))
+
+    def reap(self):
+        """
+        Collects the workers that have exited, and replaces them unless they were asked to exit
+        """
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            slot = self.workers.pop(pid, None)
+            if slot is None:
+                continue
+            row = slot * len(STAT_FIELDS)
+            click.echo("Worker {} exited with status {} after {} requests".format(pid, os.waitstatus_to_exitcode(status), self.stats[row + REQUESTS]))
+            self.exited_requests += self.stats[row + REQUESTS]
+            self.exited_errors += self.stats[row + ERRORS]
+            self.stats[row:row + len(STAT_FIELDS)] = [0] * len(STAT_FIELDS)
+            self.free_slots.append(slot)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            else:
+                self.spawn()
+
+    def reload(self):
+        """
+        Replaces the workers: the new ones are started first, so requests keep being served
+        """
+        old = [pid for pid in self.workers if pid not in self.retiring]
+        if len(old) > len(self.free_slots):
+            click.echo("Still reloading, the reload is skipped")
+            return
+        click.echo("Reloading workers")
+        for pid in old:
+            self.spawn()
+        self.stop_workers(old)
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def shutdown(self):
+        """
+        Stops the workers gracefully, killing the ones still running after the graceful timeout
+        """
+        click.echo("Shutting down")
+        self.stop_workers(list(self.workers))
+        deadline = time.time() + self.options['graceful_timeout']
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            click.echo("Worker {} killed".format(pid))
+            os.kill(pid, signal.SIGKILL)
+        while self.workers:
+            self.reap()
+            time.sleep(0.01)
+        self.listener.close()
+        self.report()
+
+    def report(self):
+        """
+        Prints the statistics of every running worker, and the totals of all the workers so far
+        """
+        now = time.time()
+        total_requests, total_errors = self.exited_requests, self.exited_errors
+        for slot in sorted(self.workers.values()):
+            row = slot * len(STAT_FIELDS)
+            pid, started, requests, active, errors = self.stats[row:row + len(STAT_FIELDS)]
+            total_requests += requests
+            total_errors += errors
+            if pid:
+                click.echo("Worker {}: {} requests, {} active, {} server errors, up {:.0f} s".format(pid, requests, active, errors, now - started))
+        click.echo("Total: {} requests, {} server errors".format(total_requests, total_errors))
+        sys.stdout.flush()
+
+
+@click.command(name="serve", help="Serves the API with preforked multi-threaded worker processes")
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option("--port", default=8000, help="Port to listen on, 0 for any free port")
+@click.option("--workers", default=None, type=int, help="Number of worker processes, the number of CPUs by default")
+@click.option("--threads", default=4, help="Number of requests a worker handles at a time")
+@click.option("--max-requests", default=0, help="Replace a worker after it has handled this many requests, 0 for never")
+@click.option("--graceful-timeout", default=30, help="Seconds the workers may take to finish their requests when stopping")
+@click.option("--stats-interval", default=0, help="Seconds between reports of the worker statistics, 0 for only on SIGUSR1 and on shutdown")
+@click.option("--backlog", default=2048, help="Number of connections waiting to be accepted")
+@click.option("--access-log/--no-access-log", default=False, help="Log every request")
+@with_appcontext
+def serve_cmd(**options):
+    """
+    Runs the API with the preforking launcher until it is stopped with SIGTERM or SIGINT.
+    This function is called from the command line with "$ revmusic serve" or "$ flask serve"
+    """
+    if not hasattr(os, 'fork'):
+        raise click.ClickException("Serving with preforked workers requires os.fork")
+    if options['workers'] is None:
+        options['workers'] = os.cpu_count() or 1
+    Master(current_app._get_current_object(), options).run()
+
+
+# The "revmusic" command, e.g. "$ revmusic serve": the commands of the app without setting FLASK_APP
+cli = FlaskGroup(create_app=create_app)
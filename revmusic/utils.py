@@ -1,4 +1,11 @@
+import os
+import re
+import json
+import base64
 import datetime
+import threading
+
+from revmusic.constants import NDJSON
 
 def to_date(date_str):
     """
@@ -45,13 +52,114 @@ def to_time(time_str):
         #print("Incorrect time format: {}".format(time_str))
         return None
 
+# State of the identifier generator. Reset in a forked child process, see create_identifier
+_identifier_lock = threading.Lock()
+_identifier_state = {'pid': None, 'node': None, 'last': None, 'sequence': 0}
+
 def create_identifier(prefix):
     """
-    Creates an identifier for an item: takes current datetime, stringifies it by concatenating year, month, day, hours, minutes and seconds,
-    and adds this combination to a given prefix. Returns the identifier and the creation datetime as a tuple.
+    Creates an unique identifier for an item without querying the database, and returns the identifier
+    and the creation datetime as a tuple. The identifier is the given prefix followed by
+    - the creation datetime with microsecond resolution (year, month, day, hours, minutes, seconds, microseconds),
+    - a sequence number separating the identifiers created by this process within the same microsecond,
+    - a random node id separating the processes, generated again after a fork.
+    Within a process the creation datetimes never decrease, so identifiers with the same prefix sort by creation time.
     : param str prefix: Prefix of an identifier, e.g., "review_"
     """
-    dt = datetime.datetime.now()
-    dt_str = dt.strftime("%Y%m%d%H%M%S")
-    identifier = prefix + dt_str
+    with _identifier_lock:
+        state = _identifier_state
+        if state['pid'] != os.getpid():
+            state['pid'] = os.getpid()
+            state['node'] = os.urandom(3).hex()
+            state['last'] = None
+        dt = datetime.datetime.now()
+        if state['last'] is not None and dt <= state['last']:
+            # Same microsecond or the clock went backwards: keep the time and bump the sequence
+            dt = state['last']
+            state['sequence'] += 1
+            if state['sequence'] > 9999:
+                dt += datetime.timedelta(microseconds=1)
+                state['sequence'] = 0
+        else:
+            state['sequence'] = 0
+        state['last'] = dt
+        identifier = '{}{}{:04d}{}'.format(prefix, dt.strftime("%Y%m%d%H%M%S%f"), state['sequence'], state['node'])
     return (identifier, dt)
+
+def parse_bulk_rows(req):
+    """
+    Reads the rows of a bulk request, sent either as a JSON array or as NDJSON (one JSON document per line)
+    params:
+    - req: The Flask request
+    Returns: List of rows or None if the body is neither. In NDJSON, a line that is not valid JSON becomes a None row
+    """
+    if req.mimetype == NDJSON:
+        rows = []
+        for line in req.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+        return rows
+    data = req.get_json(silent=True)
+    if isinstance(data, list):
+        return data
+    return None
+
+def chunks(items, size=500):
+    """
+    Splits a list into consecutive chunks of the given size. Used for keeping the number of bound
+    parameters of a single IN query below SQLite's limit.
+    : param list items: The list to split
+    : param int size: The maximum size of a chunk
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def encode_cursor(dt, item_id):
+    """
+    Creates an opaque pagination cursor from the sort key of an item, i.e., its datetime and database id.
+    The cursor is an URL-safe base64 string, so it can be passed as-is in a query parameter.
+    : param datetime dt: The datetime part of the sort key, e.g., the submission date of a review
+    : param int item_id: The id part of the sort key
+    """
+    key = '{}_{}'.format(dt.strftime('%Y-%m-%d %H:%M:%S.%f'), item_id)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    Converts a cursor created by encode_cursor back to its sort key
+    params:
+    - cursor: The cursor string
+    Returns: (datetime, id) tuple or None if failed to convert. None is also returned if cursor is None
+    """
+    if cursor is None:
+        return None
+    try:
+        dt_str, item_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('_')
+        return (datetime.datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S.%f'), int(item_id))
+    except (ValueError, UnicodeError):
+        #print("Incorrect cursor: {}".format(cursor))
+        return None
+
+def unique_violation(error):
+    """
+    Finds out which unique constraint an insert or update violated, so the write can be tried without checking
+    for duplicates first. SQLite names the columns in the message ("UNIQUE constraint failed: album.title, album.artist"),
+    PostgreSQL in the detail of the error ("Key (title, artist)=(...) already exists.").
+    params:
+    - error: The IntegrityError raised by SQLAlchemy
+    Returns: Tuple of the column names, e.g. ('title', 'artist'), or None if the error is not a unique violation
+    """
+    diag = getattr(error.orig, 'diag', None)
+    if diag is not None:
+        match = re.match(r'Key \(([^)]*)\)=', diag.message_detail or '')
+        if getattr(error.orig, 'pgcode', None) != '23505' or match is None:
+            return None
+        return tuple(column.strip().strip('"') for column in match.group(1).split(','))
+    message = str(error.orig)
+    if not message.startswith('UNIQUE constraint failed: '):
+        return None
+    return tuple(column.strip().split('.')[-1] for column in message[len('UNIQUE constraint failed: '):].split(','))
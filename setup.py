@@ -12,5 +12,12 @@ setup(
         'SQLAlchemy',
         'jsonschema',
         'click'
-    ]
+    ],
+    entry_points={
+        'console_scripts': ['revmusic = revmusic.server:cli']
+    },
+    extras_require={
+        'fast': ['orjson'],
+        'asgi': ['uvicorn']
+    }
 )
@@ -10,11 +10,13 @@ const API_URL = "http://127.0.0.1:5000";
 const USERS_ALL = "revmusic:users-all";
 const ALBUMS_ALL = "revmusic:albums-all";
 const REVIEWS_ALL = "revmusic:reviews-all";
+const ALBUMS_TOP = "revmusic:albums-top";
 const REVIEWS_FOR_ALBUM = 'revmusic:reviews-for';
 // API urls stored here
 let USERS_URL = '';
 let ALBUMS_URL = '';
 let REVIEWS_URL = '';
+let TOP_ALBUMS_URL = '';
 
 
 function errorAlert(xhr) {
@@ -42,18 +44,20 @@ window.onload = async function() {
 
 function getMainUrls() {
     /*
-    Loads the URLs for revmusic:users-all, revmusic:albums-all, revmusic:reviews-all. After a successful GET, this calls rendering on URL dependent functions
+    Loads the URLs for revmusic:users-all, revmusic:albums-all, revmusic:reviews-all, revmusic:albums-top. After a successful GET, this calls rendering on URL dependent functions
     */
     $.ajax({
         url: API_URL + "/api/",
         success: function(data) {
             data = data["@controls"];
             USERS_URL = data[USERS_ALL]["href"];
-            ALBUMS_URL = data[ALBUMS_ALL]["href"];
+            ALBUMS_URL = data[ALBUMS_ALL]["href"].split("?")[0];
             REVIEWS_URL = data[REVIEWS_ALL]["href"].split("?")[0];
+            TOP_ALBUMS_URL = data[ALBUMS_TOP]["href"].split("?")[0];
             // Render stuff dependent on the URLs
             getAlbums();
             renderNewestReviews();
+            renderTopAlbums();
         },
         error: function(xhr) {
             $("body").html("<h1>Couldn't connect to the API. Please check that the API_URL is correct and that the API is running!</h1>");
@@ -348,6 +352,32 @@ function renderNewestReviews() {
     });
 }
 
+function renderTopAlbums(rankby='rating') {
+    /*
+    Renders the 5 best rated albums, or the 5 albums reviewed most during the last week. Called when the site is loaded
+    args:
+        rankby: 'rating' or 'trending'
+    */
+    $(".Top_Albums").html(
+        "<h3>Top Albums:</h3>" +
+        "<button onclick='renderTopAlbums(\"rating\")'>Best rated</button>  |  " +
+        "<button onclick='renderTopAlbums(\"trending\")'>Trending this week</button></br>"
+    );
+    $.ajax({
+        url: API_URL + TOP_ALBUMS_URL + "?limit=5&rankby=" + rankby,
+        success: function(data) {
+            data = data["items"];
+            for(var i = 0; i < data.length; i++) {
+                $(".Top_Albums").append(
+                    (i + 1) + ". " + data[i].title + " by " + data[i].artist + "</br>" +
+                    data[i].review_count + " reviews, " + data[i].average_rating + " stars on average</br>"
+                );
+            }
+        },
+        error: function(data) {}
+    });
+}
+
 function renderReviewAlbum(href) {
     $(".Add_Review_Popup").html(
         "<div id='popupOverlay'></div>" +
@@ -385,6 +415,7 @@ function addReview(href) {
             $(".Add_Review_Popup").fadeToggle();
             //renderSelectedAlbum(href);
             renderNewestReviews();
+            renderTopAlbums();
         },
         error: errorAlert
     });
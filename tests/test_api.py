@@ -1,18 +1,36 @@
 import os
 import re
+import sys
+import shutil
 import json
 import time
+import asyncio
+import queue
 import pytest
+import signal
+import sqlite3
 import tempfile
 import datetime
+import threading
+import subprocess
+import urllib.request
+from urllib.parse import unquote
+from flask import url_for
 from jsonschema import validate
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
-from sqlalchemy.exc import IntegrityError, StatementError
+from sqlalchemy.exc import IntegrityError, OperationalError, StatementError
 
 from revmusic import create_app, db
+from revmusic.constants import MASON, NDJSON, USER_PROFILE, ALBUM_PROFILE, REVIEW_PROFILE, RANKING_PRIOR_REVIEWS, TRENDING_DAYS, MAX_TOP_ALBUMS, MAX_TOP_DAYS
 from revmusic.utils import to_date, to_time, to_datetime
 from revmusic.models import User, Album, Review, Tag
+from revmusic.importer import import_albums, import_albums_cmd
+from revmusic.benchmark import benchmark_cmd
+from revmusic.asgi import AsgiApp
+from revmusic.replicas import snapshot_db_cmd
+from revmusic.caching import init_cache, source_version, FileCache
+from revmusic.mason import SERIALIZERS, RevMusicBuilder, use_serializer, dumps
 from tests.populate_test_db import populate_db
 
 # RUN WITH: $ python3 -m pytest -s tests
@@ -21,6 +39,8 @@ from tests.populate_test_db import populate_db
 
 @event.listens_for(Engine, 'connect')
 def set_sqlite_pragma(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
     cursor = dbapi_connection.cursor()
     cursor.execute('PRAGMA foreign_keys=ON')
     cursor.close()
@@ -31,13 +51,49 @@ def client():
     Setup the revmusic database for testing
     @pytest.fixture decoration ensures that all functions starting with test_ are run
     """
-    # Configure the app
+    yield from _create_client()
+
+@pytest.fixture
+def metrics_client():
+    """
+    Same as client, but with the request instrumentation enabled
+    """
+    yield from _create_client(METRICS=True)
+
+@pytest.fixture
+def replica_client():
+    """
+    Same as client, but with two SQLite read replicas. They are empty until copied from the database with snapshot-db
+    """
+    yield from _create_replica_client()
+
+@pytest.fixture
+def replica_metrics_client():
+    """
+    Same as replica_client, but with the request instrumentation enabled
+    """
+    yield from _create_replica_client(METRICS=True)
+
+def _create_replica_client(**extra_config):
+    directory = tempfile.mkdtemp()
+    clients = _create_client(SQLALCHEMY_REPLICA_URIS=['sqlite:///' + os.path.join(directory, 'replica{}.db'.format(i)) for i in range(2)], **extra_config)
+    client = next(clients)
+    yield client
+    for engine in client.application.extensions['replicas']:
+        engine.dispose()
+    next(clients, None)
+    shutil.rmtree(directory)
+
+def _create_client(**extra_config):
+    # Configure the app. The tests can be run against a database server given in REVMUSIC_TEST_DATABASE_URI,
+    # e.g. postgresql://postgres@localhost/revmusic_test. Its tables are dropped after every test
     db_fd, db_fname = tempfile.mkstemp()
     config = {
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_DATABASE_URI": os.environ.get("REVMUSIC_TEST_DATABASE_URI", "sqlite:///" + db_fname),
         "SQLALCHEMY_TRACK_MODIFICATIONS": False,
         "TESTING": True
     }
+    config.update(extra_config)
     # Create the app and add the configuration
     app = create_app(config)
     # Create the app's database
@@ -48,6 +104,11 @@ def client():
             return
     # Provides the client for tests
     yield app.test_client()
+    with app.app_context():
+        db.session.remove()
+        if "REVMUSIC_TEST_DATABASE_URI" in os.environ:
+            db.drop_all()
+        db.engine.dispose()
     # Close the temp files
     os.close(db_fd)
     os.unlink(db_fname)
@@ -165,6 +226,75 @@ def _check_control_put_method(client, body, ctrl, data):
     resp = client.put(href, json=body)
     assert resp.status_code == 201
 
+def _add_reviews(client, n=10):
+    """
+    Adds n new users and albums to the database. Every new user reviews the album 'stc is the greatest'
+    and user 'admin' reviews every new album, so each review listing grows by n items.
+    """
+    with client.application.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        stc = Album.query.filter_by(unique_name='stc is the greatest').first()
+        for i in range(n):
+            user = User(username='user{}'.format(i), email='user{}@test.com'.format(i), password='a'*64)
+            album = Album(unique_name='album {}'.format(i), title='Album {}'.format(i), artist='Artist {}'.format(i))
+            db.session.add(Review(identifier='review_user{}'.format(i), user=user, album=stc, title='a', content='a',
+                star_rating=3, submission_date=datetime.datetime(2021, 4, 1, 10, 0, i)))
+            db.session.add(Review(identifier='review_album{}'.format(i), user=admin, album=album, title='a', content='a',
+                star_rating=3, submission_date=datetime.datetime(2021, 4, 2, 10, 0, i)))
+        db.session.commit()
+
+def _asgi_requests(asgi_app, requests):
+    """
+    Sends the requests concurrently to an ASGI application. Returns the (status, headers, body) tuple of every request
+    : param AsgiApp asgi_app: the application
+    : param list requests: (method, url, headers, body) tuples
+    """
+    async def request(method, url, headers, body):
+        path, _, query = url.partition('?')
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path, 'root_path': '',
+            'query_string': query.encode('latin-1'), 'server': ('localhost', 80), 'client': ('127.0.0.1', 5000),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+        }
+        # The body arrives in two parts
+        received = [{'type': 'http.request', 'body': body[:5], 'more_body': True}, {'type': 'http.request', 'body': body[5:]}]
+        sent = []
+        async def receive():
+            return received.pop(0)
+        async def send(message):
+            sent.append(message)
+        await asgi_app(scope, receive, send)
+        assert sent[0]['type'] == 'http.response.start'
+        assert not sent[-1].get('more_body', False)
+        return (sent[0]['status'], dict((name.decode('latin-1'), value.decode('latin-1')) for name, value in sent[0]['headers']),
+                b''.join(message['body'] for message in sent[1:]))
+    async def run_all():
+        return await asyncio.gather(*(request(*args) for args in requests))
+    return asyncio.run(run_all())
+
+def _count_queries(client, url):
+    """
+    Sends a GET request to the given URL and returns the number of SQL statements executed while handling it
+    """
+    return len(_get_queries(client, url))
+
+def _get_queries(client, url):
+    """
+    Sends a GET request to the given URL and returns the SQL statements executed while handling it
+    """
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+    assert resp.status_code == 200
+    return statements
+
 #######
 # TESTS
 #######
@@ -184,6 +314,7 @@ class TestEntryPoint(object):
         # Check included controls
         _check_control_get_method(client, body, 'revmusic:reviews-all')
         _check_control_get_method(client, body, 'revmusic:albums-all')
+        _check_control_get_method(client, body, 'revmusic:albums-top')
         _check_control_get_method(client, body, 'revmusic:users-all')
 
 
@@ -299,9 +430,14 @@ class TestUserCollection(object):
         # Try to re-register same user
         resp = client.post(self.RESOURCE_URL, json=user)
         assert resp.status_code == 409
+        # Try to re-register same username, different email
+        resp = client.post(self.RESOURCE_URL, json=_get_user_json(email='other@gmail.com'))
+        assert resp.status_code == 409
+        assert 'username' in json.loads(resp.data)['@error']['@messages'][0]
         # Try to re-register different user, same email
         resp = client.post(self.RESOURCE_URL, json=_get_user_json(user='hennas'))
         assert resp.status_code == 409
+        assert 'email' in json.loads(resp.data)['@error']['@messages'][0]
 
 
 class TestUserItem(object):
@@ -409,10 +545,12 @@ class TestUserItem(object):
         user = _get_user_json(user='YTC FAN')
         resp = client.put(self.RESOURCE_URL, json=user)
         assert resp.status_code == 409
+        assert 'username' in json.loads(resp.data)['@error']['@messages'][0]
         # Try to edit to existing email
         user = _get_user_json(user='admin', email='best_rapper@gmail.com')
         resp = client.put(self.RESOURCE_URL, json=user)
         assert resp.status_code == 409
+        assert 'email' in json.loads(resp.data)['@error']['@messages'][0]
 
     def test_delete(self, client):
         print('\nTesting DELETE for {}: '.format(self.RESOURCE_NAME), end='')
@@ -473,6 +611,30 @@ class TestAlbumCollection(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_ratings(self, client):
+        print('\nTesting GET with ratings for {}: '.format(self.RESOURCE_NAME), end='')
+        for user, stars in (('admin', 2), ('ytc fan', 4)):
+            resp = client.post('/api/albums/rota/reviews/', json=_get_review_json(user=user, star_rating=stars))
+            assert resp.status_code == 201
+        body = json.loads(client.get('/api/albums/rota/').data)
+        assert (body['review_count'], body['average_rating']) == (2, 3.0)
+        assert body['rating_histogram'] == {'1': 0, '2': 1, '3': 0, '4': 1, '5': 0}
+
+        def names(query):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 200
+            return [(item['unique_name'], item['review_count'], item['average_rating']) for item in json.loads(resp.data)['items']]
+        assert names('?sortby=rating') == [('iäti vihassa ja kunniassa', 1, 5.0), ('stc is the greatest', 1, 5.0), ('rota', 2, 3.0)]
+        assert names('?sortby=reviews')[0] == ('rota', 2, 3.0)
+        assert [name for name, count, rating in names('?min_rating=4')] == ['iäti vihassa ja kunniassa', 'stc is the greatest']
+        assert names('?min_reviews=2') == [('rota', 2, 3.0)]
+        # Albums without reviews have no rating, so they sort last
+        resp = client.post(self.RESOURCE_URL, json=_get_album_json())
+        assert resp.status_code == 201
+        assert names('?sortby=rating')[-1] == (_get_album_json()['unique_name'], 0, None)
+        assert client.get(self.RESOURCE_URL + '?sortby=title').status_code == 400
+        assert client.get(self.RESOURCE_URL + '?min_rating=high').status_code == 400
+
     def test_valid_post(self, client):
         print('\nTesting valid POST for {}: '.format(self.RESOURCE_NAME), end='')
         album = _get_album_json()
@@ -582,9 +744,11 @@ class TestAlbumCollection(object):
         # Try to re-register same user
         resp = client.post(self.RESOURCE_URL, json=album)
         assert resp.status_code == 409
+        assert 'Unique name' in json.loads(resp.data)['@error']['@messages'][0]
         # Same with different unique name
         resp = client.post(self.RESOURCE_URL, json=_get_album_json(unique_name='title_artist'))
         assert resp.status_code == 409
+        assert 'with artist' in json.loads(resp.data)['@error']['@messages'][0]
 
 
 class TestAlbumItem(object):
@@ -713,10 +877,12 @@ class TestAlbumItem(object):
         album = _get_album_json(unique_name='iäti vihassa ja kunniassa')
         resp = client.put(self.RESOURCE_URL, json=album)
         assert resp.status_code == 409
+        assert 'Unique name' in json.loads(resp.data)['@error']['@messages'][0]
         # Try to edit to existing title & artist combo
         album = _get_album_json(title='Iäti Vihassa ja Kunniassa', artist='Vitsaus')
         resp = client.put(self.RESOURCE_URL, json=album)
         assert resp.status_code == 409
+        assert 'with artist' in json.loads(resp.data)['@error']['@messages'][0]
     
     def test_delete(self, client):
         print('\nTesting DELETE for {}: '.format(self.RESOURCE_NAME), end='')
@@ -767,6 +933,30 @@ class TestReviewCollection(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
     
+    def test_query_count(self, client):
+        """
+        Checks that the number of executed SQL statements does not grow with the number of listed reviews
+        """
+        print('\nTesting query count for {}: '.format(self.RESOURCE_NAME), end='')
+        filtered_url = self.RESOURCE_URL + '?filterby=album&searchword=a&timeframe=01012021'
+        before = _count_queries(client, self.RESOURCE_URL)
+        before_filtered = _count_queries(client, filtered_url)
+        _add_reviews(client)
+        assert _count_queries(client, self.RESOURCE_URL) == before
+        assert _count_queries(client, filtered_url) == before_filtered == before
+
+    def test_joins(self, client):
+        """
+        Checks that the users and the albums are joined once, also when filtering by them
+        """
+        print('\nTesting joins for {}: '.format(self.RESOURCE_NAME), end='')
+        for filterby in ('album', 'artist', 'genre', 'user', 'text'):
+            statement = _get_queries(client, self.RESOURCE_URL + '?filterby={}&searchword=a'.format(filterby))[-1]
+            assert statement.count('JOIN album') == 1
+            assert statement.count('JOIN user') == 1
+        statement = _get_queries(client, self.RESOURCE_URL)[-1]
+        assert statement.count('JOIN album') == statement.count('JOIN user') == 1
+
     def test_filtering(self, client):
         """
         Checks that correct filtering options return the correct number of results
@@ -860,6 +1050,106 @@ class TestReviewCollection(object):
         body = json.loads(resp.data)
         assert len(body['items']) == 2
 
+        # Users are matched against the reviewers, not the albums
+        _add_reviews(client)
+        resp = client.get(self.RESOURCE_URL + '?filterby=user&searchword=user')
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body['items']) == 10
+        assert all(item['user'].startswith('user') for item in body['items'])
+
+    def test_pagination(self, client):
+        """
+        Checks that the next and prev controls walk through all reviews page by page in the correct order
+        """
+        print('\nTesting GET pagination for {}: '.format(self.RESOURCE_NAME), end='')
+        _add_reviews(client)
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        all_reviews = [item['identifier'] for item in body['items']]
+        assert len(all_reviews) == 22
+
+        # Walk forwards with next
+        resp = client.get(self.RESOURCE_URL + '?page_size=5')
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert 'prev' not in body['@controls']
+        pages = [[item['identifier'] for item in body['items']]]
+        while 'next' in body['@controls']:
+            body = json.loads(client.get(body['@controls']['next']['href']).data)
+            pages.append([item['identifier'] for item in body['items']])
+        assert [len(page) for page in pages] == [5, 5, 5, 5, 2]
+        assert sum(pages, []) == all_reviews
+
+        # Walk backwards with prev
+        backwards = [[item['identifier'] for item in body['items']]]
+        while 'prev' in body['@controls']:
+            body = json.loads(client.get(body['@controls']['prev']['href']).data)
+            backwards.append([item['identifier'] for item in body['items']])
+        assert backwards[::-1] == pages
+
+        # Filters are kept in the page links
+        resp = client.get(self.RESOURCE_URL + '?filterby=album&searchword=stc&page_size=2')
+        body = json.loads(resp.data)
+        pages = [[item['identifier'] for item in body['items']]]
+        while 'next' in body['@controls']:
+            body = json.loads(client.get(body['@controls']['next']['href']).data)
+            pages.append([item['identifier'] for item in body['items']])
+        assert len(sum(pages, [])) == 11
+
+        # Invalid pagination parameters
+        resp = client.get(self.RESOURCE_URL + '?page_size=0')
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + '?page_size=5&after=notacursor')
+        assert resp.status_code == 400
+        body = json.loads(client.get(self.RESOURCE_URL + '?page_size=5').data)
+        cursor = re.search(r'after=([^&]+)', body['@controls']['next']['href']).group(1)
+        resp = client.get(self.RESOURCE_URL + '?page_size=5&after={0}&before={0}'.format(cursor))
+        assert resp.status_code == 400
+
+    def test_text_search(self, client):
+        """
+        Checks that the full-text search finds reviews by their own and their album's texts, and follows changes to them
+        """
+        print('\nTesting GET text search for {}: '.format(self.RESOURCE_NAME), end='')
+        # Find by review title and content
+        resp = client.get(self.RESOURCE_URL + '?filterby=text&searchword=posers')
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body['items']) == 1
+        assert body['items'][0]['album'] == 'Iäti Vihassa ja Kunniassa'
+
+        resp = client.get(self.RESOURCE_URL + '?filterby=text&searchword=good')
+        body = json.loads(resp.data)
+        assert len(body['items']) == 2
+
+        # Best match first, even though it is the older review
+        resp = client.get(self.RESOURCE_URL + '?filterby=text&searchword=black metal')
+        body = json.loads(resp.data)
+        assert body['items'][0]['album'] == 'Iäti Vihassa ja Kunniassa'
+        resp = client.get(self.RESOURCE_URL + '?filterby=text&searchword=good black')
+        body = json.loads(resp.data)
+        assert len(body['items']) == 1
+
+        # Find by album info and word beginnings
+        resp = client.get(self.RESOURCE_URL + '?filterby=text&searchword=nerdco')
+        body = json.loads(resp.data)
+        assert len(body['items']) == 1
+        assert body['items'][0]['album'] == 'STC is the Greatest'
+
+        # Changes to reviews and albums are reflected
+        resp = client.put('/api/albums/stc is the greatest/', json=_get_album_json('stc is the greatest', 'STC is the Greatest', 'Spamtec', genre='Chiptune'))
+        assert resp.status_code == 201
+        assert len(json.loads(client.get(self.RESOURCE_URL + '?filterby=text&searchword=nerdcore').data)['items']) == 0
+        assert len(json.loads(client.get(self.RESOURCE_URL + '?filterby=text&searchword=chiptune').data)['items']) == 1
+        resp = client.delete('/api/albums/stc is the greatest/')
+        assert resp.status_code == 204
+        assert len(json.loads(client.get(self.RESOURCE_URL + '?filterby=text&searchword=chiptune').data)['items']) == 0
+
+        # Search syntax in the search word is not interpreted
+        for searchword in ['"', 'good OR', 'NOT', '*', '(metal']:
+            resp = client.get(self.RESOURCE_URL + '?filterby=text&searchword=' + searchword)
+            assert resp.status_code == 200
+
     def test_incorrect_filtering(self, client):
         """
         Checks that correct filtering options return the correct number of results
@@ -900,6 +1190,14 @@ class TestReviewCollection(object):
         resp = client.get(self.RESOURCE_URL + '?timeframe=25032021a27032021')
         assert resp.status_code == 415
 
+        # The last representable day is a valid end of the timeframe
+        resp = client.get(self.RESOURCE_URL + '?timeframe=31129999_31129999')
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['items'] == []
+        resp = client.get(self.RESOURCE_URL + '?timeframe=01012021_31129999')
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)['items']) == len(json.loads(client.get(self.RESOURCE_URL).data)['items'])
+
         # Invalid nlatest
         resp = client.get(self.RESOURCE_URL + '?nlatest=a')
         assert resp.status_code == 400
@@ -1088,6 +1386,15 @@ class TestReviewByUser(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_query_count(self, client):
+        """
+        Checks that the number of executed SQL statements does not grow with the number of listed reviews
+        """
+        print('\nTesting query count for {}: '.format(self.RESOURCE_NAME), end='')
+        before = _count_queries(client, self.RESOURCE_URL)
+        _add_reviews(client)
+        assert _count_queries(client, self.RESOURCE_URL) == before
+
 class TestReviewsByAlbum(object):
     RESOURCE_URL = '/api/albums/stc is the greatest/reviews/'
     INVALID_URL = '/api/albums/stc is the worst/reviews/'
@@ -1125,6 +1432,15 @@ class TestReviewsByAlbum(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
     
+    def test_query_count(self, client):
+        """
+        Checks that the number of executed SQL statements does not grow with the number of listed reviews
+        """
+        print('\nTesting query count for {}: '.format(self.RESOURCE_NAME), end='')
+        before = _count_queries(client, self.RESOURCE_URL)
+        _add_reviews(client)
+        assert _count_queries(client, self.RESOURCE_URL) == before
+
     def test_valid_post(self, client):
         print('\nTesting valid POST for {}: '.format(self.RESOURCE_NAME), end='')
         review = _get_review_json(user='admin')
@@ -1207,3 +1523,862 @@ class TestReviewsByAlbum(object):
         review = _get_review_json(user='admin')
         resp = client.post(self.INVALID_URL, json=review)
         assert resp.status_code == 404
+
+class TestReviewBulk(object):
+    RESOURCE_URL = '/api/reviews/bulk'
+    RESOURCE_NAME = 'ReviewBulk'
+
+    def _get_rows(self):
+        """
+        Returns bulk rows of which the first two are valid
+        """
+        return [
+            dict(_get_review_json(user='admin'), album='rota'),
+            dict(_get_review_json(user='YTC fan'), album='rota'),
+            dict(_get_review_json(user='ytc fan'), album='stc is the greatest'), # Already reviewed
+            dict(_get_review_json(user='admin'), album='rota'), # Twice in the batch
+            dict(_get_review_json(user='nobody'), album='rota'),
+            dict(_get_review_json(user='admin'), album='nothing'),
+            dict(_get_review_json(user='admin', star_rating=6), album='rota'),
+            _get_review_json(user='admin')
+        ]
+
+    def _check_response(self, client, resp):
+        """
+        Checks the response to the rows from _get_rows
+        """
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method(client, body, 'revmusic:reviews-all')
+        assert body['created'] == 2
+        assert body['failed'] == 6
+        assert [item['index'] for item in body['items']] == [0, 1]
+        for item in body['items']:
+            _check_control_get_method(client, item, 'self')
+        assert [(error['index'], error['status']) for error in body['errors']] == [(2, 409), (3, 409), (4, 404), (5, 404), (6, 400), (7, 400)]
+        body = json.loads(client.get('/api/albums/rota/reviews/').data)
+        assert sorted(item['user'] for item in body['items']) == ['admin', 'ytc fan']
+
+    def test_valid_post(self, client):
+        print('\nTesting valid POST for {}: '.format(self.RESOURCE_NAME), end='')
+        # The control is found from the review collection
+        body = json.loads(client.get('/api/reviews/').data)
+        _check_control_present(client, body, 'revmusic:add-reviews')
+        assert body['@controls']['revmusic:add-reviews']['href'] == self.RESOURCE_URL
+        validate(self._get_rows()[:2], body['@controls']['revmusic:add-reviews']['schema'])
+
+        resp = client.post(self.RESOURCE_URL, json=self._get_rows())
+        self._check_response(client, resp)
+
+    def test_ndjson_post(self, client):
+        print('\nTesting NDJSON POST for {}: '.format(self.RESOURCE_NAME), end='')
+        lines = [json.dumps(row) for row in self._get_rows()[:7]] + ['', '{"user": broken']
+        resp = client.post(self.RESOURCE_URL, data='\n'.join(lines), content_type='application/x-ndjson')
+        self._check_response(client, resp)
+
+    def test_wrong_mediatype_post(self, client):
+        print('\nTesting wrong mediatype POST for {}: '.format(self.RESOURCE_NAME), end='')
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(self._get_rows()))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json=self._get_rows()[0])
+        assert resp.status_code == 415
+
+class TestTopAlbums(object):
+    RESOURCE_URL = '/api/albums/top'
+    RESOURCE_NAME = 'TopAlbums'
+
+    @staticmethod
+    def _ranking(client, query=''):
+        resp = client.get(TestTopAlbums.RESOURCE_URL + query)
+        assert resp.status_code == 200
+        return [(item['unique_name'], item['review_count'], item['score']) for item in json.loads(resp.data)['items']]
+
+    def test_get(self, client):
+        print('\nTesting GET for {}: '.format(self.RESOURCE_NAME), end='')
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method(client, body, 'self')
+        _check_control_get_method(client, body, 'revmusic:albums-all')
+        for item in body['items']:
+            _check_control_get_method(client, item, 'self')
+            _check_control_get_method(client, item, 'profile')
+        # Albums without reviews are not ranked. The mean of all ratings is 5, so both albums score 5
+        assert (body['rankby'], body['days']) == ('rating', None)
+        assert self._ranking(client) == [('iäti vihassa ja kunniassa', 1, 5.0), ('stc is the greatest', 1, 5.0)]
+        # An album named "top" is still found under its own URL
+        resp = client.post('/api/albums/', json=_get_album_json('top', 'Top', 'Band'))
+        assert resp.status_code == 201
+        assert json.loads(client.get('/api/albums/top/').data)['title'] == 'Top'
+
+    def test_bayesian_rating(self, client):
+        print('\nTesting Bayesian rating ranking for {}: '.format(self.RESOURCE_NAME), end='')
+        # Many four star reviews beat a single five star review, as the mean is pulled down by a poorly rated album
+        assert client.post('/api/albums/', json=_get_album_json()).status_code == 201
+        for i in range(20):
+            user = 'user{}'.format(i)
+            assert client.post('/api/users/', json=_get_user_json(user, '{}@a.com'.format(user))).status_code == 201
+            assert client.post('/api/albums/rota/reviews/', json=_get_review_json(user=user, star_rating=4)).status_code == 201
+            resp = client.post('/api/albums/{}/reviews/'.format(_get_album_json()['unique_name']), json=_get_review_json(user=user, star_rating=2))
+            assert resp.status_code == 201
+        ranking = self._ranking(client)
+        assert [name for name, count, score in ranking] == ['rota', 'iäti vihassa ja kunniassa', 'stc is the greatest', _get_album_json()['unique_name']]
+        mean = (2 * 5 + 20 * 4 + 20 * 2) / 42
+        assert ranking[0][2] == round((mean * RANKING_PRIOR_REVIEWS + 80) / (RANKING_PRIOR_REVIEWS + 20), 3)
+        assert ranking[1][2] == round((mean * RANKING_PRIOR_REVIEWS + 5) / (RANKING_PRIOR_REVIEWS + 1), 3)
+        # Filters
+        assert [name for name, count, score in self._ranking(client, '?genre=NERDCORE')] == ['stc is the greatest']
+        assert [name for name, count, score in self._ranking(client, '?artist=wyrd')] == ['rota']
+        assert len(self._ranking(client, '?limit=2')) == 2
+
+    def test_time_window(self, client):
+        print('\nTesting time windows for {}: '.format(self.RESOURCE_NAME), end='')
+        # The test reviews were submitted in 2021, so the last week has none
+        assert self._ranking(client, '?rankby=trending') == []
+        assert self._ranking(client, '?days=7') == []
+        for user, album in (('admin', 'rota'), ('ytc fan', 'rota'), ('admin', 'stc is the greatest')):
+            assert client.post('/api/albums/{}/reviews/'.format(album), json=_get_review_json(user=user, star_rating=3)).status_code == 201
+        body = json.loads(client.get(self.RESOURCE_URL + '?rankby=trending').data)
+        assert (body['rankby'], body['days']) == ('trending', TRENDING_DAYS)
+        assert [(item['unique_name'], item['review_count'], item['score']) for item in body['items']] == [
+            ('rota', 2, round(2 / TRENDING_DAYS, 3)), ('stc is the greatest', 1, round(1 / TRENDING_DAYS, 3))
+        ]
+        # Within the window only the new reviews count
+        assert self._ranking(client, '?days=1') == [('rota', 2, 3.0), ('stc is the greatest', 1, 3.0)]
+        # Deleting a review removes it from the window. Ties are broken by the average rating, then by the age of the album
+        resp = client.delete('/api/users/ytc fan/')
+        assert resp.status_code == 204
+        assert self._ranking(client, '?rankby=trending&days=1') == [('stc is the greatest', 1, 1.0), ('rota', 1, 1.0)]
+
+    def test_invalid(self, client):
+        print('\nTesting invalid GET for {}: '.format(self.RESOURCE_NAME), end='')
+        for query in ['?rankby=popularity', '?days=0', '?days=week', '?limit=0', '?limit={}'.format(MAX_TOP_ALBUMS + 1),
+                      '?days={}'.format(MAX_TOP_DAYS + 1), '?days=1000000', '?rankby=trending&days=1000000']:
+            assert client.get(self.RESOURCE_URL + query).status_code == 400
+        assert client.get(self.RESOURCE_URL + '?days={}'.format(MAX_TOP_DAYS)).status_code == 200
+
+    def test_conditional(self, client):
+        print('\nTesting conditional GET for {}: '.format(self.RESOURCE_NAME), end='')
+        etag = client.get(self.RESOURCE_URL).headers['ETag']
+        assert client.get(self.RESOURCE_URL, headers={'If-None-Match': etag}).status_code == 304
+        assert client.post('/api/albums/rota/reviews/', json=_get_review_json(user='admin')).status_code == 201
+        assert client.get(self.RESOURCE_URL, headers={'If-None-Match': etag}).status_code == 200
+
+
+class TestAlbumBulk(object):
+    RESOURCE_URL = '/api/albums/bulk'
+    RESOURCE_NAME = 'AlbumBulk'
+
+    def _get_rows(self):
+        """
+        Returns album rows: a new album, a replacement for 'rota', an invalid album and an album conflicting with an existing one
+        """
+        return [
+            _get_album_json(),
+            _get_album_json('ROTA', 'Rota', 'Wyrd', genre='Folk Metal'),
+            _get_album_json('broken', release='2001-02-31'),
+            _get_album_json('stc 2', 'STC is the Greatest', 'Spamtec')
+        ]
+
+    def _check_albums(self, client):
+        """
+        Checks that the rows from _get_rows have been imported
+        """
+        body = json.loads(client.get('/api/albums/').data)
+        assert sorted(item['unique_name'] for item in body['items']) == ['iäti vihassa ja kunniassa', 'rota', 'stc is the greatest', 'test']
+        body = json.loads(client.get('/api/albums/rota/').data)
+        assert body['genre'] == 'Folk Metal'
+        assert body['release'] == '2001-04-25'
+
+    def test_valid_post(self, client):
+        print('\nTesting valid POST for {}: '.format(self.RESOURCE_NAME), end='')
+        body = json.loads(client.get('/api/albums/').data)
+        _check_control_present(client, body, 'revmusic:import-albums')
+        assert body['@controls']['revmusic:import-albums']['href'] == self.RESOURCE_URL
+
+        resp = client.post(self.RESOURCE_URL, json=self._get_rows())
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method(client, body, 'revmusic:albums-all')
+        assert body['imported'] == 2
+        assert body['failed'] == 2
+        assert [error['index'] for error in body['errors']] == [2, 3]
+        self._check_albums(client)
+        # An album named "bulk" is still found under its own URL
+        resp = client.post('/api/albums/', json=_get_album_json('bulk', 'Bulk', 'Band'))
+        assert resp.status_code == 201
+        assert json.loads(client.get('/api/albums/bulk/').data)['title'] == 'Bulk'
+
+    def test_csv_post(self, client):
+        print('\nTesting CSV POST for {}: '.format(self.RESOURCE_NAME), end='')
+        lines = ['unique_name,title,artist,release,duration,genre']
+        lines += [','.join(row[key] for key in ['unique_name', 'title', 'artist', 'release', 'duration', 'genre']) for row in self._get_rows()]
+        resp = client.post(self.RESOURCE_URL, data='\n'.join(lines), content_type='text/csv')
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body['imported'] == 2
+        assert body['failed'] == 2
+        self._check_albums(client)
+
+    def test_wrong_mediatype_post(self, client):
+        print('\nTesting wrong mediatype POST for {}: '.format(self.RESOURCE_NAME), end='')
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(self._get_rows()))
+        assert resp.status_code == 415
+
+    def test_import_command(self, client):
+        print('\nTesting import-albums command: ', end='')
+        fd, fname = tempfile.mkstemp(suffix='.ndjson')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(json.dumps(row) for row in self._get_rows()))
+        try:
+            result = client.application.test_cli_runner().invoke(import_albums_cmd, [fname, '--batch-size', '2'])
+        finally:
+            os.unlink(fname)
+        assert result.exit_code == 0
+        assert 'Imported 2 albums, 2 failed' in result.output
+        self._check_albums(client)
+
+    def test_failed_import(self, client):
+        print('\nTesting failed import for {}: '.format(self.RESOURCE_NAME), end='')
+        def rows():
+            yield _get_album_json()
+            yield _get_album_json('other', 'Other', 'Band')
+            raise OSError('Connection reset')
+        with client.application.app_context():
+            # The batches written before the failure are rolled back with the rest
+            with pytest.raises(OSError):
+                import_albums(rows(), batch_size=1)
+            db.session.rollback()
+            assert Album.query.filter(Album.unique_name.in_(['test', 'other'])).count() == 0
+            db.session.remove()
+        assert client.get('/api/albums/test/').status_code == 404
+
+class TestConditionalGet(object):
+    RESOURCE_NAME = 'conditional GET'
+
+    def test_etag(self, client):
+        print('\nTesting {}: '.format(self.RESOURCE_NAME), end='')
+        for url in ['/api/', '/api/users/', '/api/users/admin/', '/api/albums/', '/api/albums/rota/',
+                    '/api/reviews/', '/api/albums/rota/reviews/', '/api/users/admin/reviews/']:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            etag = resp.headers['ETag']
+            assert resp.headers['Cache-Control'] == 'no-cache'
+            resp = client.get(url, headers={'If-None-Match': etag})
+            assert resp.status_code == 304
+            assert resp.data == b''
+            assert resp.headers['ETag'] == etag
+            resp = client.get(url, headers={'If-None-Match': '"something else"'})
+            assert resp.status_code == 200
+
+        # Errors don't get validators
+        resp = client.get('/api/albums/nothing/')
+        assert resp.status_code == 404
+        assert 'ETag' not in resp.headers
+
+        # Different query parameters give different ETags
+        assert client.get('/api/reviews/').headers['ETag'] != client.get('/api/reviews/?nlatest=1').headers['ETag']
+
+    def test_representations(self, client):
+        print('\nTesting {} with NDJSON: '.format(self.RESOURCE_NAME), end='')
+        resp = client.get('/api/reviews/')
+        etag = resp.headers['ETag']
+        assert 'Accept' in resp.headers['Vary']
+        # The NDJSON representation of the same URL has its own ETag, so the Mason one is not reused for it
+        resp = client.get('/api/reviews/', headers={'Accept': NDJSON, 'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert resp.mimetype == NDJSON
+        assert resp.headers['ETag'] != etag
+        assert 'Accept' in resp.headers['Vary']
+        resp = client.get('/api/reviews/', headers={'Accept': NDJSON, 'If-None-Match': resp.headers['ETag']})
+        assert resp.status_code == 304
+        assert 'Accept' in resp.headers['Vary']
+        # The Mason representation still validates with its own ETag
+        assert client.get('/api/reviews/', headers={'If-None-Match': etag}).status_code == 304
+
+    def test_version(self, client):
+        print('\nTesting {} across deployments: '.format(self.RESOURCE_NAME), end='')
+        # By default the version of the representations is a hash of the source code
+        assert client.application.config['REPRESENTATION_VERSION'] == source_version()
+        etag = client.get('/api/').headers['ETag']
+        assert client.get('/api/', headers={'If-None-Match': etag}).status_code == 304
+        # A deployment with other representations doesn't validate the documents cached from the earlier one
+        client.application.config['REPRESENTATION_VERSION'] = 'next'
+        resp = client.get('/api/', headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] != etag
+
+    def test_changes(self, client):
+        print('\nTesting {} after changes: '.format(self.RESOURCE_NAME), end='')
+        reviews_etag = client.get('/api/reviews/').headers['ETag']
+        album_etag = client.get('/api/albums/rota/').headers['ETag']
+        user_etag = client.get('/api/users/ytc fan/').headers['ETag']
+        resp = client.post('/api/albums/rota/reviews/', json=_get_review_json(user='admin'))
+        assert resp.status_code == 201
+        resp = client.get('/api/reviews/', headers={'If-None-Match': reviews_etag})
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] != reviews_etag
+        assert len(json.loads(resp.data)['items']) == 3
+        # The rating of the album changed
+        resp = client.get('/api/albums/rota/', headers={'If-None-Match': album_etag})
+        assert resp.status_code == 200
+        # Users did not change
+        resp = client.get('/api/users/ytc fan/', headers={'If-None-Match': user_etag})
+        assert resp.status_code == 304
+        # Changing a user changes the review listings, which show usernames
+        reviews_etag = client.get('/api/reviews/').headers['ETag']
+        resp = client.put('/api/users/admin/', json=_get_user_json('admin', 'root@admin.com'))
+        assert resp.status_code == 201
+        assert client.get('/api/reviews/', headers={'If-None-Match': reviews_etag}).status_code == 200
+
+    def test_last_modified(self, client):
+        print('\nTesting {} with Last-Modified: '.format(self.RESOURCE_NAME), end='')
+        resp = client.get('/api/albums/')
+        last_modified = resp.headers['Last-Modified']
+        resp = client.get('/api/albums/', headers={'If-Modified-Since': last_modified})
+        assert resp.status_code == 304
+        resp = client.get('/api/albums/', headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+        assert resp.status_code == 200
+
+    def test_no_counters(self, client):
+        print('\nTesting {} without change counters: '.format(self.RESOURCE_NAME), end='')
+        etag = client.get('/api/albums/').headers['ETag']
+        # Databases other than SQLite and PostgreSQL have no change counters, so nothing can be validated
+        with client.application.app_context():
+            db.session.execute('DELETE FROM data_version')
+            db.session.commit()
+        resp = client.get('/api/albums/', headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert 'ETag' not in resp.headers
+        assert 'Last-Modified' not in resp.headers
+
+class TestResponseCache(object):
+    RESOURCE_NAME = 'response cache'
+
+    @staticmethod
+    def _enable_cache(client, backend, directory=None):
+        """
+        Configures a response cache for the app of the client
+        """
+        client.application.config['RESPONSE_CACHE'] = backend
+        client.application.config['RESPONSE_CACHE_SIZE'] = 16
+        client.application.config['RESPONSE_CACHE_DIR'] = directory
+        init_cache(client.application)
+
+    @staticmethod
+    def _rename_album_directly(client, album, title):
+        """
+        Changes an album without going through the API, so the cache is not told about the change
+        """
+        with client.application.app_context():
+            Album.query.filter_by(unique_name=album).first().title = title
+            db.session.commit()
+
+    def _check_invalidation(self, client):
+        resp = client.get('/api/albums/rota/')
+        assert json.loads(resp.data)['title'] == 'Rota'
+        assert json.loads(client.get('/api/albums/stc is the greatest/').data)['title'] == 'STC is the Greatest'
+        reviews = client.get('/api/reviews/').data
+        self._rename_album_directly(client, 'rota', 'Stale')
+        self._rename_album_directly(client, 'stc is the greatest', 'Stale')
+        # Served from the cache, byte for byte
+        resp = client.get('/api/albums/rota/')
+        assert json.loads(resp.data)['title'] == 'Rota'
+        assert client.get('/api/reviews/').data == reviews
+        # Query parameters in another order hit the same entry
+        first = client.get('/api/reviews/?filterby=album&nlatest=1').data
+        assert client.get('/api/reviews/?nlatest=1&filterby=album').data == first
+        # A new review invalidates the review listings and the rating of its album, but not the other albums
+        resp = client.post('/api/albums/rota/reviews/', json=_get_review_json(user='admin'))
+        assert resp.status_code == 201
+        body = json.loads(client.get('/api/reviews/').data)
+        assert len(body['items']) == 3
+        body = json.loads(client.get('/api/albums/rota/').data)
+        assert (body['title'], body['review_count']) == ('Stale', 1)
+        assert json.loads(client.get('/api/albums/stc is the greatest/').data)['title'] == 'STC is the Greatest'
+        # Editing the album through the API invalidates it
+        resp = client.put('/api/albums/rota/', json=_get_album_json('rota', 'Rota', 'Stam1na'))
+        assert resp.status_code == 201
+        assert json.loads(client.get('/api/albums/rota/').data)['artist'] == 'Stam1na'
+        # Errors are not cached
+        assert client.get('/api/albums/nothing/').status_code == 404
+        resp = client.post('/api/albums/', json=_get_album_json('nothing', 'Nothing', 'No one'))
+        assert resp.status_code == 201
+        assert client.get('/api/albums/nothing/').status_code == 200
+        # Deleting the user removes its reviews from the listings
+        resp = client.delete('/api/users/admin/')
+        assert resp.status_code == 204
+        assert client.get('/api/users/admin/').status_code == 404
+        body = json.loads(client.get('/api/reviews/').data)
+        assert all(item['user'] != 'admin' for item in body['items'])
+
+    def test_lru(self, client):
+        print('\nTesting {} in memory: '.format(self.RESOURCE_NAME), end='')
+        self._enable_cache(client, 'lru')
+        self._check_invalidation(client)
+        # The least recently used entries are dropped
+        for i in range(20):
+            client.get('/api/reviews/?nlatest={}'.format(i + 1))
+        assert len(client.application.extensions['response_cache'].entries) == 16
+
+    def test_file(self, client):
+        print('\nTesting {} in files: '.format(self.RESOURCE_NAME), end='')
+        with tempfile.TemporaryDirectory() as directory:
+            self._enable_cache(client, 'file', directory)
+            self._check_invalidation(client)
+            assert len(os.listdir(os.path.join(directory, 'entries'))) > 0
+            # Another process sharing the directory sees the invalidations
+            other = FileCache(directory)
+            client.get('/api/albums/rota/')
+            self._rename_album_directly(client, 'rota', 'Fresh')
+            assert json.loads(client.get('/api/albums/rota/').data)['title'] != 'Fresh'
+            other.invalidate(['album:rota'])
+            assert json.loads(client.get('/api/albums/rota/').data)['title'] == 'Fresh'
+            # Nor are the responses cached by an earlier deployment served
+            self._rename_album_directly(client, 'rota', 'Redeployed')
+            client.application.config['REPRESENTATION_VERSION'] = 'next'
+            assert json.loads(client.get('/api/albums/rota/').data)['title'] == 'Redeployed'
+            # The least recently used entries are removed
+            for i in range(20):
+                client.get('/api/reviews/?nlatest={}'.format(i + 1))
+            assert len(os.listdir(os.path.join(directory, 'entries'))) == 16
+
+    def test_file_eviction(self, client):
+        print('\nTesting {} file eviction: '.format(self.RESOURCE_NAME), end='')
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory, maxsize=2)
+            value = (200, [('Content-Type', 'text/plain')], b'x')
+            for key in ['a', 'b']:
+                cache.set(key, value, {})
+                # Modification times have a coarse resolution
+                time.sleep(0.05)
+            assert cache.get('a') == value
+            time.sleep(0.05)
+            cache.set('c', value, {})
+            assert (cache.get('a'), cache.get('b'), cache.get('c')) == (value, None, value)
+            assert len(os.listdir(os.path.join(directory, 'entries'))) == 2
+
+class TestStreaming(object):
+    RESOURCE_NAME = 'streamed collections'
+    URLS = ['/api/users/', '/api/albums/', '/api/reviews/', '/api/reviews/?nlatest=5', '/api/reviews/?filterby=text&searchword=greatest',
+            '/api/albums/stc is the greatest/reviews/', '/api/users/admin/reviews/']
+
+    def test_mason(self, client):
+        print('\nTesting {} as Mason: '.format(self.RESOURCE_NAME), end='')
+        _add_reviews(client, 10)
+        for url in self.URLS:
+            expected = client.get(url)
+            resp = client.get(url + ('&' if '?' in url else '?') + 'stream=true')
+            assert resp.status_code == 200
+            assert resp.mimetype == MASON
+            assert 'Content-Length' not in resp.headers
+            # The streamed document is byte for byte the same
+            assert resp.data == expected.data
+        # Empty collection
+        resp = client.post('/api/albums/', json=_get_album_json())
+        assert resp.status_code == 201
+        resp = client.get('/api/albums/test/reviews/?stream=1')
+        assert json.loads(resp.data)['items'] == []
+        assert resp.data == client.get('/api/albums/test/reviews/').data
+
+    def test_ndjson(self, client):
+        print('\nTesting {} as NDJSON: '.format(self.RESOURCE_NAME), end='')
+        _add_reviews(client, 10)
+        for url in self.URLS:
+            expected = json.loads(client.get(url).data)['items']
+            resp = client.get(url, headers={'Accept': NDJSON})
+            assert resp.status_code == 200
+            assert resp.mimetype == NDJSON
+            lines = resp.data.decode('utf-8').splitlines()
+            assert [json.loads(line) for line in lines] == expected
+        # Errors are still Mason
+        resp = client.get('/api/users/nobody/reviews/', headers={'Accept': NDJSON})
+        assert resp.status_code == 404
+        assert resp.mimetype == MASON
+        # Mason is preferred unless NDJSON is asked for
+        assert client.get('/api/users/', headers={'Accept': '*/*'}).mimetype == MASON
+
+class TestSerializer(object):
+    RESOURCE_NAME = 'JSON serializers'
+
+    def test_same_output(self, client):
+        print('\nTesting {}: '.format(self.RESOURCE_NAME), end='')
+        _add_reviews(client, 3)
+        urls = ['/api/', '/api/users/', '/api/albums/', '/api/albums/rota/', '/api/reviews/', '/api/users/admin/reviews/',
+                '/api/albums/nothing/', '/api/reviews/?stream=true']
+        outputs = {}
+        try:
+            for name in SERIALIZERS:
+                use_serializer(name)
+                outputs[name] = [client.get(url).data for url in urls]
+        finally:
+            use_serializer('auto')
+        # Every available serializer gives the same bytes
+        assert all(output == outputs['json'] for output in outputs.values())
+
+        # Dates and times are serialized in the same format as they are given to the API
+        body = json.loads(client.get('/api/albums/stc is the greatest/').data)
+        assert body['release'] == '2004-01-01'
+        assert body['duration'] == '01:01:00'
+        assert json.loads(client.get('/api/albums/rota/').data)['release'] is None
+        body = json.loads(client.get('/api/reviews/').data)
+        for item in body['items']:
+            assert re.match(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$', item['submission_date'])
+        assert dumps({'a': datetime.datetime(2021, 4, 1, 10, 0, 5, 123), 'b': None, 'c': 'ä'}) == \
+            '{"a":"2021-04-01 10:00:05","b":null,"c":"ä"}'.encode('utf-8')
+        with pytest.raises(TypeError):
+            dumps({'a': object()})
+        with pytest.raises(ValueError):
+            use_serializer('nothing')
+
+class TestUrlTemplates(object):
+    RESOURCE_NAME = 'URL templates'
+    VALUES = ['rota', 'stc is the greatest', 'iäti vihassa ja kunniassa', 'a/b', '100%?#&=+', "'\"<>", '日本', '__album__']
+
+    def test_same_as_url_for(self, client):
+        print('\nTesting {}: '.format(self.RESOURCE_NAME), end='')
+        for base_url in ['http://localhost/', 'http://localhost/prefix/']:
+            with client.application.test_request_context('/', base_url=base_url):
+                album_url = RevMusicBuilder.url_template('api.albumitem', 'album')
+                review_url = RevMusicBuilder.url_template('api.reviewitem', 'album', 'review')
+                assert RevMusicBuilder.url_template('api.albumitem', 'album') is album_url
+                for value in self.VALUES:
+                    assert album_url(album=value) == url_for('api.albumitem', album=value)
+                    assert review_url(album=value, review=value[::-1]) == url_for('api.reviewitem', album=value, review=value[::-1])
+
+    def test_listings(self, client):
+        print('\nTesting {} in listings: '.format(self.RESOURCE_NAME), end='')
+        # The test client can't send an escaped '?' or '#' in the path
+        for i, value in enumerate(['100% &=+', "'\"<>", '日本', '__album__']):
+            resp = client.post('/api/albums/', json=_get_album_json(value, 'Title {}'.format(i), 'Artist'))
+            assert resp.status_code == 201
+            with client.application.test_request_context('/'):
+                resp = client.post(url_for('api.reviewsbyalbum', album=value), json=_get_review_json(user='admin'))
+            assert resp.status_code == 201
+        resp = client.post('/api/users/', json=_get_user_json('ä ö?%'))
+        assert resp.status_code == 201
+        urls = ['/api/users/', '/api/albums/', '/api/reviews/', '/api/users/admin/reviews/', '/api/albums/100%25%20&=+/reviews/']
+        with client.application.test_request_context('/'):
+            for url in urls:
+                resp = client.get(url)
+                body = json.loads(resp.data)
+                assert body['items']
+                for item in body['items']:
+                    # The controls are byte for byte the same as when built with add_control and url_for
+                    expected = RevMusicBuilder()
+                    if 'username' in item:
+                        expected.add_control('self', url_for('api.useritem', user=item['username']))
+                        expected.add_control('profile', USER_PROFILE)
+                    elif 'unique_name' in item:
+                        expected.add_control('self', url_for('api.albumitem', album=item['unique_name']))
+                        expected.add_control('profile', ALBUM_PROFILE)
+                    else:
+                        album = re.match(r'^/api/albums/([^/]+)/', item['@controls']['self']['href']).group(1)
+                        expected.add_control('self', url_for('api.reviewitem', album=unquote(album), review=item['identifier']))
+                        expected.add_control('profile', REVIEW_PROFILE)
+                    assert dumps(item['@controls']) == dumps(expected['@controls'])
+
+class TestMetrics(object):
+    RESOURCE_NAME = 'metrics'
+
+    def test_server_timing(self, metrics_client):
+        print('\nTesting {} in Server-Timing: '.format(self.RESOURCE_NAME), end='')
+        resp = metrics_client.get('/api/reviews/')
+        assert resp.status_code == 200
+        timing = resp.headers['Server-Timing']
+        match = re.match(r'^db;dur=([\d.]+);desc="(\d+) queries", serialize;dur=([\d.]+), total;dur=([\d.]+)$', timing)
+        assert match
+        # Data versions for the ETag and the reviews with their users and albums
+        assert int(match.group(2)) == 2
+        assert float(match.group(1)) <= float(match.group(4))
+        assert float(match.group(3)) > 0
+        # Not found and errors are measured too
+        assert 'Server-Timing' in metrics_client.get('/api/albums/nothing/').headers
+        assert 'Server-Timing' in metrics_client.get('/api/nothing/').headers
+
+    def test_prometheus(self, metrics_client):
+        print('\nTesting {} in Prometheus format: '.format(self.RESOURCE_NAME), end='')
+        for i in range(3):
+            size = len(metrics_client.get('/api/users/').data)
+        metrics_client.get('/api/users/nobody/')
+        resp = metrics_client.get('/api/_metrics')
+        assert resp.status_code == 200
+        assert resp.mimetype == 'text/plain'
+        text = resp.data.decode('utf-8')
+        labels = 'endpoint="api.usercollection",method="GET",status="200"'
+        assert 'revmusic_requests_total{{{}}} 3\n'.format(labels) in text
+        assert 'revmusic_db_queries_total{{{}}} 6\n'.format(labels) in text
+        assert 'revmusic_response_bytes_total{{{}}} {}\n'.format(labels, size * 3) in text
+        assert 'revmusic_request_duration_seconds_bucket{{{},le="+Inf"}} 3\n'.format(labels) in text
+        assert 'revmusic_requests_total{endpoint="api.useritem",method="GET",status="404"} 1\n' in text
+        # Every sample line is well formed
+        for line in text.splitlines():
+            assert line.startswith('# ') or re.match(r'^revmusic_[a-z_]+\{[^}]*\} [\d.e+-]+$', line)
+
+    def test_replicas(self, replica_metrics_client):
+        print('\nTesting {} with read replicas: '.format(self.RESOURCE_NAME), end='')
+        client = replica_metrics_client
+        paths = [uri[len('sqlite:///'):] for uri in client.application.config['SQLALCHEMY_REPLICA_URIS']]
+        assert client.application.test_cli_runner().invoke(snapshot_db_cmd, paths).exit_code == 0
+        # The queries of the reads are counted, whichever replica they go to
+        for i in range(3):
+            resp = client.get('/api/users/')
+            assert resp.status_code == 200
+            assert 'desc="2 queries"' in resp.headers['Server-Timing']
+        text = client.get('/api/_metrics').data.decode('utf-8')
+        assert 'revmusic_db_queries_total{endpoint="api.usercollection",method="GET",status="200"} 6\n' in text
+
+    def test_disabled(self, client):
+        print('\nTesting {} disabled: '.format(self.RESOURCE_NAME), end='')
+        assert 'Server-Timing' not in client.get('/api/users/').headers
+        assert client.get('/api/_metrics').status_code == 404
+
+class TestAsgi(object):
+    RESOURCE_NAME = 'ASGI serving mode'
+    URLS = ['/api/', '/api/users/', '/api/users/admin/', '/api/albums/', '/api/albums/?sortby=rating', '/api/albums/top',
+            '/api/albums/stc is the greatest/', '/api/albums/stc%20is%20the%20greatest/reviews/', '/api/reviews/?nlatest=5',
+            '/api/users/admin/reviews/', '/api/reviews/?stream=true', '/api/users/nobody/']
+
+    def test_get(self, client):
+        print('\nTesting {} GET: '.format(self.RESOURCE_NAME), end='')
+        _add_reviews(client, 10)
+        asgi_app = AsgiApp(client.application, max_threads=2)
+        requests = [(('GET', unquote(url), {}, b'')) for url in self.URLS]
+        requests.append(('GET', '/api/users/', {'Accept': NDJSON}, b''))
+        responses = _asgi_requests(asgi_app, requests)
+        for (method, url, headers, body), (status, resp_headers, data) in zip(requests, responses):
+            expected = client.get(url, headers=headers)
+            # Same status, headers and bytes as with WSGI
+            assert status == expected.status_code
+            assert resp_headers == dict((name.lower(), value) for name, value in expected.headers.items())
+            assert data == expected.data
+        asgi_app.close()
+
+    def test_write(self, client):
+        print('\nTesting {} writes: '.format(self.RESOURCE_NAME), end='')
+        asgi_app = AsgiApp(client.application)
+        user = json.dumps(_get_user_json()).encode('utf-8')
+        (status, headers, data), = _asgi_requests(asgi_app, [('POST', '/api/users/', {'Content-Type': 'application/json'}, user)])
+        assert status == 201
+        assert headers['location'].endswith('/api/users/itsame/')
+        assert client.get('/api/users/itsame/').status_code == 200
+        (status, headers, data), = _asgi_requests(asgi_app, [('POST', '/api/users/', {'Content-Type': 'application/json'}, user)])
+        assert status == 409
+        assert json.loads(data)['@error']['@message'] == 'Already exists'
+        asgi_app.close()
+
+    def test_lifespan(self, client):
+        print('\nTesting {} lifespan: '.format(self.RESOURCE_NAME), end='')
+        asgi_app = AsgiApp(client.application)
+        received = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+        async def receive():
+            return received.pop(0)
+        async def send(message):
+            sent.append(message)
+        asyncio.run(asgi_app({'type': 'lifespan'}, receive, send))
+        assert [message['type'] for message in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+        # The worker threads are stopped
+        with pytest.raises(RuntimeError):
+            asgi_app.executor.submit(print)
+
+    def test_shutdown_during_request(self, client):
+        print('\nTesting {} shutdown during requests: '.format(self.RESOURCE_NAME), end='')
+        app = client.application
+        wsgi_app = app.wsgi_app
+        def slow_app(environ, start_response):
+            time.sleep(0.5)
+            return wsgi_app(environ, start_response)
+        asgi_app = AsgiApp(app)
+        sent = {'finished': [], 'cancelled': [], 'lifespan': []}
+
+        async def request(name):
+            scope = {'type': 'http', 'method': 'GET', 'path': '/api/users/', 'query_string': b'', 'headers': []}
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+            async def send(message):
+                sent[name].append(message)
+            await asgi_app(scope, receive, send)
+
+        async def run():
+            finished = asyncio.ensure_future(request('finished'))
+            # Cancelled like a server gives up on the requests when its graceful shutdown times out
+            cancelled = asyncio.ensure_future(request('cancelled'))
+            await asyncio.sleep(0.1)
+            cancelled.cancel()
+            received = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+            async def receive():
+                return received.pop(0)
+            async def send(message):
+                sent['lifespan'].append(message)
+            await asgi_app({'type': 'lifespan'}, receive, send)
+            await finished
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+
+        app.wsgi_app = slow_app
+        try:
+            # Run in a thread, so a deadlock fails the test instead of hanging it
+            thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+            thread.start()
+            thread.join(10)
+            assert not thread.is_alive()
+        finally:
+            app.wsgi_app = wsgi_app
+        assert [message['type'] for message in sent['lifespan']] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+        # The request being handled is answered before the shutdown completes, the cancelled one is not
+        assert sent['finished'][0]['status'] == 200
+        assert not sent['finished'][-1].get('more_body', False)
+        assert sent['cancelled'] == []
+
+class TestServe(object):
+    RESOURCE_NAME = 'preforking launcher'
+    URLS = ['/api/', '/api/users/', '/api/albums/', '/api/reviews/?nlatest=5', '/api/albums/top']
+
+    def test_serve(self, client):
+        print('\nTesting {}: '.format(self.RESOURCE_NAME), end='')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, REVMUSIC_DATABASE_URI=client.application.config['SQLALCHEMY_DATABASE_URI'], PYTHONUNBUFFERED='1', PYTHONPATH=root)
+        proc = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', 'from revmusic.server import cli; cli()', 'serve',
+                                 '--port', '0', '--workers', '2', '--threads', '2', '--max-requests', '5'],
+                                env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        lines = queue.Queue()
+        threading.Thread(target=lambda: [lines.put(line.rstrip('\n')) for line in proc.stdout], daemon=True).start()
+        def wait_for(pattern):
+            # Returns the match of the next output line matching the pattern
+            while True:
+                match = re.match(pattern, lines.get(timeout=20))
+                if match:
+                    return match
+        try:
+            port = wait_for(r'Listening on http://127.0.0.1:(\d+) with 2 workers of 2 threads').group(1)
+            wait_for(r'Worker \d+ started')
+            wait_for(r'Worker \d+ started')
+            # The workers give the same responses as the app itself, and are replaced after 5 requests
+            for i in range(3):
+                for url in self.URLS:
+                    with urllib.request.urlopen('http://127.0.0.1:{}{}'.format(port, url), timeout=20) as resp:
+                        assert resp.status == 200
+                        assert resp.read() == client.get(url).data
+            assert wait_for(r'Worker \d+ exited with status (\d+) after (\d+) requests').groups() == ('0', '5')
+            proc.send_signal(signal.SIGUSR1)
+            assert wait_for(r'Total: (\d+) requests, (\d+) server errors').groups() == ('15', '0')
+            proc.send_signal(signal.SIGHUP)
+            wait_for('Reloading workers')
+            with urllib.request.urlopen('http://127.0.0.1:{}/api/'.format(port), timeout=20) as resp:
+                assert resp.status == 200
+            proc.send_signal(signal.SIGTERM)
+            wait_for('Shutting down')
+            assert wait_for(r'Total: (\d+) requests, (\d+) server errors').groups() == ('16', '0')
+            assert proc.wait(timeout=30) == 0
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+class TestReadReplicas(object):
+    RESOURCE_NAME = 'read replicas'
+
+    def test_routing(self, replica_client):
+        print('\nTesting {} routing: '.format(self.RESOURCE_NAME), end='')
+        client = replica_client
+        paths = [uri[len('sqlite:///'):] for uri in client.application.config['SQLALCHEMY_REPLICA_URIS']]
+        def snapshot():
+            result = client.application.test_cli_runner().invoke(snapshot_db_cmd, paths)
+            assert result.exit_code == 0, result.output
+            # Mark the copies, to see which database a response is read from
+            for i, path in enumerate(paths):
+                connection = sqlite3.connect(path)
+                connection.execute("UPDATE user SET email = 'replica{}@admin.com' WHERE username = 'admin'".format(i))
+                # Without counting it as a change, so the copy doesn't look newer than it is
+                connection.execute("UPDATE data_version SET version = version - 1 WHERE name = 'user'")
+                connection.commit()
+                connection.close()
+        def admin_email(client):
+            resp = client.get('/api/users/admin/')
+            assert resp.status_code == 200
+            return json.loads(resp.data)['email']
+        snapshot()
+
+        # The reads are spread over the replicas
+        assert set(admin_email(client) for i in range(30)) == {'replica0@admin.com', 'replica1@admin.com'}
+        # Writes go to the primary
+        writer = client.application.test_client()
+        resp = writer.post('/api/users/', json=_get_user_json())
+        assert resp.status_code == 201
+        for path in paths:
+            connection = sqlite3.connect(path)
+            assert connection.execute("SELECT count(*) FROM user WHERE username = 'itsame'").fetchone()[0] == 0
+            connection.close()
+        # The writer reads its write from the primary, as the replicas lag behind. Others read from the replicas
+        assert writer.get('/api/users/itsame/').status_code == 200
+        assert admin_email(writer) == 'root@admin.com'
+        assert client.get('/api/users/itsame/').status_code == 404
+        # Once the replicas have caught up, the writer reads from them again
+        snapshot()
+        assert client.get('/api/users/itsame/').status_code == 200
+        assert admin_email(writer).startswith('replica')
+
+    def test_sqlite_replicas(self, replica_client):
+        print('\nTesting {} on SQLite: '.format(self.RESOURCE_NAME), end='')
+        client = replica_client
+        app = client.application
+        paths = [uri[len('sqlite:///'):] for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+        result = app.test_cli_runner().invoke(snapshot_db_cmd, paths)
+        assert result.exit_code == 0
+        assert 'Snapshot written to {}'.format(paths[1]) in result.output
+        # Replicas are read-only
+        with pytest.raises(OperationalError):
+            with app.extensions['replicas'][0].connect() as connection:
+                connection.execute("DELETE FROM user")
+        # The cookie of a write holds the change counters of the primary
+        resp = client.post('/api/users/', json=_get_user_json())
+        assert resp.status_code == 201
+        cookie = re.match(r'revmusic_written=([^;]*);', resp.headers['Set-Cookie']).group(1)
+        with app.app_context():
+            versions = dict(db.session.execute('SELECT name, version FROM data_version').fetchall())
+        assert cookie == '.'.join('{}:{}'.format(name, versions[name]) for name in sorted(versions))
+        assert 'Path=/api/' in resp.headers['Set-Cookie']
+        # A cookie that can't be read makes the client read from the primary
+        reader = app.test_client()
+        assert reader.get('/api/users/itsame/').status_code == 404
+        reader.set_cookie('localhost', 'revmusic_written', 'user:x', path='/api/')
+        assert reader.get('/api/users/itsame/').status_code == 200
+        # Failed writes don't set it
+        resp = reader.post('/api/users/', json=_get_user_json())
+        assert resp.status_code == 409
+        assert 'Set-Cookie' not in resp.headers
+
+class TestBenchmark(object):
+    RESOURCE_NAME = 'benchmark'
+
+    def test_command(self, client):
+        print('\nTesting {} command: '.format(self.RESOURCE_NAME), end='')
+        runner = client.application.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'benchmark.json')
+            result = runner.invoke(benchmark_cmd, ['--scales', '20,40', '--rounds', '2', '--output', output])
+            assert result.exit_code == 0, result.output
+            with open(output) as f:
+                results = json.load(f)
+            assert set(results['scales']) == {'20', '40'}
+            routes = results['scales']['20']
+            assert len(routes) == 28
+            assert {'edit review', 'delete review'} <= set(routes)
+            for summary in routes.values():
+                assert summary['requests'] == 2
+                assert summary['p50_ms'] <= summary['p90_ms'] <= summary['p99_ms'] <= summary['max_ms']
+            # Comparing with a baseline that was much faster and ran fewer queries fails
+            for routes in results['scales'].values():
+                for summary in routes.values():
+                    summary['p50_ms'] /= 100
+                    summary['queries'] -= 1
+            baseline = os.path.join(directory, 'baseline.json')
+            with open(baseline, 'w') as f:
+                json.dump(results, f)
+            result = runner.invoke(benchmark_cmd, ['--scales', '20', '--rounds', '2', '--output', output, '--baseline', baseline])
+            assert result.exit_code == 1
+            assert 'Regression: scale 20, reviews:' in result.output
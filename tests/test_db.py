@@ -2,13 +2,18 @@ import os
 import pytest
 import tempfile
 import datetime
-from sqlalchemy import event, func
+import threading
+from sqlalchemy import event, func, inspect
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError, StatementError
+from jsonschema import ValidationError
 
-from revmusic import create_app, db
-from revmusic.utils import to_date, to_time, to_datetime
-from revmusic.models import User, Album, Review, Tag
+from revmusic import create_app, db, schemas
+from revmusic.utils import to_date, to_time, to_datetime, create_identifier, unique_violation
+from revmusic.models import User, Album, Review, Tag, AlbumActivity, DataVersion, init_db_cmd, upgrade_db_cmd, review_search, match_reviews, search_reviews
+from revmusic.populate_db import generate_data
+from sqlalchemy.pool import QueuePool, StaticPool
+from revmusic.database import configure_engine, get_engine_options
 
 
 # RUN WITH: $ python3 -m pytest -s tests
@@ -32,6 +37,9 @@ def app():
     with app.app_context():
         db.create_all()
     yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
     # Close the temp files
     os.close(db_fd)
     os.unlink(db_fname)
@@ -908,6 +916,56 @@ def test_ondelete(app):
         assert Review.query.count() == 0
         assert Tag.query.count() == 0
 
+def test_set_based_delete(app):
+    """
+    Tests that deleting a user or an album leaves its reviews and tags to the database,
+    with a constant number of statements however many reviews there are
+    """
+    print('\nTesting set-based deletes: ', end='')
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        user, other = _get_user(), _get_user(username='b', email='b@a.com')
+        albums = [_get_album(title=str(i), unique_name=str(i)) for i in range(50)]
+        for i, album in enumerate(albums):
+            review = _get_review(identifier='u' + str(i), star_rating=4)
+            review.user = user
+            review.album = album
+            tag = _get_tag(identifier='t' + str(i))
+            tag.user = other
+            tag.review = review
+            db.session.add(tag)
+        review = _get_review(identifier='o', star_rating=2)
+        review.user = other
+        review.album = albums[0]
+        db.session.add(review)
+        db.session.commit()
+        # Deleting the user doesn't load its reviews (the ones already loaded would be deleted by the session)
+        assert len(user.reviews) == 50
+        db.session.expire(user)
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        db.session.delete(user)
+        db.session.commit()
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+        assert [statement for statement in statements if not statement.startswith('SELECT user')] == ['DELETE FROM user WHERE user.id = ?']
+        assert Review.query.count() == 1
+        assert Tag.query.count() == 0
+        album = Album.query.filter_by(unique_name='0').first()
+        assert (album.review_count, album.rating_sum) == (1, 2)
+
+        statements.clear()
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        assert Album.query.filter_by(unique_name='0').delete(synchronize_session=False) == 1
+        db.session.commit()
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+        assert len(statements) == 1
+        assert Review.query.count() == 0
+        assert User.query.filter_by(username='b').delete(synchronize_session=False) == 1
+        assert User.query.filter_by(username='b').delete(synchronize_session=False) == 0
+        db.session.commit()
+
 def test_onupdate(app):
     """
     Tests that onUpdate works as expected
@@ -954,3 +1012,363 @@ def test_onupdate(app):
         assert Album.query.first().reviews[0].id == 13
         assert Review.query.first().tags[0].id == 36
         assert Tag.query.first().review.id == 13
+
+def test_upgrade_db(app):
+    """
+    Tests that upgrade-db adds the review indexes to a database created without them
+    """
+    print('\nTesting upgrade-db: ', end='')
+    with app.app_context():
+        for index in Review.__table__.indexes:
+            index.drop(bind=db.engine)
+        assert len(inspect(db.engine).get_indexes('review')) == 0
+    result = app.test_cli_runner().invoke(upgrade_db_cmd)
+    assert result.exit_code == 0
+    with app.app_context():
+        names = [index['name'] for index in inspect(db.engine).get_indexes('review')]
+        assert sorted(names) == sorted(index.name for index in Review.__table__.indexes)
+        # The timeframe filtering of the review collection is able to use the index
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM review WHERE submission_date >= :start AND submission_date < :end',
+            {'start': '2021-01-01 00:00:00.000000', 'end': '2021-01-02 00:00:00.000000'}
+        ).fetchall()
+        assert 'ix_review_submission_date' in ' '.join(str(row) for row in plan)
+
+def test_review_search(app):
+    """
+    Tests that the review search index follows inserts, updates and deletes of reviews and albums,
+    and that upgrade-db recreates the index from the existing reviews
+    """
+    print('\nTesting review search index: ', end='')
+    with app.app_context():
+        user = _get_user()
+        album = _get_album(genre='Polka')
+        review = _get_review(title='Accordion heaven', content='Superb')
+        review.user = user
+        review.album = album
+        db.session.add(review)
+        db.session.commit()
+        assert Review.query.join(review_search, review_search.c.rowid == Review.id).filter(match_reviews('accordion polka')).count() == 1
+
+        review.content = 'Terrible'
+        album.genre = 'Humppa'
+        db.session.commit()
+        assert Review.query.join(review_search, review_search.c.rowid == Review.id).filter(match_reviews('superb')).count() == 0
+        assert Review.query.join(review_search, review_search.c.rowid == Review.id).filter(match_reviews('terrible humppa')).count() == 1
+
+        db.session.execute('DROP TABLE review_search')
+        db.session.commit()
+    result = app.test_cli_runner().invoke(upgrade_db_cmd)
+    assert result.exit_code == 0
+    with app.app_context():
+        assert Review.query.join(review_search, review_search.c.rowid == Review.id).filter(match_reviews('terrible humppa')).count() == 1
+        db.session.delete(Review.query.first())
+        db.session.commit()
+        assert db.session.execute('SELECT COUNT(*) FROM review_search').scalar() == 0
+
+def test_schemas(app):
+    """
+    Tests that the schema registry built by create_app matches the models' schemas and cannot be modified
+    """
+    print('\nTesting schema registry: ', end='')
+    for name, model in (('user', User), ('album', Album), ('review', Review)):
+        schema = schemas.get_schema(name)
+        assert schema == model.get_schema()
+        assert schema is schemas.get_schema(name)
+        with pytest.raises(TypeError):
+            schema['required'].append('id')
+        with pytest.raises(TypeError):
+            schema['properties']['title'] = {}
+    schemas.validate({'user': 'a', 'title': 'a', 'content': 'a', 'star_rating': 5}, 'review')
+    with pytest.raises(ValidationError):
+        schemas.validate({'user': 'a', 'title': 'a', 'content': 'a', 'star_rating': 6}, 'review')
+
+def test_create_identifier():
+    """
+    Tests that created identifiers are unique and sorted by creation time, also across threads
+    """
+    print('\nTesting identifier creation: ', end='')
+    identifiers = [create_identifier('review_') for i in range(20000)]
+    assert len(set(identifier for identifier, dt in identifiers)) == len(identifiers)
+    assert sorted(identifiers) == identifiers
+    assert all(identifier.startswith('review_') for identifier, dt in identifiers)
+    assert all(identifier[7:27] == dt.strftime('%Y%m%d%H%M%S%f') for identifier, dt in identifiers)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.extend(create_identifier('tag_')[0] for i in range(2000))) for j in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results)) == 8000
+
+def test_unique_violation(app):
+    """
+    Tests that the violated unique constraint is found from the IntegrityError
+    """
+    print('\nTesting unique violations: ', end='')
+    with app.app_context():
+        db.session.add(_get_album())
+        db.session.commit()
+        for album, columns in [(_get_album(unique_name='b'), ('title', 'artist')), (_get_album(title='b'), ('unique_name',))]:
+            db.session.add(album)
+            with pytest.raises(IntegrityError) as e:
+                db.session.commit()
+            db.session.rollback()
+            assert unique_violation(e.value) == columns
+        db.session.add(Review(identifier='a', title='a', content='a', star_rating=5, submission_date=datetime.datetime(2021, 1, 1)))
+        with pytest.raises(IntegrityError) as e:
+            db.session.commit()
+        db.session.rollback()
+        assert unique_violation(e.value) is None
+
+    # The error of PostgreSQL carries the details in diag
+    class Diag(object):
+        message_detail = 'Key (title, artist)=(a, a) already exists.'
+    class PostgresError(Exception):
+        pgcode = '23505'
+        diag = Diag()
+    assert unique_violation(IntegrityError('INSERT', {}, PostgresError())) == ('title', 'artist')
+    PostgresError.pgcode = '23503'
+    assert unique_violation(IntegrityError('INSERT', {}, PostgresError())) is None
+
+def test_generate_data(app):
+    """
+    Tests that the synthetic data generator fills every table consistently and deterministically
+    """
+    with app.app_context():
+        users, albums, reviews, tags = generate_data(200, seed=1)
+        assert (users, albums) == (200, 100)
+        assert User.query.count() == users
+        assert Album.query.count() == albums
+        assert Review.query.count() == reviews
+        assert Tag.query.count() == tags
+        assert reviews > users
+        # Ratings are skewed towards the high end, and the most popular album gets many reviews
+        ratings = dict(db.session.query(Review.star_rating, func.count()).group_by(Review.star_rating).all())
+        assert set(ratings) <= set(range(1, 6))
+        assert ratings.get(5, 0) > ratings.get(1, 0)
+        top = db.session.query(func.count()).select_from(Review).group_by(Review.album_id).order_by(func.count().desc()).first()[0]
+        assert top > reviews / albums * 5
+        # The search index is filled by the triggers
+        assert db.session.query(func.count()).select_from(review_search).scalar() == reviews
+        # The reviews are dated up to today, also the recent ones the time windows of the queries look at
+        newest, oldest = db.session.query(func.max(Review.submission_date), func.min(Review.submission_date)).one()
+        assert datetime.datetime.now() - datetime.timedelta(days=30) < newest <= datetime.datetime.now()
+        assert oldest >= datetime.datetime.now() - datetime.timedelta(days=3 * 366)
+        first = [(review.identifier[:7], review.title, review.star_rating) for review in Review.query.order_by(Review.id).limit(50)]
+        # Data with another seed can be added to the same database
+        more = generate_data(10, seed=2)
+        assert User.query.count() == users + more[0]
+    # The same seed gives the same data
+    db_fd, db_fname = tempfile.mkstemp()
+    other = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "SQLALCHEMY_TRACK_MODIFICATIONS": False})
+    try:
+        with other.app_context():
+            db.create_all()
+            generate_data(200, seed=1, now=datetime.datetime(2021, 5, 1))
+            assert [(review.identifier[:7], review.title, review.star_rating) for review in Review.query.order_by(Review.id).limit(50)] == first
+            assert db.session.query(func.max(Review.submission_date)).scalar() <= datetime.datetime(2021, 5, 1)
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+def test_sqlite_pragmas(app):
+    """
+    Tests that every new connection is configured with the pragmas, and that the configuration is registered once per engine
+    """
+    def read_pragmas(engine):
+        with engine.connect() as conn:
+            return {name: conn.execute('PRAGMA {}'.format(name)).scalar() for name in
+                ['foreign_keys', 'journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'temp_store']}
+
+    with app.app_context():
+        engine = db.engine
+    # The listener of the tests sets only foreign_keys, so the rest come from the app
+    assert read_pragmas(engine) == {
+        'foreign_keys': 1, 'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000, 'cache_size': -64000, 'temp_store': 2
+    }
+    configure_engine(engine, {'SQLITE_PRAGMAS': {'busy_timeout': 1}})
+    assert read_pragmas(engine)['busy_timeout'] == 5000
+
+    # Overridden and disabled pragmas
+    db_fd, db_fname = tempfile.mkstemp()
+    other = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "SQLITE_PRAGMAS": {'journal_mode': None, 'synchronous': 'FULL', 'busy_timeout': 100}
+    })
+    try:
+        with other.app_context():
+            pragmas = read_pragmas(db.engine)
+            db.engine.dispose()
+        assert pragmas['journal_mode'] == 'delete'
+        assert pragmas['synchronous'] == 2
+        assert pragmas['busy_timeout'] == 100
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+def test_engine_options(app):
+    """
+    Tests the pool settings given to the engine for database servers and SQLite
+    """
+    options = get_engine_options({'SQLALCHEMY_DATABASE_URI': 'postgresql://revmusic@dbhost/revmusic', 'DATABASE_POOL_SIZE': 20})
+    assert options == {'pool_size': 20, 'max_overflow': 10, 'pool_recycle': 1800, 'pool_timeout': 30, 'pool_pre_ping': True}
+    options = get_engine_options({
+        'SQLALCHEMY_DATABASE_URI': 'mysql+pymysql://revmusic@dbhost/revmusic',
+        'SQLALCHEMY_ENGINE_OPTIONS': {'pool_recycle': 60, 'echo': True}
+    })
+    assert (options['pool_recycle'], options['echo'], options['pool_pre_ping']) == (60, True, True)
+    # SQLite files get a pool of connections usable from any thread, in-memory databases are left to Flask-SQLAlchemy
+    options = get_engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite:////tmp/revmusic.db'})
+    assert options['poolclass'] is QueuePool
+    assert options['connect_args'] == {'check_same_thread': False}
+    assert get_engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}) == {}
+
+    with app.app_context():
+        assert isinstance(db.engine.pool, QueuePool)
+        # Connections are reused between sessions
+        first = db.session.connection().connection.connection
+        db.session.remove()
+        assert db.session.connection().connection.connection is first
+        # A connection opened by another process, i.e. before a fork, is replaced and not used
+        db.session.connection().connection._connection_record.info['pid'] = -1
+        db.session.remove()
+        assert db.session.connection().connection.connection is not first
+        assert db.session.execute('SELECT 1').scalar() == 1
+
+def test_init_db(app):
+    """
+    Tests that init-db recreates the tables through the engine, the search index and the change counters included
+    """
+    print('\nTesting init-db: ', end='')
+    with app.app_context():
+        review = _get_review()
+        review.user = _get_user()
+        review.album = _get_album()
+        db.session.add(review)
+        db.session.commit()
+    result = app.test_cli_runner().invoke(init_db_cmd)
+    assert result.exit_code == 0
+    with app.app_context():
+        assert User.query.count() == 0
+        assert Review.query.count() == 0
+        assert sorted(version.name for version in DataVersion.query) == ['album', 'review', 'user']
+        assert db.session.query(func.count()).select_from(review_search).scalar() == 0
+        review = _get_review(title='Accordion heaven')
+        review.user = _get_user()
+        review.album = _get_album()
+        db.session.add(review)
+        db.session.commit()
+        query, relevance = search_reviews(Review.query.join(Review.album), 'accordion')
+        assert query.count() == 1
+        assert DataVersion.query.get('review').version == 1
+
+def test_album_ratings(app):
+    """
+    Tests that the rating aggregates of the albums follow inserts, updates and deletes of reviews,
+    and that upgrade-db adds and fills them in a database created without them
+    """
+    print('\nTesting album rating aggregates: ', end='')
+    def aggregates(album):
+        db.session.refresh(album)
+        return (album.review_count, album.rating_sum, album.average_rating, album.rating_histogram)
+
+    with app.app_context():
+        users = [_get_user(username=str(i), email='{}@a.com'.format(i)) for i in range(3)]
+        album, other = _get_album(), _get_album(title='b', unique_name='b')
+        db.session.add(album)
+        db.session.commit()
+        assert aggregates(album) == (0, 0, None, {'1': 0, '2': 0, '3': 0, '4': 0, '5': 0})
+        reviews = []
+        for i, stars in enumerate([5, 4, 4]):
+            review = _get_review(identifier=str(i), star_rating=stars)
+            review.user = users[i]
+            review.album = album
+            reviews.append(review)
+        db.session.add_all(reviews + [other])
+        db.session.commit()
+        assert aggregates(album) == (3, 13, 13 / 3, {'1': 0, '2': 0, '3': 0, '4': 2, '5': 1})
+
+        reviews[0].star_rating = 1
+        db.session.commit()
+        assert aggregates(album) == (3, 9, 3.0, {'1': 1, '2': 0, '3': 0, '4': 2, '5': 0})
+        reviews[1].album = other
+        db.session.commit()
+        assert aggregates(album)[:2] == (2, 5)
+        assert aggregates(other) == (1, 4, 4.0, {'1': 0, '2': 0, '3': 0, '4': 1, '5': 0})
+        db.session.delete(reviews[2])
+        db.session.commit()
+        assert aggregates(album)[:2] == (1, 1)
+        # Bulk inserts and cascading deletes bypass the ORM
+        db.session.execute(Review.__table__.insert(), [{
+            'identifier': 'bulk', 'user_id': users[2].id, 'album_id': album.id, 'title': 'a', 'content': 'a',
+            'star_rating': 3, 'submission_date': datetime.datetime(2021, 1, 1)
+        }])
+        db.session.commit()
+        assert aggregates(album)[:2] == (2, 4)
+        db.session.execute('DELETE FROM user WHERE id = :id', {'id': users[0].id})
+        db.session.commit()
+        assert aggregates(album) == (1, 3, 3.0, {'1': 0, '2': 0, '3': 1, '4': 0, '5': 0})
+        # Sorting by the average uses the stored aggregates
+        assert [a.unique_name for a in Album.query.order_by(Album.average_rating.desc())] == ['b', 'a']
+
+        for name in ('album_rating_insert', 'album_rating_update', 'album_rating_delete'):
+            db.session.execute('DROP TRIGGER {}'.format(name))
+        db.session.execute('DROP INDEX ix_album_review_count')
+        for name in ('review_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5'):
+            db.session.execute('ALTER TABLE album DROP COLUMN {}'.format(name))
+        db.session.commit()
+        db.session.remove()
+    result = app.test_cli_runner().invoke(upgrade_db_cmd)
+    assert result.exit_code == 0
+    assert 'Added column album.rating_5' in result.output
+    with app.app_context():
+        album = Album.query.filter_by(unique_name='a').first()
+        assert aggregates(album) == (1, 3, 3.0, {'1': 0, '2': 0, '3': 1, '4': 0, '5': 0})
+        db.session.delete(Review.query.filter_by(identifier='bulk').first())
+        db.session.commit()
+        assert aggregates(album)[:2] == (0, 0)
+
+def test_album_activity(app):
+    """
+    Tests that the daily activity of the albums follows the reviews, and that upgrade-db recomputes it
+    """
+    print('\nTesting album activity: ', end='')
+    def activity():
+        return [(row.album_id, row.day.isoformat(), row.review_count, row.rating_sum)
+            for row in AlbumActivity.query.order_by(AlbumActivity.album_id, AlbumActivity.day)]
+
+    with app.app_context():
+        album, other = _get_album(), _get_album(title='b', unique_name='b')
+        reviews = []
+        for i, (stars, date) in enumerate([(5, '2021-01-01 10:10:10'), (3, '2021-01-01 23:59:59'), (4, '2021-01-02 00:00:00')]):
+            review = _get_review(identifier=str(i), star_rating=stars, submission_date=date)
+            review.user = _get_user(username=str(i), email='{}@a.com'.format(i))
+            review.album = album
+            reviews.append(review)
+        db.session.add_all(reviews + [other])
+        db.session.commit()
+        assert activity() == [(album.id, '2021-01-01', 2, 8), (album.id, '2021-01-02', 1, 4)]
+
+        reviews[0].submission_date = to_datetime('2021-01-02 10:10:10')
+        reviews[1].album = other
+        db.session.commit()
+        assert activity() == [(album.id, '2021-01-01', 0, 0), (album.id, '2021-01-02', 2, 9), (other.id, '2021-01-01', 1, 3)]
+        db.session.delete(reviews[2])
+        db.session.commit()
+        assert activity()[1] == (album.id, '2021-01-02', 1, 5)
+
+        # Rows of deleted albums go with them
+        db.session.execute('DELETE FROM album WHERE id = :id', {'id': other.id})
+        db.session.execute('DELETE FROM album_activity WHERE album_id = :id', {'id': album.id})
+        db.session.commit()
+        assert activity() == []
+        db.session.remove()
+    result = app.test_cli_runner().invoke(upgrade_db_cmd)
+    assert result.exit_code == 0
+    with app.app_context():
+        assert activity() == [(Album.query.first().id, '2021-01-02', 1, 5)]